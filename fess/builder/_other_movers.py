@@ -22,6 +22,7 @@ class MSTchangingMover(Mover):
     def move(self, sm):
         self._prev_stats = {}
         self._prev_mst = None
+        self._snapshot = None
         # Get an element. If it is a ml-segment, break it.
         elem = self._get_elem(sm)
         if elem[0]=="m":
@@ -29,10 +30,9 @@ class MSTchangingMover(Mover):
             if "open" in sm.bg.describe_multiloop(loop):
                 return super(MSTchangingMover, self).move(sm)
             else:
-                defined_loop = set(loop)&sm.bg.mst
                 self._prev_mst = copy.copy(sm.bg.mst)
-                for node in defined_loop:
-                    self._prev_stats[node]= sm.elem_defs[node]
+                # Changing the MST reloads all stats from the coordinates.
+                self._prev_stats = dict(sm.elem_defs)
                 old_elem = elem
                 # Now change the MST
                 elem = sm.set_multiloop_break_segment(elem)
@@ -45,14 +45,20 @@ class MSTchangingMover(Mover):
             return super(MSTchangingMover, self).move(sm)
 
     def revert(self, sm):
-        if self._prev_mst is not None:
-            # Reset MST
-            log.info("Reverting MST")
-            sm.change_mst(self._prev_mst)
-        else:
+        if self._prev_mst is None:
             log.info("Nothing to revert")
+            super(MSTchangingMover, self).revert(sm)
+            return
+        # Reset MST
+        log.info("Reverting MST")
+        sm.change_mst(self._prev_mst, self.stat_source)
         self._prev_mst = None
-        super(MSTchangingMover, self).revert(sm)
+        # change_mst loads the stats from the coordinates, so the stats are restored afterwards.
+        sm.elem_defs.clear()
+        sm.elem_defs.update(self._prev_stats)
+        self._prev_stats = {}
+        # The build order has changed, so everything needs to be rebuilt.
+        sm.new_traverse_and_build(start="start", include_start=True)
 
 class ExhaustiveMover(Mover):
     HELPTEXT = ("Try all fragment combinations for \n"
@@ -133,7 +139,8 @@ class NElementMover(Mover):
                 movestring.append(self._move(sm, elem, new_stat))
             if i>100000:
                 raise RuntimeError("Caught in an endless loop (?)")
-        sm.new_traverse_and_build(start = "start", include_start=True)
+        self._snapshot = sm.snapshot(list(self._prev_stats))
+        sm.rebuild_changed(list(self._prev_stats))
         return "".join(movestring)
 
 
@@ -198,7 +205,8 @@ class WholeMLMover(Mover):
         while self._has_incomplete_ml(sm):
             elem, new_stat = self._get_elem_and_stat(sm)
             movestring.append(self._move(sm, elem, new_stat))
-        sm.new_traverse_and_build(start = "start", include_start = True)
+        self._snapshot = sm.snapshot(list(self._prev_stats))
+        sm.rebuild_changed(list(self._prev_stats))
         return "".join(movestring)
     def _has_incomplete_ml(self, sm):
         if not self._prev_stats:
@@ -22,6 +22,8 @@ import os.path
 
 from logging_exceptions import log_to_exception
 
+from .geometry import segment_distances
+
 log=logging.getLogger(__name__)
 
 try:
@@ -69,15 +71,14 @@ def iter_probs(loop, cg, prob_fun, cutoff_dist, domain = None):
         stems = (s for s in domain if s[0]=="s")
     else:
         stems = cg.stem_iterator()
+    stems = [s for s in stems if s not in cg.edges[loop]]
+    if stems:
+        stem_coords = cg.coords[stems].reshape(-1, 2, 3)
+        distances, = segment_distances(cg.coords[loop][:1], cg.coords[loop][1:],
+                                       stem_coords[:,0], stem_coords[:,1],
+                                       cutoff=cutoff_dist)
+        stems = [s for s, dist in zip(stems, distances) if dist < cutoff_dist]
     for s in stems:
-        if s in cg.edges[loop]:
-            continue
-        if not ftuv.elements_closer_than(cg.coords[loop][0],
-                                 cg.coords[loop][1],
-                                 cg.coords[s][0],
-                                 cg.coords[s][1],
-                                 cutoff_dist):
-            continue
         point = get_relative_orientation(cg, loop, s)
         p, = prob_fun(point)
         if p>1:
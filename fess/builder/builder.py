@@ -167,7 +167,14 @@ class Builder(object):
                     built_nodes = built_nodes[:built_nodes.index(start_node)]
                     log.debug("Going back to node {}".format(start_node))
                 else:
-                    start_node = built_nodes[-1]
+                    # built_nodes holds the loop and stem of every build step so far, after s0.
+                    # Starting at a stem would only build the children of that stem,
+                    # so we start at the loop of the next step in the build order.
+                    next_step = (len(built_nodes) - 1) // 2
+                    if next_step < len(sm.bg.build_order):
+                        start_node = sm.bg.build_order[next_step][1]
+                    else:
+                        start_node = "end"
                     log.debug("Proceeding with next node {}".format(start_node))
                 newbuilt_nodes = sm.new_traverse_and_build(start = start_node, max_steps = 1)
         except KeyboardInterrupt:
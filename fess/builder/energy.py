@@ -5,7 +5,7 @@ from builtins import (ascii, bytes, chr, dict, filter, hex, input, #pip install
                       str, super, zip)
 __metaclass__=object
 
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict
 import random
 import warnings
 import os.path as op
@@ -32,9 +32,9 @@ import scipy.stats
 import scipy.optimize
 import scipy.ndimage
 import scipy.misc
+from scipy.spatial import cKDTree
 import pandas as pd
 
-import Bio.KDTree as kd #KD-Trees for distance-calculations in point-cloud.
 
 from logging_exceptions import log_to_exception
 
@@ -50,8 +50,10 @@ import forgi.threedee.model.descriptors as ftmd
 import forgi.threedee.classification.aminor as ftca
 
 
-from .energy_abcs import EnergyFunction, CoarseGrainEnergy, DEFAULT_ENERGY_PREFACTOR, InteractionEnergy
+from .energy_abcs import (EnergyFunction, CoarseGrainEnergy, DEFAULT_ENERGY_PREFACTOR,
+                          InteractionEnergy, TabulatedDistribution, LengthIndexedData)
 import fess.builder.aminor as fba
+from fess.builder.geometry import GeometryCache, segment_distances
 from fess.builder._commandline_helper import replica_substring
 from ..utils import get_all_subclasses, get_version_string
 from fess import data_file
@@ -84,9 +86,36 @@ def load_local_data(filename):
     except TypeError:
         return StringIO(data.decode("utf-8"))
 
+#: Reference data tables loaded by `load_reference_data`, shared by all energies.
+_reference_data = {}
+
+def load_reference_data(filename, length_col="nt_length", **kwargs):
+    '''
+    Load a table of reference data once per process.
+
+    All energies (e.g. one SLD energy per hairpin) share the same
+    LengthIndexedData instance, which must not be modified.
+
+    :param filename: A filename relative to the base directory of the
+                     package (see `load_local_data`) or an absolute path.
+    :param length_col: The name of the column holding the RNA length.
+    :param kwargs: Passed to pandas.read_csv
+    :return: A LengthIndexedData instance
+    '''
+    key = (filename, length_col, repr(sorted(kwargs.items())))
+    if key not in _reference_data:
+        log.info("Loading reference data from %s", filename)
+        if op.isabs(filename):
+            data = pd.read_csv(filename, **kwargs)
+        else:
+            data = pd.read_csv(load_local_data(filename), **kwargs)
+        _reference_data[key] = LengthIndexedData(data, length_col)
+    return _reference_data[key]
+
 class RandomEnergy(EnergyFunction):
     _shortname = "RND"
     HELPTEXT = "Random Energy"
+    cacheable = False
     def eval_energy(self, cg, background=None, nodes=None, **kwargs):
         return self.prefactor * random.random() + self.adjustment
 
@@ -108,6 +137,7 @@ class ConstantEnergy(EnergyFunction):
 class CheatingEnergy(EnergyFunction):
     _shortname = "CHE"
     HELPTEXT = "Cheating Energy. Tries to minimize the RMSD."
+    non_negative = True
     @classmethod
     def from_cg(cls, prefactor, adjustment, cg, **kwargs):
         if "reference_cg" in kwargs:
@@ -123,7 +153,7 @@ class CheatingEnergy(EnergyFunction):
         super(CheatingEnergy, self).__init__(prefactor = prefactor, adjustment = adjustment)
         self.real_residues = ref_cg.get_ordered_virtual_residue_poss()
     def eval_energy(self, cg, background=None, nodes=None, **kwargs):
-        new_residues = cg.get_ordered_virtual_residue_poss()
+        new_residues = GeometryCache.for_cg(cg).virtual_residues
         return  ftms.rmsd(self.real_residues, new_residues)**self.adjustment*self.prefactor
 
 
@@ -149,14 +179,12 @@ class FitVolume(EnergyFunction):
         super(FitVolume, self).__init__(prefactor, adjustment)
     def eval_energy(self, cg, *args, **kwargs):
         density = np.zeros_like(self.data)
-        points = []
-        for i in range(1, cg.seq_length+1):
-            points.append(cg.get_virtual_residue(i, allow_single_stranded=True))
+        geometry = GeometryCache.for_cg(cg)
 
         # model 000 = self.centroid
 
         origin_x, origin_y, origin_z = self.centroid
-        points = ftuv.center_on_centroid(points)
+        points = geometry.virtual_residues - geometry.centroid
         for point in points:
             x,y,z = point
             x = int((x + origin_x) // self.vox_x)
@@ -172,6 +200,7 @@ class ProjectionMatchEnergy(EnergyFunction):
     _shortname = "PRO"
     HELPTEXT = ("Match Projection distances. \n"
                "Requires the projected distances.")
+    non_negative = True
     @classmethod
     def from_cg(cls, prefactor, adjustment, pro_distances, cg, **kwargs):
         """
@@ -221,7 +250,8 @@ class ProjectionMatchEnergy(EnergyFunction):
 
     def optimizeProjectionDistance(self, p):
         """
-        :param c: A numpy array. The projection vector that HAS TO BE NORMALIZED
+        :param c: A numpy array. The projection vector that HAS TO BE NORMALIZED.
+                  An array of shape (3, K) evaluates K projection vectors at once.
 
         Let theta be the angle between the p, normal vector of the plane of projection,
         and the vector a which is projected onto that plain.
@@ -241,21 +271,25 @@ class ProjectionMatchEnergy(EnergyFunction):
         for all d, i.e. for all a, dist_3d, dist_2d considered.
         Under the side constraint that p has to be normalized.
         """
-        x=0
-        #Sum over all given distances
-        for (s,e), dist in self.distances.items():
-            sc=self.cg.coords[s]
-            ec=self.cg.coords[e]
-            #The middle point of the cg element
-            start=(sc[0]+sc[1])/2
-            end=(ec[0]+ec[1])/2
-            a=end-start
-            lengthDifferenceExperiment=ftuv.magnitude(a)**2-dist**2
-            lengthDifferenceGivenP=(p[0]*a[0]+p[1]*a[1]+p[2]*a[2])**2
-            # Add the deviation between (3d length-2d length)**2 observed vs calculated
-            # for the given projection angle
-            x+=abs(lengthDifferenceGivenP-lengthDifferenceExperiment)
-        return x
+        lengthDifferenceGivenP = np.dot(np.asarray(p).T, self._projection_vectors.T)**2
+        # Sum the deviations between (3d length-2d length)**2 observed vs calculated
+        # for the given projection angle over all given distances
+        return np.sum(np.abs(lengthDifferenceGivenP-self._length_differences), axis=-1)
+
+    def _set_projection_vectors(self, cg):
+        """
+        Store the vectors a between the middle points of the cg elements and
+        the values dist_3d^2-dist2d^2 used by optimizeProjectionDistance.
+        """
+        geometry = GeometryCache.for_cg(cg)
+        index = geometry.segment_index
+        #The middle point of the cg elements
+        middle = np.mean(geometry.segments, axis=1)
+        starts, ends = zip(*self.distances.keys())
+        self._projection_vectors = (middle[[index[e] for e in ends]]
+                                    - middle[[index[s] for s in starts]])
+        dists = np.array(list(self.distances.values()), dtype=float)
+        self._length_differences = np.sum(self._projection_vectors**2, axis=1) - dists**2
 
     def eval_energy(self, cg, background=None, nodes=None, **kwargs):
         """
@@ -274,14 +308,10 @@ class ProjectionMatchEnergy(EnergyFunction):
         self.cg=cg
         # The projection vector has to be normalized
         c1={'type':'eq', 'fun':lambda x: x[0]**2+x[1]**2+x[2]**2-1}
-        best_start=np.array([0.,0.,0.])
-        best_score=float('inf')
-        for direction in self.start_points:
-            score=self.optimizeProjectionDistance(direction)
-            if score<best_score:
-                best_start=direction
-                best_score=score
-        opt=scipy.optimize.minimize(self.optimizeProjectionDistance, direction,
+        self._set_projection_vectors(cg)
+        scores=self.optimizeProjectionDistance(np.array(self.start_points).T)
+        best_start=self.start_points[np.argmin(scores)]
+        opt=scipy.optimize.minimize(self.optimizeProjectionDistance, best_start,
                                     constraints=c1, options={"maxiter":200} )
         if opt.success:
             self.projDir=opt.x
@@ -301,6 +331,7 @@ class FPPEnergy(EnergyFunction):
     name = "Four-Point-Projection-Energy"
     HELPTEXT = ("4 point projection energy.\n"
                 "Select 4 landmarks in the projected image.")
+    non_negative = True
 
     @classmethod
     def from_cg(cls, prefactor, adjustment, fpp_landmarks, fpp_ref_image, fpp_scale, cg, **kwargs):
@@ -502,6 +533,13 @@ class DistanceExponentialEnergy(EnergyFunction):
             name = "{}{}".format(name, self.adjustment)
         return "{}({},{})".format(name,self.from_elem, self.to_elem)
 
+    def depends_on(self, cg):
+        return set([self.from_elem, self.to_elem])
+
+    def lower_bound(self):
+        # -log(pdf) of the exponential distribution is at least log(scale)
+        return min(0., 10.*math.log(self.prefactor))
+
     def eval_energy(self, cg, background=True, nodes=None, **kwargs):
         "This energy is always >0"
         closest_distance = self.get_distance(cg)
@@ -525,6 +563,7 @@ class StemVirtualResClashEnergy(EnergyFunction):
     IS_CONSTRAINT_ONLY = True
     can_constrain = "sm"
     HELPTEXT = "Clash constraint energy"
+    non_negative = True
 
 
     def __init__(self, clash_penalty = None, atom_diameter = None):
@@ -542,167 +581,320 @@ class StemVirtualResClashEnergy(EnergyFunction):
                     adjustment = atom_diameter    )
         self.bad_bulges = []
         self.bad_atoms = defaultdict(list)
+        #: The _ClashIndex of the last structure evaluated with nodes=None
+        self._clash_index = None
+        #: The _ClashIndex of the last accepted structure
+        self._accepted_clash_index = None
 
-    def _virtual_residue_atom_clashes_kd(self, cg):
+    def _stem_connectivity(self, cg, stems):
         '''
-        Check if any of the virtual residue atoms clash.
-        '''
-        virtual_atoms = []
-        coords = []
-        for key1 in self.vras.keys():
-            for key2 in self.vras[key1].keys():
-                virtual_atoms += [(self.vras[key1][key2], key1, key2)]
-                coords += [self.vras[key1][key2]]
-
-        if len(virtual_atoms) == 0:
-            return 0
-
-        #coords = np.vstack([p[0] for p in virtual_atoms])
-        #coords = np.array([ line for line in np.array(virtual_atoms)[:,0]])
-        coords = np.array(coords)
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            kdt2 = kd.KDTree(3)
-            kdt2.set_coords(coords)
-            kdt2.all_search(self.adjustment) #Distance in Angstrom. #1.8
-
-        clashes = 0
-        indeces = kdt2.all_get_indices()
-        for (ia,ib) in indeces:
-            key1 = virtual_atoms[ia][1]
-            key2 = virtual_atoms[ib][1]
-
-            if key1[0] == key2[0]:
-                continue
-            if  cg.edges[key1[0]] & cg.edges[key2[0]]:
-                 # Really do not consider connected stems,
-                continue
-
-            resn1 = cg.stem_side_vres_to_resn(key1[0], key1[2], key1[1])
-            resn2 = cg.stem_side_vres_to_resn(key2[0], key2[2], key2[1])
-
-            #Adjacent residues cannot clash
-            if abs(resn1 - resn2) == 1:
-                continue
-            clash_pair = tuple(sorted([key1[0], key2[0]]))
-            if clash_pair not in self.bad_bulges:
-                self.bad_bulges.append(clash_pair)
-            self.bad_atoms[key1[0]].append(virtual_atoms[ia][0])
-            self.bad_atoms[key2[0]].append(virtual_atoms[ib][0])
-            clashes += 1
+        A boolean matrix, which is True for every pair of stems that
+        must not be checked for clashes (a stem with itself and stems
+        connected by a common loop).
 
-        return clashes
-
-    def _virtual_residue_atom_clashes(self, cg, s1,i1,a1, s2, i2, a2):
+        :param stems: A list of stem names. Rows and columns of the
+                      matrix are in the same order.
         '''
-        Check if any of the virtual residue atoms clash.
-
-        This is a reference implementation without KD-Trees.
-        Thus it is only used for testing!
+        stem_index = {s: i for i, s in enumerate(stems)}
+        loop_index = {}
+        rows = []
+        cols = []
+        for s in stems:
+            for loop in cg.edges[s]:
+                rows.append(stem_index[s])
+                cols.append(loop_index.setdefault(loop, len(loop_index)))
+        incidence = np.zeros((len(stems), len(loop_index)), dtype=int)
+        incidence[rows, cols] = 1
+        connected = np.dot(incidence, incidence.T) > 0
+        np.fill_diagonal(connected, True)
+        return connected
+
+    def _virtual_residue_points(self, cg, stems, mult=8):
         '''
-        #(p1, v1, v1_l, v1_r) = ftug.virtual_res_3d_pos(bg, s1, i1)
-        #(p2, v2, v2_l, v2_r) = ftug.virtual_res_3d_pos(bg, s2, i2)
-
-
-        vra1 = self.vras[(s1,i1,a1)]
-        vra2 = self.vras[(s2,i2,a2)]
-
-        clashes = 0
+        Get one point per virtual residue and strand, located mult
+        Angstrom away from the helix axis in the direction of the residue.
 
-        atoms1 = vra1
-        atoms2 = vra2
-
-        #for atoms1 in vra1:
-            #for atoms2 in vra2:
-
-        for a1 in atoms1.values():
-            for a2 in atoms2.values():
-                if ftuv.vec_distance(a1,a2) < 1.8:
-                #if ftuv.magnitude(a1 - a2) < 1.8:
-                    clashes += 1
-
-        return clashes
+        :returns: A tuple (points, stem_idx, vres, side, resn) of numpy arrays
+                  with one entry per point. stem_idx indexes into `stems`,
+                  resn is the residue number of the point.
+        '''
+        points = []
+        stem_idx = []
+        vres = []
+        side = []
+        resn = []
+        for k, s in enumerate(stems):
+            s_len = cg.stem_length(s)
+            define = cg.defines[s]
+            v3dposs = np.array([cg.v3dposs[s][i] for i in range(s_len)])
+            # Per virtual residue, the point for side 1 (v_l) comes first.
+            stem_points = np.empty((s_len, 2, 3))
+            stem_points[:, 0] = v3dposs[:, 0] + mult * v3dposs[:, 2]
+            stem_points[:, 1] = v3dposs[:, 0] + mult * v3dposs[:, 3]
+            points.append(stem_points.reshape(-1, 3))
+            i = np.repeat(np.arange(s_len), 2)
+            a = np.tile([1, 0], s_len)
+            stem_idx.append(np.full(2 * s_len, k, dtype=int))
+            vres.append(i)
+            side.append(a)
+            resn.append(np.where(a == 0, define[0] + i, define[3] - i))
+        return (np.vstack(points), np.concatenate(stem_idx), np.concatenate(vres),
+                np.concatenate(side), np.concatenate(resn))
 
     def eval_energy(self, cg, background=False, nodes = None, **kwargs):
         '''
         Count how many clashes of virtual residues there are.
 
+        If nodes is None, the clashes are found incrementally: Only the stems
+        that moved since the last evaluation are tested against the rest
+        (see `accept_last_measure` and `reject_last_measure`).
+
         @param sm: The SpatialModel containing the list of stems.
         @param background: Use a background distribution to normalize this one.
                            This should always be false since clashes are independent
                            of any other energies.
         '''
-        #: A dict of dicts. The first key is a triple (stem, a, b), e.g.: ('s27', 5, 1)
-        #: Where a is the position within the strand and b is the stem (0 or 1)
-        #: The key of the inner dict is the atom, e.g. "O3'"
-        self.vras = dict()
-        self.bases = dict()
         self.bad_bulges = []
         self.bad_atoms = defaultdict(list)
-        mult = 8
-        points = []
-        energy = 0.
 
+        incremental = nodes is None
         if nodes is None:
             nodes = cg.defines.keys()
 
-        self.log.debug("%s stems: %s", len([stem for stem in nodes if stem[0]=="s"]), nodes)
-        if len([stem for stem in nodes if stem[0]=="s"])<2:
+        stems = sorted(d for d in nodes if d[0] == "s")
+        self.log.debug("%s stems: %s", len(stems), nodes)
+        if len(stems)<2:
             # Special case, if only one stem is present.
             return 0.
 
-        for d in nodes:
-            if d[0] == 's':
-                s = d
-                s_len = cg.stem_length(s)
-                #stem_inv = cg.stem_invs[s]
-                self.log.debug("s %s, slen %s", s, s_len)
-                for i in range(s_len):
-                    (p, v, v_l, v_r) = cg.v3dposs[d][i]
-
-                    points += [(p+ mult * v_l, d, i, 1)]
-                    points += [(p+ mult * v_r, d, i, 0)]
-        self.log.debug("points: %s, nodes %s, defines %s", points, nodes, cg.defines)
-        coords = np.vstack([point[0] for point in points])
-        clash_pairs = []
-        #kk = ss.KDTree(np.array(l))
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            kdt = kd.KDTree(3)
-            kdt.set_coords(coords)
-            kdt.all_search(10.)
-        #print len(kdt.all_get_indices())
-        #print len(kk.query_pairs(7.))
-        indeces = kdt.all_get_indices()
-        for (ia,ib) in indeces:
-            (s1,i1,a1) = (points[ia][1], points[ia][2], points[ia][3])
-            (s2,i2,a2) = (points[ib][1], points[ib][2], points[ib][3])
-            clash_pairs += [((s1,i1,a1), (s2,i2,a2))]
-            #print("NO NEW NODES: ", sorted(clash_pairs))
-
-        #potential_clashes = 0
-        for (s1, i1, a1), (s2,i2,a2) in clash_pairs:
-            #if new_nodes != None:
-            #    if s1 not in new_nodes and s2 not in new_nodes:
-            #        continue
-
-            if s1 == s2:
-                continue
+        if incremental:
+            self._clash_index = self._update_clash_index(cg, stems)
+            index = self._clash_index
+            self._record_clashes(stems, index.point_stem[index.pair_points], index.pair_atoms)
+            return self.prefactor * len(index.pair_points)
 
-            if cg.edges[s1]&cg.edges[s2]:
-                # the stems are connected
-                continue
+        connected = self._stem_connectivity(cg, stems)
+        points, stem_idx, vres, side, resn = self._virtual_residue_points(cg, stems)
 
-            #potential_clashes += 1
-            #fud.pv('s1,s2')
+        # Find virtual residues of unconnected stems that come close to each other.
+        pairs = cKDTree(points).query_pairs(10., output_type='ndarray')
+        pairs = pairs[~connected[stem_idx[pairs[:,0]], stem_idx[pairs[:,1]]]]
+        candidates = np.unique(pairs)
+        if len(candidates) == 0:
+            return 0.
 
-            if (s1,i1,a1) not in self.vras.keys():
-                self.vras[(s1,i1,a1)] = ftug.virtual_residue_atoms(cg, s1, i1, a1)
-            if (s2,i2,a2) not in self.vras.keys():
-                self.vras[(s2,i2,a2)] = ftug.virtual_residue_atoms(cg, s2, i2, a2)
+        # Now check the virtual atoms of these residues for clashes.
+        stem_start = np.searchsorted(stem_idx, np.arange(len(stems)))
+        atom_coords = []
+        atom_vres = []
+        for s in np.unique(stem_idx[candidates]):
+            coords, offsets = _stem_virtual_atoms(cg, stems[s])
+            for k in candidates[stem_idx[candidates] == s]:
+                j = k - stem_start[s]
+                atom_coords.append(coords[offsets[j]:offsets[j+1]])
+                atom_vres.append(np.full(offsets[j+1] - offsets[j], k, dtype=int))
+        atom_coords = np.concatenate(atom_coords)
+        atom_vres = np.concatenate(atom_vres)
+
+        pairs = cKDTree(atom_coords).query_pairs(self.adjustment, output_type='ndarray')
+        va = atom_vres[pairs[:,0]]
+        vb = atom_vres[pairs[:,1]]
+        #Neither connected stems, nor adjacent residues can clash
+        clashing = (~connected[stem_idx[va], stem_idx[vb]] &
+                    (np.abs(resn[va] - resn[vb]) != 1))
+        pairs = pairs[clashing]
+        self._record_clashes(stems, stem_idx[atom_vres[pairs]], atom_coords[pairs])
+        return self.prefactor * len(pairs)
+
+    def _record_clashes(self, stems, stem_pairs, atom_pairs):
+        '''
+        Fill self.bad_bulges and self.bad_atoms.
 
-        energy += self.prefactor * self._virtual_residue_atom_clashes_kd(cg)
-        return energy
+        :param stem_pairs: A Nx2 array of indices into stems, one row per clash.
+        :param atom_pairs: A Nx2x3 array with the coordinates of the clashing atoms.
+        '''
+        seen = set()
+        for (i1, i2), (atom1, atom2) in zip(stem_pairs.tolist(), atom_pairs):
+            s1 = stems[i1]
+            s2 = stems[i2]
+            clash_pair = tuple(sorted([s1, s2]))
+            if clash_pair not in seen:
+                seen.add(clash_pair)
+                self.bad_bulges.append(clash_pair)
+            self.bad_atoms[s1].append(atom1)
+            self.bad_atoms[s2].append(atom2)
+
+    def _update_clash_index(self, cg, stems):
+        '''
+        Return a _ClashIndex for the current structure.
+
+        All data of the current index (self._clash_index) which only
+        depends on stems that did not move is reused.
+        '''
+        old = self._clash_index
+        topology = tuple((s, tuple(cg.defines[s]), tuple(sorted(cg.edges[s]))) for s in stems)
+        geometry = np.hstack((cg.coords[stems].reshape(-1, 6),
+                              cg.twists[stems].reshape(-1, 6)))
+        new = _ClashIndex()
+        new.geometry = geometry
+        if old is None or old.topology != topology:
+            new.topology = topology
+            new.connected = self._stem_connectivity(cg, stems)
+            (new.points, new.point_stem, new.point_vres,
+             new.point_side, new.point_resn) = self._virtual_residue_points(cg, stems)
+            new.stem_start = np.searchsorted(new.point_stem, np.arange(len(stems)))
+            moved = np.ones(len(stems), dtype=bool)
+            old = _ClashIndex.empty(len(new.points))
+        else:
+            for attr in ["topology", "connected", "point_stem", "point_vres",
+                         "point_side", "point_resn", "stem_start"]:
+                setattr(new, attr, getattr(old, attr))
+            moved = np.any(geometry != old.geometry, axis=1)
+            new.points = np.array(old.points)
+            if np.any(moved):
+                new.points[moved[new.point_stem]] = self._virtual_residue_points(
+                                        cg, [s for s, m in zip(stems, moved) if m])[0]
+        self.log.debug("Clash index: %d of %d stems moved", np.count_nonzero(moved), len(stems))
+        moved_points = moved[new.point_stem]
+
+        # Virtual residues of unconnected stems that come close to each other.
+        keep = ~(moved_points[old.near[:,0]] | moved_points[old.near[:,1]])
+        near = _pairs_within(new.points, moved_points, 10.)
+        near = near[~new.connected[new.point_stem[near[:,0]], new.point_stem[near[:,1]]]]
+        new.near = np.concatenate((old.near[keep], near))
+        new.candidates = np.zeros(len(new.points), dtype=bool)
+        new.candidates[new.near.ravel()] = True
+
+        # The virtual atoms of unmoved residues stay valid.
+        new.atom_cache = { k: v for k, v in old.atom_cache.items() if not moved_points[k] }
+        added = new.candidates & (moved_points | ~old.candidates)
+        kept = new.candidates & ~added
+        added_coords = []
+        added_point = []
+        for k in np.flatnonzero(added):
+            if k not in new.atom_cache:
+                s = new.point_stem[k]
+                coords, offsets = _stem_virtual_atoms(cg, stems[s])
+                start = new.stem_start[s]
+                for j in range(len(offsets) - 1):
+                    new.atom_cache[start + j] = coords[offsets[j]:offsets[j+1]]
+            added_coords.append(new.atom_cache[k])
+            added_point.append(np.full(len(new.atom_cache[k]), k, dtype=int))
+        kept_atoms = kept[old.atom_point]
+        new.atom_coords = np.concatenate([old.atom_coords[kept_atoms]] + added_coords)
+        new.atom_point = np.concatenate([old.atom_point[kept_atoms]] + added_point)
+
+        # Clashes between atoms of residues that are still candidates and did not move
+        # stay the same. Only atoms of new candidates have to be checked.
+        keep = kept[old.pair_points[:,0]] & kept[old.pair_points[:,1]]
+        pairs = _pairs_within(new.atom_coords, added[new.atom_point], self.adjustment)
+        pp = new.atom_point[pairs]
+        #Neither connected stems, nor adjacent residues can clash
+        clashing = (~new.connected[new.point_stem[pp[:,0]], new.point_stem[pp[:,1]]] &
+                    (np.abs(new.point_resn[pp[:,0]] - new.point_resn[pp[:,1]]) != 1))
+        new.pair_points = np.concatenate((old.pair_points[keep], pp[clashing]))
+        new.pair_atoms = np.concatenate((old.pair_atoms[keep], new.atom_coords[pairs[clashing]]))
+        return new
+
+    def accept_last_measure(self):
+        """
+        The clash index of the last evaluated structure becomes the one
+        to return to with `reject_last_measure`.
+        """
+        super(StemVirtualResClashEnergy, self).accept_last_measure()
+        self._accepted_clash_index = self._clash_index
+
+    def reject_last_measure(self):
+        """
+        Roll the clash index back to the last accepted structure.
+        """
+        super(StemVirtualResClashEnergy, self).reject_last_measure()
+        if self._accepted_clash_index is not None:
+            self._clash_index = self._accepted_clash_index
+
+#: Virtual atoms of stems in their local coordinate frame, see _stem_virtual_atoms
+_STEM_TEMPLATES = OrderedDict()
+_MAX_STEM_TEMPLATES = 2000
+
+def _stem_virtual_atoms(cg, stem):
+    '''
+    Get the virtual atoms of all residues of a stem.
+
+    The virtual atoms of a stem only depend on its sequence and on its
+    internal geometry (length and twist), which is fixed by the stem's stat.
+    They are calculated with forgi once in the stem's local coordinate frame
+    and afterwards only rotated and translated to the stem's current position.
+
+    :returns: A tuple (coords, offsets). The virtual atoms of the j-th virtual
+              residue are coords[offsets[j]:offsets[j+1]], where the virtual
+              residues are ordered like in StemVirtualResClashEnergy
+              (for each position in the stem first strand 1, then strand 0).
+    '''
+    mids = cg.coords[stem]
+    twists = cg.twists[stem]
+    origin = mids[0]
+    basis = ftuv.create_orthonormal_basis(mids[1] - origin, twists[0])
+    local_geometry = np.dot(basis, np.array([mids[1] - origin, twists[0], twists[1]]).T)
+    key = (tuple(cg.get_define_seq_str(stem)),
+           tuple(np.round(local_geometry, 6).ravel()))
+    try:
+        local_coords, offsets = _STEM_TEMPLATES[key]
+    except KeyError:
+        coords = []
+        offsets = [0]
+        for i in range(cg.stem_length(stem)):
+            for a in (1, 0):
+                atoms = list(ftug.virtual_residue_atoms(cg, stem, i, a).values())
+                coords.extend(atoms)
+                offsets.append(offsets[-1] + len(atoms))
+        local_coords = np.dot(np.array(coords) - origin, basis.T)
+        offsets = np.array(offsets)
+        _STEM_TEMPLATES[key] = (local_coords, offsets)
+        if len(_STEM_TEMPLATES) > _MAX_STEM_TEMPLATES:
+            _STEM_TEMPLATES.popitem(last=False)
+    return np.dot(local_coords, basis) + origin, offsets
+
+def _pairs_within(coords, changed, radius):
+    '''
+    Find all pairs of points closer than radius, where
+    at least one of the two points is changed.
+
+    :param coords: A Nx3 array
+    :param changed: A boolean array of length N
+    :returns: A Mx2 array of indices into coords.
+    '''
+    changed_idx = np.flatnonzero(changed)
+    if len(changed_idx) == len(coords):
+        return cKDTree(coords).query_pairs(radius, output_type='ndarray')
+    if len(changed_idx) == 0:
+        return np.zeros((0, 2), dtype=int)
+    changed_tree = cKDTree(coords[changed_idx])
+    pairs = [changed_idx[changed_tree.query_pairs(radius, output_type='ndarray')]]
+    rest_idx = np.flatnonzero(~changed)
+    close = changed_tree.sparse_distance_matrix(cKDTree(coords[rest_idx]), radius,
+                                                output_type='ndarray')
+    pairs.append(np.column_stack((changed_idx[close['i']], rest_idx[close['j']])))
+    return np.concatenate(pairs).reshape(-1, 2)
+
+class _ClashIndex(object):
+    '''
+    The virtual residues, virtual atoms and clashes of one structure,
+    as used for the incremental evaluation of StemVirtualResClashEnergy.
+
+    An index is not modified once it is complete. Updating it for
+    a new structure creates a new _ClashIndex sharing the unchanged data.
+    '''
+    @classmethod
+    def empty(cls, num_points):
+        index = cls()
+        index.near = np.zeros((0, 2), dtype=int)
+        index.candidates = np.zeros(num_points, dtype=bool)
+        index.atom_cache = {}
+        index.atom_coords = np.zeros((0, 3))
+        index.atom_point = np.zeros(0, dtype=int)
+        index.pair_points = np.zeros((0, 2), dtype=int)
+        index.pair_atoms = np.zeros((0, 2, 3))
+        return index
 
 class RoughJunctionClosureEnergy(EnergyFunction):
     _shortname = "JDIST"
@@ -710,6 +902,7 @@ class RoughJunctionClosureEnergy(EnergyFunction):
     IS_CONSTRAINT_ONLY = True
     can_constrain = "junction"
     HELPTEXT = "Junction constraint energy"
+    non_negative = True
     @classmethod
     def from_cg(cls, prefactor, adjustment, cg, **kwargs):
         return cls(prefactor, adjustment)
@@ -774,6 +967,9 @@ class MaxEnergyValue(EnergyFunction):
             self.bad_bulges = []
             return 0.
 
+    def lower_bound(self):
+        return 0.
+
     def precheck(self, cg, elems, elem_defs):
         c = self._other_energy.precheck(cg, elems, elem_defs)
         if c>=self.adjustment:
@@ -800,6 +996,7 @@ class FragmentBasedJunctionClosureEnergy(EnergyFunction):
     _shortname = "FJC"
     can_constrain = "junction"
     HELPTEXT = ("A Fragment based energy")
+    non_negative = True
     _always_search=False
     @classmethod
     def from_cg(cls, prefactor, adjustment, cg, stat_source, **kwargs):
@@ -816,6 +1013,8 @@ class FragmentBasedJunctionClosureEnergy(EnergyFunction):
                     energies.append(cls(ml, stat_source, prefactor=prefactor, adjustment=adjustment))
         return CombinedEnergy(energies)
 
+    _eval_attributes = EnergyFunction._eval_attributes + ("used_stat",)
+
     def __init__(self, element, stat_source, angular_weight=math.degrees(1)/4, prefactor = None, adjustment = None):
         self.element = element
         self.stat_source = stat_source
@@ -857,6 +1056,9 @@ class FragmentBasedJunctionClosureEnergy(EnergyFunction):
         return 0
 
 
+    def depends_on(self, cg):
+        return set([self.element]) | set(cg.edges[self.element])
+
     @profile
     def eval_energy(self, cg, background=True, nodes=None,  sampled_stats=None, **kwargs):
         self.bad_bulges = []
@@ -1012,26 +1214,8 @@ class RadiusOfGyrationEnergy(CoarseGrainEnergy):
         return cg.radius_of_gyration("fast")
 
     def _get_values_from_file(self, filename, length):
-        data = pd.read_csv(load_local_data(filename), delimiter=' ', comment="#", names=["pdb_id","nt_length","rog"])
-
-        rdata = []
-
-        distribution_upper_bound = 1.0
-        distribution_lower_bound = 1.0
-        target_len=500
-        target_len=min(target_len,len(data[:]))
-        while (len(rdata) < 500 and len(rdata)<len(data)):
-            distribution_lower_bound -= INCR
-            distribution_upper_bound += INCR
-
-            mask_upper = data.iloc[:,1] < length * ( distribution_upper_bound )
-            mask_lower = data.iloc[:,1] > ( distribution_lower_bound ) * length
-            rdata = data.loc[ mask_upper & mask_lower ]
-
-        rogs = rdata.iloc[:,2]
-        rogs=np.array(rogs)
-
-        return rogs
+        data = load_reference_data(filename, delimiter=' ', comment="#", names=["pdb_id","nt_length","rog"])
+        return self._values_within_nt_range(data, length, "rog")
 
 class NormalDistributedRogEnergy(RadiusOfGyrationEnergy):
     _shortname = "NDR"
@@ -1071,7 +1255,10 @@ class NormalDistributedRogEnergy(RadiusOfGyrationEnergy):
         super(NormalDistributedRogEnergy, self).__init__(rna_length, adjustment, prefactor)
 
     def _set_target_distribution(self):
-        self.target_distribution = lambda x: np.array([scipy.stats.norm(loc=0.77*self.adjustment, scale=0.23*self.adjustment).pdf(x)])
+        loc = 0.77*self.adjustment
+        scale = 0.23*self.adjustment
+        xs = np.linspace(loc-8*scale, loc+8*scale, 2000)
+        self.target_distribution = TabulatedDistribution(xs, scipy.stats.norm.logpdf(xs, loc, scale))
 
 class AMinorEnergy(InteractionEnergy):
     _shortname = "AME"
@@ -1109,7 +1296,8 @@ class AMinorEnergy(InteractionEnergy):
         super(AMinorEnergy, self).__init__(num_stems, num_loops, prefactor, adjustment)
 
     def reset_distributions(self, num_stems):
-        data = pd.read_csv(self.sampled_stats_fn, comment="#", sep=",", skipinitialspace=True)
+        data = load_reference_data(self.sampled_stats_fn, "stems", comment="#", sep=",",
+                                   skipinitialspace=True).data
         loop_data=data[data["typ"]==self.loop_type]
         max_stems=max(loop_data["stems"])
         stems=min(max_stems, num_stems)
@@ -1167,6 +1355,28 @@ class PerLoopAMinor(AMinorEnergy):
                                 1, prefactor=prefactor, adjustment=adjustment))
         return CombinedEnergy(energies)
 
+    def depends_on(self, cg):
+        # The interaction of a loop is classified against all stems.
+        return set([self.loop_type]) | set(cg.stem_iterator())
+
+def _count_hloops_closer_than(cg, loops, cutoff):
+    """
+    Used by UnspecificInteractionEnergy and LoopLoopInteractionEnergy.
+
+    :param loops: A list of hairpin loop names.
+    :returns: The number of loops in loops, which are closer than cutoff
+              to any other loop in loops.
+    """
+    if len(loops)<2:
+        return 0
+    hloops = list(cg.hloop_iterator())
+    distances = GeometryCache.for_cg(cg).segment_distances(hloops)
+    indices = [hloops.index(loop) for loop in loops]
+    distances = np.array(distances[np.ix_(indices, indices)])
+    np.fill_diagonal(distances, float("inf"))
+    return int(np.sum(np.min(distances, axis=1) < cutoff))
+
+
 class UnspecificInteractionEnergy(InteractionEnergy):
     _shortname="UIE"
     HELPTEXT="Unspecific interaction energy on the level of virtual residues."
@@ -1190,16 +1400,8 @@ class UnspecificInteractionEnergy(InteractionEnergy):
 
 
     def _get_cg_measure(self, cg):
-        interactions = 0
-        for loop1 in self.qualifying_loops(cg, cg.hloop_iterator()):
-            a,b = cg.coords[loop1]
-            for loop2 in self.qualifying_loops(cg, cg.hloop_iterator()):
-                if loop1 == loop2:
-                    continue
-                c,d = cg.coords[loop2]
-                if ftuv.elements_closer_than(a,b,c,d, self.cutoff):
-                    interactions+=1
-                    break
+        loops = list(self.qualifying_loops(cg, cg.hloop_iterator()))
+        interactions = _count_hloops_closer_than(cg, loops, self.cutoff)
         return interactions/self.num_loops
 
 class LoopLoopInteractionEnergy(InteractionEnergy):
@@ -1225,16 +1427,8 @@ class LoopLoopInteractionEnergy(InteractionEnergy):
 
 
     def _get_cg_measure(self, cg):
-        interactions = 0
-        for loop1 in self.qualifying_loops(cg, cg.hloop_iterator()):
-            a,b = cg.coords[loop1]
-            for loop2 in self.qualifying_loops(cg, cg.hloop_iterator()):
-                if loop1 == loop2:
-                    continue
-                c,d = cg.coords[loop2]
-                if ftuv.elements_closer_than(a,b,c,d, self.cutoff):
-                    interactions+=1
-                    break
+        loops = list(self.qualifying_loops(cg, cg.hloop_iterator()))
+        interactions = _count_hloops_closer_than(cg, loops, self.cutoff)
         return interactions/self.num_loops
 
     def reset_distributions(self, rna_length):
@@ -1364,21 +1558,45 @@ class _PDD_Mixin(object):
             out[:len(array)]=array
         return out
 
+    @staticmethod
+    def _stem_atoms_by_residue(cg):
+        '''
+        A dict {residue number: array of virtual atom coordinates}
+        for all residues in stems, using the stem templates.
+        '''
+        stem_atoms = {}
+        for stem in cg.stem_iterator():
+            coords, offsets = _stem_virtual_atoms(cg, stem)
+            define = cg.defines[stem]
+            for i in range(cg.stem_length(stem)):
+                # See _stem_virtual_atoms for the order of the virtual residues.
+                for j, resn in ((2*i, define[3] - i), (2*i + 1, define[0] + i)):
+                    stem_atoms[resn] = coords[offsets[j]:offsets[j+1]]
+        return stem_atoms
+
     @classmethod
     def get_pdd(cls, cg, level, stepsize, only_seqids=None):
         use_asserts = ftuv.USE_ASSERTS
         ftuv.USE_ASSERTS = False
         try:
+            if level=="R" and only_seqids is None:
+                return ftuv.pair_distance_distribution(GeometryCache.for_cg(cg).virtual_residues,
+                                                       stepsize)
             points=[]
+            if level=="A":
+                stem_atoms = cls._stem_atoms_by_residue(cg)
             for i in range(1,len(cg.seq)+1):
                 if only_seqids is not None and cg.seq.to_resid(i) not in only_seqids:
                     continue
                 if level=="R":
                     points.append(cg.get_virtual_residue(i, allow_single_stranded=True))
                 elif level=="A":
-                    va_dict = cg.virtual_atoms(i)
-                    for k,v in va_dict.items():
-                        points.append(v)
+                    if i in stem_atoms:
+                        points.extend(stem_atoms[i])
+                    else:
+                        va_dict = cg.virtual_atoms(i)
+                        for k,v in va_dict.items():
+                            points.append(v)
                 elif level=="T":
                     for point in cg.iter_three_points(i):
                         points.append(point)
@@ -1431,6 +1649,7 @@ class _PDD_Mixin(object):
 class PDDEnergy(_PDD_Mixin, EnergyFunction):
     _shortname = "PDD"
     HELPTEXT = "Pair distance distribution energy for fitting SAXS data."
+    non_negative = True
 
     def __init__(self, length, target_pdd, prefactor, adjustment, level="R", stepwidth=None):
         """
@@ -1488,6 +1707,8 @@ class PDDEnergy(_PDD_Mixin, EnergyFunction):
 class LastNPDDsEnergy(PDDEnergy):
     _shortname = "LNP"
     N=100
+    # The energy depends on the last N accepted measures
+    cacheable = False
     def eval_energy(self, cg, background=True, nodes=None, use_accepted_measure=False,
                     plot_debug=False, **kwargs):
         if plot_debug or nodes is not None:
@@ -1706,17 +1927,13 @@ def _minimal_h_h_distance(cg, elem1, elem2_iterator):
     :param elem1: A STRING. A name of a hairpin loop. e.g. "h1"
     :param elem2_iterator: An ITERATOR/ LIST. Element names to compare elem1 with.
     """
-    min_dist = float("inf")
-    for elem2 in elem2_iterator:
-        if elem2==elem1: continue
-        (i1,i2) = ftuv.line_segment_distance(cg.coords[elem1][0],
-                                            cg.coords[elem1][1],
-                                            cg.coords[elem2][0],
-                                            cg.coords[elem2][1])
-        dist = ftuv.vec_distance(i1, i2)
-        if dist < min_dist:
-            min_dist = dist
-    return min_dist
+    others = [elem2 for elem2 in elem2_iterator if elem2!=elem1]
+    if not others:
+        return float("inf")
+    segments = cg.coords[others].reshape(-1, 2, 3)
+    distances = segment_distances(cg.coords[elem1][:1], cg.coords[elem1][1:],
+                                  segments[:,0], segments[:,1])
+    return np.min(distances)
 
 
 class ShortestLoopDistancePerLoop(CoarseGrainEnergy):
@@ -1816,9 +2033,8 @@ class ShortestLoopDistancePerLoop(CoarseGrainEnergy):
         return sn.replace(self._shortname, "{}({})".format(self._shortname,self.loop_name))
 
     def _get_values_from_file(self, filename, length):
-        data = pd.read_csv(load_local_data(filename), delimiter=' ', comment="#", names=["pdb_id","nt_length","dist"])
-        data = self._values_within_nt_range(data, length, "dist", "nt_length" )
-        return data
+        data = load_reference_data(filename, delimiter=' ', comment="#", names=["pdb_id","nt_length","dist"])
+        return self._values_within_nt_range(data, length, "dist")
 
     def _get_distribution_from_values(self, values):
         f = super(ShortestLoopDistancePerLoop, self)._get_distribution_from_values(values)
@@ -1826,19 +2042,30 @@ class ShortestLoopDistancePerLoop(CoarseGrainEnergy):
         def kde_with_uniform(measure):
             x1 = f(measure)
             assert self._lsp_max>self._lsp_min
-            if np.all(measure<self._lsp_max) and np.all(measure>self._lsp_min):
-                x2=1/(self._lsp_max-self._lsp_min)
-            else:
-                x2=0
+            # Vectorized, so the target distribution can be tabulated
+            x2 = np.where((np.asarray(measure)<self._lsp_max) & (np.asarray(measure)>self._lsp_min),
+                          1/(self._lsp_max-self._lsp_min), 0)
             self.log.debug("Mixed distr: x1 = %s, x2 = %s", x1, x2)
             return (1-self._lsp_weight)*x1+self._lsp_weight*x2
         return kde_with_uniform
 
     def _get_cg_measure(self, cg):
-        min_dist = _minimal_h_h_distance(cg, self.loop_name,
-                                        [hloop for hloop in cg.hloop_iterator()
-                                         if hloop not in cg.interacting_elements ])
-        return min_dist
+        # All SLD energies share the distance matrix of all hairpins.
+        hloops = list(cg.hloop_iterator())
+        distances = GeometryCache.for_cg(cg).segment_distances(hloops)
+        i = hloops.index(self.loop_name)
+        others = [j for j, hloop in enumerate(hloops)
+                  if hloop not in cg.interacting_elements and j != i]
+        if not others:
+            return float("inf")
+        return np.min(distances[i, others])
+
+    def depends_on(self, cg):
+        hloops = set(hloop for hloop in cg.hloop_iterator()
+                     if hloop not in cg.interacting_elements)
+        hloops.add(self.loop_name)
+        return hloops
+
     def eval_energy(self, cg, background=True, nodes=None, **kwargs):
         '''
         We want to return an energy of 0. if there's less than two hairpin
@@ -1887,6 +2114,14 @@ class CombinedEnergy(object):
             super(CombinedEnergy, self).__setattr__("energies", [])
         super(CombinedEnergy, self).__setattr__("constituing_energies", [])
         super(CombinedEnergy, self).__setattr__("normalize", normalize)
+        #: The cg and the cached contributions for the last accepted structure.
+        #: A dictionary {id(energy): (cache_key, contribution, eval_attributes)}
+        super(CombinedEnergy, self).__setattr__("_accepted_cg", None)
+        super(CombinedEnergy, self).__setattr__("_accepted_cache", {})
+        #: A tuple (cg, cache) for the last energy evaluation
+        super(CombinedEnergy, self).__setattr__("_last_eval", None)
+        #: The average evaluation time of the member energies {id(energy): seconds}
+        super(CombinedEnergy, self).__setattr__("_eval_costs", {})
 
     def __setattr__(self, name, val):
         if name not in self.__dict__:
@@ -1896,6 +2131,10 @@ class CombinedEnergy(object):
             self.__dict__[name]=val
 
     def __getattr__(self, name):
+        # Special attributes (e.g. __setstate__ looked up by copy and pickle)
+        # are never delegated. Note that self.energies does not exist yet during unpickling.
+        if name.startswith("__") or "energies" not in self.__dict__:
+            raise AttributeError(name)
         #If no energies are present, do nothing (DON'T raise an error)
         if not self.energies:
             log.info("Combined Energy has no energies and returns CombinedFunction for attr %s", name)
@@ -1989,20 +2228,189 @@ class CombinedEnergy(object):
                 log.debug("%s doesn't have bad bulges")
         log.debug("Returning bad bulges %s", bad_bulges)
         return bad_bulges
-    def eval_energy(self, cg, background=True, nodes=None, verbose=False,
-                    use_accepted_measure=False, plot_debug=False, **kwargs):
-        total_energy = 0.
-        self.constituing_energies=[]
-        num_contribs=0
+    def state_key(self):
+        """
+        A tuple of the state keys of all member energies.
+
+        :returns: The state key or None, if any of the energies cannot be cached.
+        """
+        keys = []
+        for e in self.iterate_energies():
+            key = e.state_key()
+            if key is None:
+                return None
+            keys.append((id(e), key))
+        return tuple(keys)
+
+    def accept_last_measure(self):
+        """
+        Call accept_last_measure of all member energies and
+        keep the contributions of the last evaluated structure cached.
+        """
+        if self._last_eval is not None:
+            self._accepted_cg, self._accepted_cache = self._last_eval
+            self._last_eval = None
+        else:
+            self._accepted_cg = None
+            self._accepted_cache = {}
+        for e in self.energies:
+            e.accept_last_measure()
+
+    def reject_last_measure(self):
+        """
+        Call reject_last_measure of all member energies.
+        """
+        self._last_eval = None
+        for e in self.energies:
+            e.reject_last_measure()
+
+    def clear_cache(self):
+        """
+        Forget the cached contributions of the last accepted structure.
+
+        Has to be called, if a structure is accepted without evaluating its energy.
+        """
+        self._accepted_cg = None
+        self._accepted_cache = {}
+        self._last_eval = None
+        for e in self.energies:
+            if isinstance(e, CombinedEnergy):
+                e.clear_cache()
 
-        for energy in self.energies:
-            contrib = energy.eval_energy(cg, background=background, nodes=nodes,
-                                         use_accepted_measure=use_accepted_measure,
-                                         plot_debug = plot_debug, **kwargs)
+    def _cache_key(self, energy, background):
+        state_key = energy.state_key()
+        if state_key is None:
+            return None
+        return (state_key, background)
 
+    def _cached_contribution(self, energy, cg, cache_key, changed):
+        """
+        :returns: The contribution of energy for the last accepted structure
+                  or None, if it has to be re-evaluated.
+        """
+        try:
+            key, contrib, attributes = self._accepted_cache[id(energy)]
+        except KeyError:
+            return None
+        if cache_key is None or key != cache_key:
+            return None
+        dependencies = energy.depends_on(cg)
+        if dependencies is None or not changed.isdisjoint(dependencies):
+            return None
+        for attr, val in attributes.items():
+            setattr(energy, attr, val)
+        return contrib
+
+    def lower_bound(self):
+        """
+        The sum of the lower bounds of all member energies.
+        """
+        bound = sum(e.lower_bound() for e in self.energies)
+        if self.normalize and self.energies:
+            bound = bound/len(self.energies)
+        return bound
+
+    def _evaluation_order(self, indices):
+        """
+        Sort the indices of member energies for evaluation with a threshold.
+
+        Energies without a lower bound have to be evaluated before the evaluation
+        can be stopped, so they come first. Otherwise, cheaper energies come first.
+        """
+        return sorted(indices, key=lambda i: (self.energies[i].lower_bound() > -float("inf"),
+                                              self._eval_costs.get(id(self.energies[i]), 0.)))
+
+    def eval_energy(self, cg, background=True, nodes=None, verbose=False,
+                    use_accepted_measure=False, plot_debug=False, changed=None,
+                    threshold=None, **kwargs):
+        """
+        :param changed: A collection of coarse grained elements, whose coordinates
+                        or stats changed since the last accepted structure, or None.
+                        Member energies which do not depend on any of these elements
+                        (see EnergyFunction.depends_on) are not re-evaluated.
+                        Their contribution for the accepted structure is used instead.
+        :param threshold: None or a float. If given, the member energies are evaluated
+                        in the order of their measured cost and the evaluation stops,
+                        as soon as the lower bounds of the remaining energies
+                        (see EnergyFunction.lower_bound) prove that the total energy
+                        is above the threshold. In this case, a lower bound
+                        for the energy (which is above the threshold) is returned.
+        """
+        cacheable = nodes is None and not use_accepted_measure and not plot_debug
+        use_cache = cacheable and changed is not None and cg is self._accepted_cg
+        if use_cache:
+            changed = set(changed)
+        cache = {}
+        contribs = {}
+
+        to_evaluate = []
+        for i, energy in enumerate(self.energies):
+            if use_cache and not isinstance(energy, CombinedEnergy):
+                cache_key = self._cache_key(energy, background)
+                contrib = self._cached_contribution(energy, cg, cache_key, changed)
+                if contrib is not None:
+                    log.debug("Using cached contribution %s of %s", contrib, energy.shortname)
+                    cache[id(energy)] = self._accepted_cache[id(energy)]
+                    contribs[i] = contrib
+                    continue
+            to_evaluate.append(i)
+
+        if threshold is not None:
+            if self.normalize and self.energies:
+                threshold = threshold*len(self.energies)
+            to_evaluate = self._evaluation_order(to_evaluate)
+            bounds = { i: self.energies[i].lower_bound() for i in to_evaluate }
+            unbounded = sum(1 for b in bounds.values() if b == -float("inf"))
+            remaining_bound = sum(b for b in bounds.values() if b > -float("inf"))
+
+        early_stop = False
+        for i in to_evaluate:
+            energy = self.energies[i]
+            sub_threshold = None
+            if threshold is not None:
+                partial = sum(contribs.values())
+                if unbounded == 0 and partial + remaining_bound > threshold:
+                    log.debug("Stopping energy evaluation early: %s + %s > %s",
+                              partial, remaining_bound, threshold)
+                    early_stop = True
+                    break
+                if bounds[i] == -float("inf"):
+                    unbounded -= 1
+                else:
+                    remaining_bound -= bounds[i]
+                if unbounded == 0:
+                    sub_threshold = threshold - partial - remaining_bound
+            start_time = time.time()
+            if isinstance(energy, CombinedEnergy):
+                contrib = energy.eval_energy(cg, background=background, nodes=nodes,
+                                             use_accepted_measure=use_accepted_measure,
+                                             plot_debug = plot_debug, changed=changed,
+                                             threshold = sub_threshold, **kwargs)
+            else:
+                contrib = energy.eval_energy(cg, background=background, nodes=nodes,
+                                             use_accepted_measure=use_accepted_measure,
+                                             plot_debug = plot_debug, **kwargs)
+                cache_key = self._cache_key(energy, background)
+                if cache_key is not None:
+                    cache[id(energy)] = (cache_key, contrib,
+                                         { attr: getattr(energy, attr)
+                                           for attr in energy._eval_attributes
+                                           if hasattr(energy, attr) })
+            cost = time.time()-start_time
+            # An exponential moving average of the evaluation time.
+            self._eval_costs[id(energy)] = 0.9*self._eval_costs.get(id(energy), cost)+0.1*cost
             if not np.isscalar(contrib):
                 raise TypeError
                 contrib, = contrib
+            contribs[i] = contrib
+
+        total_energy = 0.
+        self.constituing_energies=[]
+        num_contribs=0
+        for i, energy in enumerate(self.energies):
+            if i not in contribs:
+                continue
+            contrib = contribs[i]
             self.constituing_energies.append((energy.shortname, contrib))
             total_energy += contrib
             num_contribs +=1
@@ -2013,6 +2421,11 @@ class CombinedEnergy(object):
                     print("bad_bulges:", energy.bad_bulges)
             log.debug("Combined energy instance at {}: {} ({}) contributing {}".format(id(self), energy.__class__.__name__, energy.shortname, contrib))
 
+        if early_stop:
+            # The remaining energies were not evaluated, so this is only a lower bound.
+            total_energy += remaining_bound
+            num_contribs = len(self.energies)
+            cacheable = False
 
         if num_contribs>0:
             if self.normalize:
@@ -2020,6 +2433,11 @@ class CombinedEnergy(object):
         else:
             assert self.energies == []
 
+        if cacheable:
+            self._last_eval = (cg, cache)
+        else:
+            self._last_eval = None
+
         if verbose:
             print ("--------------------------")
             print ("total_energy:", total_energy)
@@ -2083,6 +2501,11 @@ def update_parser(parser):
                                      "distribution from the SAX experiment.")
     energy_options.add_argument('--pdd-stepsize', type=float,
                                 help="If given, rescale the PDD to this stepsize.")
+    energy_options.add_argument('--binned-reference', action="store_true",
+                                help="Store the reference distributions of energies\n"
+                                     "with a background (e.g. ROG, SLD) as histograms\n"
+                                     "instead of KDEs of all accepted measures.\n"
+                                     "Recommended for long simulations.")
 
 def from_args(args, cg, stat_source, replica=None, reference_cg=None):
     energy_string = replica_substring(args.energy, replica)
@@ -2092,4 +2515,9 @@ def from_args(args, cg, stat_source, replica=None, reference_cg=None):
                                           pdd_target=args.pdd_file,
                                           pdd_stepsize=args.pdd_stepsize,
                                           reference_cg=reference_cg)
-    return CombinedEnergy(energies)
+    energy = CombinedEnergy(energies)
+    if args.binned_reference:
+        for e in energy.iterate_energies():
+            if isinstance(e, CoarseGrainEnergy):
+                e.use_binned_reference()
+    return energy
@@ -7,6 +7,7 @@ from future.utils import with_metaclass
 from abc import ABCMeta, abstractmethod, abstractproperty
 import numpy as np
 import scipy.stats
+import scipy.signal
 import warnings
 import logging
 import itertools as it
@@ -35,6 +36,22 @@ class EnergyFunction(with_metaclass(ABCMeta, object)):
     '''
     __metaclass__ = ABCMeta
 
+    #: Set this to False in subclasses, if the energy for the same structure may
+    #: change without a call to `self._state_changed`. (E.g. if it is random)
+    cacheable = True
+
+    #: Incremented every time the energy for an unchanged structure may change.
+    #: (E.g. when the reference distribution is resampled.)
+    state_version = 0
+
+    #: Set this to True in subclasses, if eval_energy never returns a
+    #: negative value for a non-negative prefactor.
+    non_negative = False
+
+    #: Attributes set by eval_energy. They are restored by CombinedEnergy,
+    #: if a cached contribution is used instead of calling eval_energy.
+    _eval_attributes = ("_last_measure", "bad_bulges")
+
     @classmethod
     def from_cg(cls, prefactor, adjustment, cg, **kwargs):
         """
@@ -196,9 +213,54 @@ class EnergyFunction(with_metaclass(ABCMeta, object)):
             self._update_adj()
     def _update_pf(self):
         self.prefactor += self._pf_stepwidth
+        self._state_changed()
     def _update_adj(self):
         log.debug("Updating adjustment from %s to %s", self.adjustment, self.adjustment+self._adj_stepwidth)
         self.adjustment += self._adj_stepwidth
+        self._state_changed()
+
+    def _state_changed(self):
+        """
+        Has to be called whenever the energy of an unchanged structure may change,
+        to invalidate cached energy values.
+        """
+        self.state_version += 1
+
+    def state_key(self):
+        """
+        A hashable value that changes whenever the energy of an
+        unchanged structure may change.
+
+        :returns: The state key or None, if the energy cannot be cached.
+        """
+        if not self.cacheable:
+            return None
+        return self.state_version
+
+    def lower_bound(self):
+        """
+        A lower bound for the value returned by eval_energy.
+
+        Used by CombinedEnergy to stop the evaluation early,
+        if the energy is known to exceed a threshold.
+        """
+        if self.non_negative and self.prefactor >= 0:
+            return 0.
+        return -float("inf")
+
+    def depends_on(self, cg):
+        """
+        The coarse grained elements whose coordinates (or sampled stats)
+        determine the value of this energy.
+
+        If none of these elements changed since the last accepted structure,
+        CombinedEnergy uses the cached value instead of calling eval_energy.
+
+        :param cg: The CoarseGrainRNA
+        :returns: A set of element names or None, if the energy depends
+                  on the whole structure.
+        """
+        return None
 
     def __bool__(self):
         """
@@ -292,6 +354,274 @@ class InteractionEnergy(EnergyFunction):
 
     def _resample_background_kde(self):
         self.reference_interactions = self.accepted_measures[:]
+        self._state_changed()
+
+
+class BinnedDistribution(object):
+    """
+    A probability distribution of scalar measures, stored as a weighted histogram.
+
+    Adding a measure is O(1) and evaluating the density is an interpolation
+    between bin centers, independent of the number of measures added so far.
+
+    The density is a gaussian KDE of the histogram with Scott's bandwidth
+    (like `scipy.stats.gaussian_kde`). It is only updated by `smooth`.
+    """
+    #: The width of a bin, as a fraction of the bandwidth of the initial values.
+    #: The bin width never changes, so adding values never requires rebinning.
+    bins_per_bandwidth = 8
+    #: The smoothed density extends this many bandwidths beyond the histogram.
+    #: Further out, only the outermost occupied bins contribute (as a gaussian tail).
+    padding = 4.
+
+    def __init__(self, values, bins_per_bandwidth=None):
+        """
+        :param values: A sequence of at least 2 scalar values.
+        :param bins_per_bandwidth: Overrides the class-level variable of the same name.
+        """
+        values = np.asarray(values, dtype=float)
+        if values.ndim != 1 or len(values) < 2:
+            raise ValueError("A BinnedDistribution needs at least 2 scalar values, "
+                             "got an array of shape {}".format(values.shape))
+        if bins_per_bandwidth is not None:
+            self.bins_per_bandwidth = bins_per_bandwidth
+        bandwidth = self._scott_bandwidth(len(values), np.std(values, ddof=1))
+        if bandwidth == 0:
+            bandwidth = max(abs(values[0]), 1.) * 10**-3
+        self.bin_width = bandwidth / self.bins_per_bandwidth
+        #: The left edge of the first bin
+        self.origin = values.min() - self.bin_width
+        self.counts = np.zeros(2)
+        #: Total weight, mean and sum of squared deviations (Welford's algorithm)
+        self.n = 0
+        self._mean = 0.
+        self._m2 = 0.
+        self._grow(values.max())
+        index, fraction = self._bin_position(values)
+        np.add.at(self.counts, index, 1 - fraction)
+        np.add.at(self.counts, index + 1, fraction)
+        for value in values:
+            self._update_moments(value, 1)
+        self.smooth()
+
+    @staticmethod
+    def _scott_bandwidth(n, std):
+        return std * n**(-1. / 5)
+
+    def _bin_position(self, value):
+        """
+        The index of the bin center left of value and the fractional
+        distance of value from this bin center.
+
+        Values are distributed linearly between the two neighboring
+        bins (linear binning), which is more accurate than counting them
+        in the bin they fall into.
+        """
+        position = (np.asarray(value) - self.origin) / self.bin_width - 0.5
+        index = np.floor(position).astype(int)
+        return index, position - index
+
+    def _grow(self, value):
+        """
+        Make sure the histogram has both bins for value.
+
+        The histogram grows at least by its current size, so the cost of
+        growing is O(1) amortized over all added values.
+        """
+        i, _ = self._bin_position(value)
+        if i < 0:
+            num_new = max(-i, len(self.counts))
+            self.counts = np.concatenate([np.zeros(num_new), self.counts])
+            self.origin -= num_new * self.bin_width
+        elif i + 1 >= len(self.counts):
+            num_new = max(i + 2 - len(self.counts), len(self.counts))
+            self.counts = np.concatenate([self.counts, np.zeros(num_new)])
+
+    def _update_moments(self, value, count):
+        self.n += count
+        delta = value - self._mean
+        self._mean += delta * count / self.n
+        self._m2 += count * delta * (value - self._mean)
+
+    def add(self, value, count=1):
+        """
+        Add a value with the given weight (number of repetitions).
+
+        The density does not change before the next call to `smooth`.
+        """
+        value = float(value)
+        self._grow(value)
+        index, fraction = self._bin_position(value)
+        self.counts[index] += count * (1 - fraction)
+        self.counts[index + 1] += count * fraction
+        self._update_moments(value, count)
+
+    @property
+    def bandwidth(self):
+        """
+        The bandwidth of the gaussian kernel according to Scott's rule.
+        """
+        variance = max(self._m2 / (self.n - 1), 0)
+        bandwidth = self._scott_bandwidth(self.n, math.sqrt(variance))
+        return max(bandwidth, self.bin_width / self.bins_per_bandwidth)
+
+    def smooth(self):
+        """
+        Recalculate the density from the current histogram,
+        using a FFT convolution with a gaussian kernel.
+        """
+        bandwidth = self.bandwidth
+        sigma = bandwidth / self.bin_width
+        half_width = int(math.ceil(self.padding * sigma))
+        kernel = np.exp(-0.5 * (np.arange(-half_width, half_width + 1) / sigma)**2)
+        kernel /= np.sum(kernel)
+        density = scipy.signal.fftconvolve(self.counts, kernel)
+        # Remove the rounding noise of the FFT. The gaussian tails are used instead.
+        density[density < 10**-12 * np.max(density)] = 0
+        self._density = density / (self.n * self.bin_width)
+        self._centers = self.origin + (np.arange(len(density)) - half_width + 0.5) * self.bin_width
+        self._bandwidth = bandwidth
+        occupied = np.flatnonzero(self.counts)
+        self._tails = []
+        for i in (occupied[0], occupied[-1]):
+            self._tails.append((self.origin + (i + 0.5) * self.bin_width, self.counts[i] / self.n))
+
+    def __call__(self, x):
+        """
+        The density at x.
+
+        :param x: A scalar or array
+        :returns: An array with at least 1 dimension.
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        density = np.interp(x, self._centers, self._density, left=0, right=0)
+        (left_center, left_weight), (right_center, right_weight) = self._tails
+        for outside, center, weight in [(x < left_center, left_center, left_weight),
+                                        (x > right_center, right_center, right_weight)]:
+            if np.any(outside):
+                # Where the interpolated density underflows, the outermost bin dominates.
+                tail = weight * scipy.stats.norm.pdf(x[outside], center, self._bandwidth)
+                density[outside] = np.maximum(density[outside], tail)
+        return density
+
+
+class TabulatedDistribution(object):
+    """
+    A probability distribution, tabulated as log-density on a grid.
+
+    The log-density is linearly interpolated between grid points, so evaluating
+    it does not depend on the number of values the distribution was fitted to.
+    Outside of the grid, the log-density decreases linearly with the slope
+    at the edge of the grid (but at least `min_tail_slope`).
+    Thus the density never underflows to 0 and energies stay finite, even for
+    measures far away from all values the distribution was fitted to.
+    """
+    def __init__(self, xs, log_density, min_tail_slope=None):
+        """
+        :param xs: The grid points in increasing order (at least 2)
+        :param log_density: The log-density at the grid points.
+                            Grid points at the edges with a density of 0
+                            are dropped, so the tails start at a positive density.
+                            Inside, the smallest finite value is used instead of -inf.
+        :param min_tail_slope: The log-density decreases at least this fast outside
+                               of the grid. Defaults to 1 per length of the grid.
+        """
+        xs = np.asarray(xs, dtype=float)
+        log_density = np.asarray(log_density, dtype=float)
+        finite = np.flatnonzero(np.isfinite(log_density))
+        if len(finite) < 2:
+            raise ValueError("A TabulatedDistribution needs at least 2 grid points "
+                             "with a finite log-density.")
+        xs = xs[finite[0]:finite[-1] + 1]
+        log_density = log_density[finite[0]:finite[-1] + 1]
+        finite = np.isfinite(log_density)
+        self._log_density = np.where(finite, log_density, np.min(log_density[finite]))
+        self._xs = xs
+        if min_tail_slope is None:
+            min_tail_slope = 1. / (xs[-1] - xs[0])
+        self._left_slope = max((self._log_density[1] - self._log_density[0]) / (xs[1] - xs[0]),
+                               min_tail_slope)
+        self._right_slope = min((self._log_density[-1] - self._log_density[-2]) / (xs[-1] - xs[-2]),
+                                -min_tail_slope)
+
+    @classmethod
+    def from_function(cls, distribution, lower, upper, num_points=2000):
+        """
+        Tabulate a probability density function between lower and upper.
+
+        :param distribution: A callable, vectorized density function.
+        """
+        xs = np.linspace(lower, upper, num_points)
+        with np.errstate(divide="ignore"):
+            log_density = np.log(np.ravel(distribution(xs)))
+        return cls(xs, log_density)
+
+    def logpdf(self, x):
+        """
+        The log-density at x.
+
+        :param x: A scalar or array
+        :returns: An array with at least 1 dimension.
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        # np.interp is constant outside the grid, so adding the tails is sufficient.
+        return (np.interp(x, self._xs, self._log_density)
+                + self._left_slope * np.minimum(x - self._xs[0], 0)
+                + self._right_slope * np.maximum(x - self._xs[-1], 0))
+
+    def __call__(self, x):
+        """
+        The density at x.
+
+        :param x: A scalar or array
+        :returns: An array with at least 1 dimension.
+        """
+        return np.exp(self.logpdf(x))
+
+
+class LengthIndexedData(object):
+    """
+    A table of reference data (e.g. from a file in fess/stats), indexed by the RNA length.
+
+    The row indices are sorted by length once, so the rows with a length close to
+    a given length are found by binary search instead of filtering the whole table.
+    """
+    def __init__(self, data, length_col="nt_length"):
+        """
+        :param data: A pandas DataFrame. It should not be modified afterwards.
+        :param length_col: The name of the column holding the RNA length.
+        """
+        self.data = data
+        lengths = np.asarray(data[length_col])
+        self._order = np.argsort(lengths, kind="mergesort")
+        self._sorted_lengths = lengths[self._order]
+
+    def __len__(self):
+        return len(self._sorted_lengths)
+
+    def values_within_nt_range(self, length, target_col, target_len=500):
+        """
+        The values of the rows with the lengths closest to length.
+
+        Starting with length, the window of allowed lengths is widened by
+        INCR*length to each side, until it contains at least target_len
+        rows (or all rows).
+
+        :returns: An array with the values of target_col in the order of the table.
+        """
+        distribution_lower_bound = 1.
+        distribution_upper_bound = 1.
+        start = end = 0
+        while (end - start < target_len and end - start < len(self)):
+            distribution_lower_bound -= INCR
+            distribution_upper_bound += INCR
+            start = np.searchsorted(self._sorted_lengths, distribution_lower_bound * length, side="right")
+            end = max(start, np.searchsorted(self._sorted_lengths, length * distribution_upper_bound, side="left"))
+        if end == start:
+            raise ValueError("No data found for distribution")
+        log.info("%d datapoints", end - start)
+        rows = np.sort(self._order[start:end])
+        return np.asarray(self.data[target_col])[rows]
 
 
 class CoarseGrainEnergy(EnergyFunction):
@@ -301,6 +631,12 @@ class CoarseGrainEnergy(EnergyFunction):
     #: Change this to anything but "kde" to use a beta distribution (UNTESTED).
     dist_type = "kde"
 
+    _eval_attributes = EnergyFunction._eval_attributes + ("prev_energy",)
+
+    #: If not None, a BinnedDistribution holding all accepted measures.
+    #: It replaces the growing list of accepted measures (see `use_binned_reference`)
+    _reference_histogram = None
+
     @classmethod
     def from_cg(cls, prefactor, adjustment, cg, **kwargs):
         """
@@ -417,7 +753,14 @@ class CoarseGrainEnergy(EnergyFunction):
             self.accepted_measures = list(self._get_values_from_file(self.sampled_stats_fn, rna_length))
         #If sampled_stats_fn is None, we assume accepted_measures is given in the constructor
         if self.accepted_measures:
-            self.reference_distribution = self._get_distribution_from_values(self.accepted_measures)
+            if self._reference_histogram is not None:
+                self._reference_histogram = BinnedDistribution(self.accepted_measures,
+                                                               self._reference_histogram.bins_per_bandwidth)
+                self.accepted_measures = self.accepted_measures[-1:]
+                values = self._reference_histogram
+            else:
+                values = self.accepted_measures
+            self.reference_distribution = self._get_distribution_from_values(values)
         else:
             raise ValueError("Either sampled_stats_fn or accepted_measures has to be set "
                              "before calling CoarseGrainEnergy.__init__ or "
@@ -426,6 +769,53 @@ class CoarseGrainEnergy(EnergyFunction):
         if self.real_stats_fn is not None:
             self.target_values =  self._get_values_from_file(self.real_stats_fn, rna_length)
         self._set_target_distribution()
+        self._state_changed()
+
+    def use_binned_reference(self, bins_per_bandwidth=None):
+        """
+        Store the reference distribution as a BinnedDistribution instead of a KDE.
+
+        Accepted and rejected measures are then added to a histogram in O(1),
+        instead of being appended to `self.accepted_measures` (which only keeps
+        the last accepted measure) and the reference distribution is evaluated
+        in O(1), independent of the number of sampling steps.
+
+        Energies with non-scalar measures keep their KDE.
+
+        :param bins_per_bandwidth: See `BinnedDistribution.bins_per_bandwidth`
+        """
+        if np.ndim(self.accepted_measures[-1]) != 0:
+            log.warning("%s has non-scalar measures. Keeping the KDE as reference "
+                        "distribution.", type(self).__name__)
+            return
+        if self._reference_histogram is not None:
+            return
+        self._reference_histogram = BinnedDistribution(self.accepted_measures, bins_per_bandwidth)
+        self.accepted_measures = self.accepted_measures[-1:]
+        self._resample_background_kde()
+
+    def accept_last_measure(self):
+        """
+        Like `EnergyFunction.accept_last_measure`, but add the measure
+        to the histogram, if a binned reference distribution is used.
+        """
+        if self._reference_histogram is None:
+            return super(CoarseGrainEnergy, self).accept_last_measure()
+        if self._last_measure is not None:
+            self._reference_histogram.add(self._last_measure)
+            self.accepted_measures = [self._last_measure]
+        self._step_complete()
+
+    def reject_last_measure(self):
+        """
+        Like `EnergyFunction.reject_last_measure`, but increase the count of
+        the last accepted measure, if a binned reference distribution is used.
+        """
+        if self._reference_histogram is None:
+            return super(CoarseGrainEnergy, self).reject_last_measure()
+        if len(self.accepted_measures) > 0:
+            self._reference_histogram.add(self.accepted_measures[-1])
+        self._step_complete()
 
     def _step_complete(self):
         """
@@ -440,11 +830,18 @@ class CoarseGrainEnergy(EnergyFunction):
         """
         Update the reference distribution based on the accepted values
         """
-        log.debug("Resampling background KDE for %s. Now %d accepted measures", type(self).__name__, len(self.accepted_measures))
-        values = self.accepted_measures
+        if self._reference_histogram is not None:
+            values = self._reference_histogram
+            log.debug("Smoothing binned reference distribution for %s. Now %d accepted measures",
+                      type(self).__name__, values.n)
+        else:
+            values = self.accepted_measures
+            log.debug("Resampling background KDE for %s. Now %d accepted measures",
+                      type(self).__name__, len(values))
         new_kde = self._get_distribution_from_values(values)
         if new_kde is not None:
             self.reference_distribution = new_kde
+            self._state_changed()
             log.debug("Density of ref AFTER resampling = %s", self.reference_distribution(self.accepted_measures[-1]))
         else:
             log.warning("Distribution is None. Cannot change background_kde")
@@ -456,35 +853,28 @@ class CoarseGrainEnergy(EnergyFunction):
 
     @staticmethod
     def _values_within_nt_range(data, length, target_col, length_col="nt_length", target_len=500):
-        rdata = []
-
-        distribution_lower_bound = 1.
-        distribution_upper_bound = 1.
-
-        while (len(rdata) < target_len and len(rdata)<len(data)):
-            try:
-                distribution_lower_bound -= INCR
-                distribution_upper_bound += INCR
-                rdata = data[data[length_col] > distribution_lower_bound * length]
-                rdata = rdata[rdata[length_col] < length * distribution_upper_bound]
-            except KeyboardInterrupt:
-                log.error("len(rdata) is {}, len(data)={}, bound= {}...{}".format(len(rdata),len(data),
-                     distribution_lower_bound ) * length, length * ( distribution_upper_bound ))
-                raise
-        if len(rdata)==0:
-            raise ValueError("No data found for distribution")
-        log.info("%d datapoints", len(rdata))
-        return rdata[target_col]
+        """
+        :param data: A LengthIndexedData instance or a pandas DataFrame
+        :returns: An array with the values in target_col of all rows with a length
+                  close to length. See `LengthIndexedData.values_within_nt_range`
+        """
+        if not isinstance(data, LengthIndexedData):
+            data = LengthIndexedData(data, length_col)
+        return data.values_within_nt_range(length, target_col, target_len)
 
     @classmethod
     def _get_distribution_from_values(cls, values):
         '''
         Return a probability distribution from the given values.
 
-        :param values: A list of values to fit a distribution to.
+        :param values: A list of values to fit a distribution to
+                       or a BinnedDistribution, which will be smoothed.
         :return: A probability distribution fit to the values.
         '''
 
+        if isinstance(values, BinnedDistribution):
+            values.smooth()
+            return values
         log.debug("Getting distribution from values of shape {}".format(np.shape(values)))
         if cls.dist_type == "kde":
             try:
@@ -530,28 +920,27 @@ class CoarseGrainEnergy(EnergyFunction):
 
         if background:
             ref_val = self.reference_distribution(m)
-            tar_val = self.target_distribution(m)
+            log_tar_val = self._target_log_density(m)
             if len(ref_val)>1:
                 self.log.debug("ref_values: %s", ref_val)
-                self.log.debug("tar_values: %s", tar_val)
+                self.log.debug("log(tar_values): %s", log_tar_val)
                 ref_val=np.maximum(ref_val,0)
-                tar_val=np.maximum(tar_val,0)
-                energies = np.log( tar_val ) - np.log(ref_val)
+                energies = log_tar_val - np.log(ref_val)
                 energies = np.minimum(energies, 10**8)
                 energies = np.maximum(energies, -10**8)
                 energy = sum(energies)
                 if np.isinf(energy):
                     log.warning(energies)
                     for i,r in enumerate(ref_val):
-                        if r<=0 or tar_val[i]<=0:
-                            log.warning("%sth measure %s has prob. %s in reference distribution and %s in taret distribution", i, m[i],r, tar_val[i])
+                        if r<=0 or np.isinf(log_tar_val[i]):
+                            log.warning("%sth measure %s has prob. %s in reference distribution and %s in taret distribution", i, m[i],r, np.exp(log_tar_val[i]))
             else:
-                energy, = (np.log( tar_val ) - np.log(ref_val))
+                energy, = (log_tar_val - np.log(ref_val))
             self.log.debug("Energy (not yet scaled) = {}".format(energy))
             self.prev_energy = energy
             return -1 * self.prefactor * energy
         else:
-            l = np.log(self.target_distribution(m))
+            l = self._target_log_density(m)
             self.log.debug("Energy, = {}".format(l))
             if len(l)>1:
                 energy = sum(l)
@@ -563,7 +952,37 @@ class CoarseGrainEnergy(EnergyFunction):
         super(CoarseGrainEnergy, self)._update_adj()
         self._set_target_distribution()
 
+    def _target_log_density(self, m):
+        """
+        The log of the target density at m, as an array.
+        """
+        if isinstance(self.target_distribution, TabulatedDistribution):
+            return self.target_distribution.logpdf(m)
+        with np.errstate(divide="ignore"):
+            return np.log(np.maximum(self.target_distribution(m), 0))
+
+    def _tabulation_range(self, values):
+        """
+        The range, in which the target distribution fitted to values is tabulated.
+
+        :returns: A tuple lower, upper
+        """
+        lower = np.min(values)
+        upper = np.max(values)
+        padding = (upper - lower) / 2 or 1.
+        return lower - padding, upper + padding
+
     def _set_target_distribution(self):
+        """
+        Fit the target distribution to the target values scaled by the adjustment.
+
+        The distribution is tabulated, so it is only evaluated here, not in every step.
+        """
         log.info("Adjusting target distribution (base class)")
         scaled_vals = np.asarray(self.target_values)*self.adjustment
-        self.target_distribution = self._get_distribution_from_values(scaled_vals)
+        distribution = self._get_distribution_from_values(scaled_vals)
+        if distribution is None:
+            self.target_distribution = None
+            return
+        lower, upper = self._tabulation_range(scaled_vals)
+        self.target_distribution = TabulatedDistribution.from_function(distribution, lower, upper)
@@ -0,0 +1,245 @@
+"""
+Geometric properties of coarse grained structures, shared by energies and statistics.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input, #pip install future
+                      map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+import logging
+import weakref
+
+import numpy as np
+
+import forgi.threedee.utilities.vector as ftuv
+
+log = logging.getLogger(__name__)
+
+#: Used to decide whether two segments are parallel, as in forgi.threedee.utilities.vector
+SMALL_NUM = 0.000001
+
+
+def _closest_point_parameters(u, v, w):
+    """
+    The parameters sc and tc of the closest points start1 + sc * u and start2 + tc * v
+    for pairs of segments.
+
+    :param u, v: Arrays of shape (..., 3). The direction vectors (end - start) of
+                 the first and second segment of every pair.
+    :param w: An array of shape (..., 3). start1 - start2 for every pair.
+    :returns: A tuple of two arrays of shape (...)
+    """
+    a = np.sum(u * u, axis=-1)
+    b = np.sum(u * v, axis=-1)
+    c = np.sum(v * v, axis=-1)
+    d = np.sum(u * w, axis=-1)
+    e = np.sum(v * w, axis=-1)
+    a, c = np.broadcast_arrays(a, c)
+    D = a * c - b * b
+
+    # The closest points on the infinite lines, unless they are almost parallel
+    parallel = D < SMALL_NUM
+    sN = np.where(parallel, 0., b * e - c * d)
+    sD = np.where(parallel, 1., D)
+    tN = np.where(parallel, e, a * e - b * d)
+    tD = np.where(parallel, c, D)
+    # The s=0 edge is visible
+    s_low = ~parallel & (sN < 0)
+    # The s=1 edge is visible
+    s_high = ~parallel & ~s_low & (sN > sD)
+    sN = np.where(s_low, 0., np.where(s_high, sD, sN))
+    tN = np.where(s_low, e, np.where(s_high, e + b, tN))
+    tD = np.where(s_low | s_high, c, tD)
+
+    # The t=0 edge is visible: Recompute sc for this edge
+    t_low = tN < 0
+    sN_low = np.where(-d < 0, 0., np.where(-d > a, sD, -d))
+    sD_low = np.where((-d < 0) | (-d > a), sD, a)
+    # The t=1 edge is visible: Recompute sc for this edge
+    t_high = ~t_low & (tN > tD)
+    sN_high = np.where(-d + b < 0, 0., np.where(-d + b > a, sD, -d + b))
+    sD_high = np.where((-d + b < 0) | (-d + b > a), sD, a)
+    sN = np.where(t_low, sN_low, np.where(t_high, sN_high, sN))
+    sD = np.where(t_low, sD_low, np.where(t_high, sD_high, sD))
+    tN = np.where(t_low, 0., np.where(t_high, tD, tN))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sc = np.where(np.abs(sN) < SMALL_NUM, 0., sN / sD)
+        tc = np.where(np.abs(tN) < SMALL_NUM, 0., tN / tD)
+    return sc, tc
+
+
+def segment_distances(starts1, ends1, starts2, ends2, cutoff=None, closest_points=False):
+    """
+    The minimal distances between all pairs of line segments from two sets.
+
+    This is a vectorized version of `forgi.threedee.utilities.vector.line_segment_distance`
+    and, if cutoff is given, of `forgi.threedee.utilities.vector.elements_closer_than`.
+
+    :param starts1, ends1: Arrays of shape (N, 3) with the start and end points of the
+                           first set of segments.
+    :param starts2, ends2: Arrays of shape (M, 3) with the start and end points of the
+                           second set of segments.
+    :param cutoff: None or a distance. If given, the distance of all pairs that are
+                   not closer than cutoff is inf. Pairs which are certainly further
+                   apart, because the distance between their start points is larger
+                   than cutoff plus the length of both segments, are not evaluated at all.
+    :param closest_points: If True, return the closest points as well.
+    :returns: An array of shape (N, M). If closest_points is True, a tuple
+              (distances, points1, points2), where points1 and points2 have the
+              shape (N, M, 3) and hold the closest point on the segment from the
+              first and second set. Points of pairs not closer than cutoff are nan.
+    """
+    starts1 = np.asarray(starts1, dtype=float)
+    starts2 = np.asarray(starts2, dtype=float)
+    shape = (len(starts1), len(starts2))
+    u = np.asarray(ends1, dtype=float) - starts1
+    v = np.asarray(ends2, dtype=float) - starts2
+    w = starts1[:, np.newaxis, :] - starts2[np.newaxis, :, :]
+    if cutoff is None:
+        sc, tc = _closest_point_parameters(u[:, np.newaxis, :], v[np.newaxis, :, :], w)
+    else:
+        # Like in elements_closer_than: Discard pairs that cannot be closer than cutoff.
+        lengths1 = np.sqrt(np.sum(u * u, axis=-1))
+        lengths2 = np.sqrt(np.sum(v * v, axis=-1))
+        reach = lengths1[:, np.newaxis] + lengths2[np.newaxis, :] + cutoff
+        candidates = np.sum(w * w, axis=-1) <= reach * reach
+        i, j = np.nonzero(candidates)
+        sc = np.full(shape, np.nan)
+        tc = np.full(shape, np.nan)
+        sc[i, j], tc[i, j] = _closest_point_parameters(u[i], v[j], w[i, j])
+    difference = w + sc[..., np.newaxis] * u[:, np.newaxis, :] - tc[..., np.newaxis] * v
+    distances = np.sqrt(np.sum(difference * difference, axis=-1))
+    if cutoff is not None:
+        far = ~(distances < cutoff)
+        distances[far] = np.inf
+        sc[far] = np.nan
+        tc[far] = np.nan
+    if not closest_points:
+        return distances
+    points1 = starts1[:, np.newaxis, :] + sc[..., np.newaxis] * u[:, np.newaxis, :]
+    points2 = starts2[np.newaxis, :, :] + tc[..., np.newaxis] * v[np.newaxis, :, :]
+    return distances, points1, points2
+
+
+def _same_array(array1, array2):
+    """
+    Like np.array_equal, but nan is equal to nan.
+    """
+    if array1.shape != array2.shape:
+        return False
+    return np.all((array1 == array2) | (np.isnan(array1) & np.isnan(array2)))
+
+
+class GeometryCache(object):
+    """
+    Geometric properties of the current structure of a CoarseGrainRNA, computed lazily.
+
+    Use `GeometryCache.for_cg(cg)` to get the cache for a cg. All energies
+    and statistics collectors looking at the same structure share it, so
+    every property is computed at most once per structure.
+
+    The cache compares the coordinates and twists of the cg with the values
+    it has seen before, whenever it is requested with `for_cg`. If they
+    changed (e.g. the structure was rebuilt), all cached properties are discarded.
+    The returned arrays are read-only.
+    """
+    _instances = weakref.WeakKeyDictionary()
+
+    def __init__(self, cg):
+        # A weak reference, because the cg is the key of self._instances
+        self._cg = weakref.ref(cg)
+        self._coords = None
+        self._twists = None
+        self._values = {}
+
+    @classmethod
+    def for_cg(cls, cg):
+        """
+        The geometry cache for the current structure of cg.
+        """
+        try:
+            cache = cls._instances[cg]
+        except KeyError:
+            cache = cls._instances[cg] = cls(cg)
+        cache._check_structure(cg)
+        return cache
+
+    def _check_structure(self, cg):
+        coords = cg.coords.get_array()
+        twists = cg.twists.get_array()
+        if (self._coords is None or not _same_array(coords, self._coords)
+                or not _same_array(twists, self._twists)):
+            log.debug("Structure changed. Clearing geometry cache")
+            self._values = {}
+            self._coords = coords
+            self._twists = twists
+
+    def _get(self, key, compute, *args):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        value = compute(self._cg(), *args)
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+        self._values[key] = value
+        return value
+
+    @property
+    def segment_names(self):
+        """
+        A list with the names of all coarse grained elements, in the order of `segments`.
+        """
+        return self._get("segment_names", lambda cg: list(cg.coords))
+
+    @property
+    def segment_index(self):
+        """
+        A dictionary element name: index in `segments`
+        """
+        return self._get("segment_index",
+                         lambda cg: {elem: i for i, elem in enumerate(self.segment_names)})
+
+    @property
+    def segments(self):
+        """
+        An array of shape (number of elements, 2, 3) with the start
+        and end point of every coarse grained element.
+        """
+        return self._get("segments",
+                         lambda cg: cg.coords[self.segment_names].reshape(-1, 2, 3))
+
+    def segment_distances(self, elements):
+        """
+        The matrix of minimal distances between all pairs of the given elements.
+
+        :param elements: A sequence of element names. Energies that use the same
+                         sequence of elements share the matrix.
+        :returns: An array of shape (len(elements), len(elements))
+        """
+        elements = tuple(elements)
+        return self._get(("segment_distances", elements), self._segment_distances, elements)
+
+    def _segment_distances(self, cg, elements):
+        index = self.segment_index
+        segments = self.segments[[index[elem] for elem in elements]]
+        return segment_distances(segments[:, 0], segments[:, 1],
+                                 segments[:, 0], segments[:, 1])
+
+    @property
+    def virtual_residues(self):
+        """
+        The virtual residue positions of all nucleotides,
+        as returned by `cg.get_ordered_virtual_residue_poss()`
+        """
+        return self._get("virtual_residues",
+                         lambda cg: cg.get_ordered_virtual_residue_poss())
+
+    @property
+    def centroid(self):
+        """
+        The centroid of the virtual residues.
+        """
+        return self._get("centroid",
+                         lambda cg: ftuv.get_vector_centroid(self.virtual_residues))
@@ -35,24 +35,98 @@ from fess.builder._commandline_helper import replica_substring
 
 log = logging.getLogger(__name__)
 
+#: Per-element dictionaries of the CoarseGrainRNA holding virtual residue information.
+_VRES_CACHES = ["vposs", "vvecs", "v3dposs", "vbases", "vinvs", "bases", "stem_invs"]
 
-class StemModel:
+
+class StemModel(object):
     '''
     A way of encapsulating the coarse grain 3D stem.
+
+    A StemModel either holds its own coordinates or, once it is bound
+    to the coordinate storages of a CoarseGrainRNA (see `bind`), is a
+    view into the contiguous coordinate and twist arrays of the RNA.
+    Reading `mids` or `twists` of a bound stem yields views into these
+    arrays and assigning to them writes the new values in place.
     '''
 
     def __init__(self, name=None, mids=None, twists=None):
         self.name = name
+        self._coord_storage = None
+        self._twist_storage = None
 
-        if mids == None:
+        if mids is None:
             self.mids = (np.array([0., 0., 0.]), np.array([0., 0., 1.0]))
         else:
             self.mids = mids
-        if twists == None:
+        if twists is None:
             self.twists = (np.array([0., 1., 0.]), np.array([1., 0., 0.0]))
         else:
             self.twists = twists
 
+    @property
+    def mids(self):
+        if self._coord_storage is not None:
+            return self._coord_storage[self.name]
+        return self._mids
+
+    @mids.setter
+    def mids(self, mids):
+        if self._coord_storage is not None:
+            self._coord_storage[self.name] = mids
+        else:
+            self._mids = mids
+
+    @property
+    def twists(self):
+        if self._twist_storage is not None:
+            return self._twist_storage[self.name]
+        return self._twists
+
+    @twists.setter
+    def twists(self, twists):
+        if self._twist_storage is not None:
+            self._twist_storage[self.name] = twists
+        else:
+            self._twists = twists
+
+    def bind(self, coords, twists):
+        '''
+        Store this stem's coordinates in the given coordinate storages
+        and use them as the backing store from now on.
+
+        :param coords: A forgi CoordinateStorage, usually cg.coords
+        :param twists: A forgi CoordinateStorage, usually cg.twists
+        '''
+        mids, twists_ = self.mids, self.twists
+        self._coord_storage = self._twist_storage = None
+        coords[self.name] = mids
+        twists[self.name] = twists_
+        self._coord_storage = coords
+        self._twist_storage = twists
+        self._mids = self._twists = None
+
+    @classmethod
+    def from_storage(cls, name, coords, twists):
+        '''
+        Create a StemModel that is a view into the coordinates
+        already stored for the stem `name`.
+
+        :param coords: A forgi CoordinateStorage, usually cg.coords
+        :param twists: A forgi CoordinateStorage, usually cg.twists
+        '''
+        stem = cls(name)
+        stem._coord_storage = coords
+        stem._twist_storage = twists
+        stem._mids = stem._twists = None
+        return stem
+
+    def is_bound_to(self, coords, twists):
+        '''
+        Whether or not this stem is a view into the given coordinate storages.
+        '''
+        return self._coord_storage is coords and self._twist_storage is twists
+
     def __str__(self):
         return str(self.mids) + '\n' + str(self.twists)
 
@@ -68,8 +142,13 @@ class StemModel:
         '''
         Reverse this stem's orientation so that the order of the mids
         is backwards. I.e. mids[1] = mids[0]...
+
+        The returned StemModel is not bound to any coordinate storage.
         '''
-        return StemModel(self.name, (self.mids[1], self.mids[0]), (self.twists[1], self.twists[0]))
+        mids = self.mids
+        twists = self.twists
+        return StemModel(self.name, (np.array(mids[1]), np.array(mids[0])),
+                         (np.array(twists[1]), np.array(twists[0])))
 
     def vec(self, from_side_to_side = (0, 1)):
         from_side, to_side = from_side_to_side
@@ -275,6 +354,8 @@ class SpatialModel:
         self.junction_constraint_energy = defaultdict(create_empty_energy)
 
         self.elem_defs=dict()
+        #: A tuple (build_order, children, position). See self._get_build_tree
+        self._build_tree = None
 
         self.bg = bg
         # We plan to modify the structure, so discard the cahin.
@@ -325,7 +406,7 @@ class SpatialModel:
 
         for d in self.bg.defines.keys():
             if d[0] == 's':
-                stems[d] = StemModel(d, self.bg.coords[d], self.bg.twists[d])
+                stems[d] = StemModel.from_storage(d, self.bg.coords, self.bg.twists)
 
                 if self.build_chain:
                     reconstruct_stem(self, d, self.chain, stem_library=cbc.Configuration.stem_library, stem=stems[d])
@@ -365,16 +446,20 @@ class SpatialModel:
         region as from there we can just randomly orient the first stem.
         '''
 
-        edge = self.bg.sorted_stem_iterator().next()
+        edge = next(self.bg.sorted_stem_iterator())
         define = 'start'
         return (edge, define, StemModel(edge))
 
 
-    def save_sampled_elems(self):
+    def save_sampled_elems(self, elems=None):
         '''
         Save the information about all of the sampled elements.
+
+        :param elems: Optional; Only save the information for these elements.
         '''
         for d, ed in self.elem_defs.items():
+            if elems is not None and d not in elems:
+                continue
             try:
                 self.bg.sampled[d] = [ed.pdb_name] + [len(ed.define)] + ed.define
                 self.bg.vbase[d] = ed.vbase
@@ -595,13 +680,18 @@ class SpatialModel:
 
         return stem
 
-    def fill_in_bulges_and_loops(self):
+    def fill_in_bulges_and_loops(self, elems=None):
+        """
+        :param elems: Optional; Only fill in these bulges and loops.
+        """
         log.debug("Started fill_in_bulges_and_loops")
         loops = list(self.bg.hloop_iterator())
         fiveprime = list(self.bg.floop_iterator())
         threeprime = list(self.bg.tloop_iterator())
 
         for d in self.bg.defines.keys():
+            if elems is not None and d not in elems:
+                continue
             if d[0] != 's':
                 if d in loops or d in fiveprime or d in threeprime:
                     log.debug("Adding loop {} (connected to {})".format(d, list(self.bg.edges[d])[0]))
@@ -624,10 +714,17 @@ class SpatialModel:
 
     def stem_to_coords(self, stem):
         """
+        Make sure the coordinates of the StemModel self.stems[stem] are
+        stored in self.bg.coords and self.bg.twists.
 
+        Stems placed by this SpatialModel are views into these arrays
+        already, so this only copies coordinates for StemModels that
+        were assigned to self.stems from outside.
         """
         log = logging.getLogger(__name__+".SpatialModel.stem_to_coords")
         sm = self.stems[stem]
+        if sm.is_bound_to(self.bg.coords, self.bg.twists):
+            return
         if log.isEnabledFor(logging.DEBUG):
             if (not np.allclose(self.bg.coords[stem][0], sm.mids[0]) or
                 not np.allclose(self.bg.coords[stem][1], sm.mids[1])):
@@ -636,18 +733,52 @@ class SpatialModel:
                 not np.allclose(self.bg.twists[stem][1], sm.twists[1])):
                 log.debug("Changing stem twist %s : %s to %s", stem, self.bg.twists[stem], (sm.twists[0], sm.twists[1]))
 
-        self.bg.coords[stem] = np.array([sm.mids[0], sm.mids[1]])
-        self.bg.twists[stem] = np.array([sm.twists[0], sm.twists[1]])
+        sm.bind(self.bg.coords, self.bg.twists)
+
+    def _place_stem(self, stem, mids, twists):
+        '''
+        Write the coordinates of a newly placed stem in place into
+        self.bg.coords and self.bg.twists.
 
-    def _loops_to_coords(self):
+        The StemModel in self.stems is reused if it already is a view
+        into these arrays.
+        '''
+        model = self.stems.get(stem)
+        if model is None or not model.is_bound_to(self.bg.coords, self.bg.twists):
+            model = StemModel.from_storage(stem, self.bg.coords, self.bg.twists)
+            self.stems[stem] = model
+        model.mids = mids
+        model.twists = twists
+
+    def _loops_to_coords(self, elems=None):
         '''
         Add all of the stem and bulge coordinates to the BulgeGraph data structure.
+
+        :param elems: Optional; Only update the coordinates of these loops.
         '''
 
         log.debug("_loops_to_coords: Adding bulge coodinates from stems")
-        self.bg.add_bulge_coords_from_stems()
+        if elems is None:
+            self.bg.add_bulge_coords_from_stems()
+        else:
+            # Like self.bg.add_bulge_coords_from_stems, but only for elems
+            for d in elems:
+                if d[0] == 's':
+                    continue
+                edges = list(self.bg.edges[d])
+                if len(edges) == 2:
+                    (s1b, _) = self.bg.get_sides(edges[0], d)
+                    (s2b, _) = self.bg.get_sides(edges[1], d)
+                    mids1 = self.bg.coords[edges[0]]
+                    mids2 = self.bg.coords[edges[1]]
+                    if self.bg.get_link_direction(edges[0], edges[1], d) == 1:
+                        self.bg.coords[d] = (mids1[s1b], mids2[s2b])
+                    else:
+                        self.bg.coords[d] = (mids2[s2b], mids1[s1b])
 
         for d in self.bg.hloop_iterator():
+            if elems is not None and d not in elems:
+                continue
             bm = self.bulges[d]
             connected, =self.bg.edges[d]
             if not np.allclose(bm.mids[0], self.bg.coords[connected][1]):
@@ -656,6 +787,8 @@ class SpatialModel:
                 assert False, "Bulge {}, Difference {}".format(d, bm.mids[0]-self.bg.coords[connected][1])
             self.bg.coords[d] = np.array([bm.mids[0], bm.mids[1]])
         for d in it.chain(self.bg.floop_iterator(), self.bg.tloop_iterator()):
+            if elems is not None and d not in elems:
+                continue
             if d in self.bg.defines:
                 bm = self.bulges[d]
                 connected, =self.bg.edges[d]
@@ -706,16 +839,36 @@ class SpatialModel:
 
         #self.prev_visit_order = prev_visited
 
-    def _finish_building(self):
-        log.debug("Finish building")
+    def _finish_building(self, nodes=None):
+        """
+        Add the bulges, loops and virtual residues to the built stems.
+
+        :param nodes: Optional; The elements that have been (re-)built or whose
+                      stats have changed. If given, only these elements and
+                      the loops attached to the (re-)built stems are updated.
+                      Otherwise all elements are updated.
+        """
+        log.debug("Finish building %s", nodes)
+        if nodes is None:
+            elems = None
+            stems = None
+        else:
+            elems = set(nodes)
+            stems = [ d for d in nodes if d[0] == 's' ]
+            for stem in stems:
+                elems.update(self.bg.edges[stem])
         log.debug("(1) vposs now %s", self.bg.vposs)
-        self.fill_in_bulges_and_loops()
+        self.fill_in_bulges_and_loops(elems)
         log.debug("(2) vposs now %s", self.bg.vposs)
-        self._loops_to_coords()
+        self._loops_to_coords(elems)
         log.debug("(3) vposs now %s", self.bg.vposs)
-        self.save_sampled_elems()
+        self.save_sampled_elems(elems)
         log.debug("(4) vposs now %s", self.bg.vposs)
-        self.bg.add_all_virtual_residues()
+        if stems is None:
+            self.bg.add_all_virtual_residues()
+        else:
+            for stem in stems:
+                ftug.add_virtual_residues(self.bg, stem)
         log.debug("(5) vposs now %s", self.bg.vposs)
 
     def add_to_skip(self):
@@ -744,88 +897,72 @@ class SpatialModel:
         self.to_skip = to_skip
 
 
-    def new_traverse_and_build(self, start='start', max_steps=float('inf'),
-                               end=None, include_start=False, finish_building = True):
-        '''
-        Build a 3D structure from the graph in self.bg and the stats from self.elem_defs.
-        :param start: Optional; Start building the given element. If it is a stem, build AFTER this stem.
-                      TODO: instead of linear build_order use a tree. Only build leaves dependend on the changed node
-
-        :param max_staps: Optional; Build at most that many stems.
-        :param end: Optional; End building once the given node is built.
-                    If `end` and `max_steps` are given, the criterion that kicks in earlier counts.
-        :param include_start: If True, build including the node given as start,
-                              if False, only build AFTER it. Only has an effect is start is a stem.
-        :param finish_building: Usually True. Set it to False, if self._finish_building
-                                should not be called after the stems have been built.
-        :returns: A list of course_grained elements that have been built.
-                  (Useful, if start or max_steps is given).
-        '''
-        log.debug("new_traverse_and_build(self, start={}, max_steps={}, end={})".format(start, max_steps, end))
+    def _get_build_order(self):
         if not self.bg.build_order:
-            build_order = self.bg.traverse_graph()
-        else:
-            build_order = self.bg.build_order
-        log.debug("build_order: %s", build_order)
-        def buildorder_of(stemid, include = False):
-            """
-            Returns the buildorder of the multi-/ interior loop before the stem with stemid.
-            :param stemid: a string describing a stem or loop, e.g. 's0', 'i3'
-            :param include: Whether or not to include the starting node (only for stems),
-                            for bulges, the stem AFTER the bulge is always the first stem placed.
-            """
-
-            if stemid == "s0":
-                return int(include)
-
-            if stemid.startswith('s'):
-                for i, stem_loop_stem in enumerate(build_order):
-                    if stemid==stem_loop_stem[2]:
-                        if include:
-                            return i
-                        else:
-                            return i+1
-            else:
-                if stemid[0] in "fth":
-                    return float("inf") #Only fill in bulges and loops if loop was changed
-                for i, stem_loop_stem in enumerate(build_order):
-                    if stemid==stem_loop_stem[1]:
-                        return i
-            raise ValueError("{} not found in {}.".format(stemid,build_order))
+            return self.bg.traverse_graph()
+        return self.bg.build_order
+
+    def _get_build_tree(self, build_order):
+        """
+        The build order as a dependency tree.
+
+        The tree is cached as long as the build order does not change.
+
+        :returns: A tuple `children, position`. `children` is a dictionary
+                  {stem: [build_step, ...]}, containing the indices into the build_order
+                  of all stems placed relative to the stem.
+                  `position` is a dictionary {elem: build_step} for all loops and
+                  stems placed in the build_order.
+        """
+        if self._build_tree is None or self._build_tree[0] is not build_order:
+            children = defaultdict(list)
+            position = {}
+            for i, (s1, l, s2) in enumerate(build_order):
+                children[s1].append(i)
+                position[l] = i
+                position[s2] = i
+            self._build_tree = (build_order, children, position)
+        return self._build_tree[1], self._build_tree[2]
+
+    def _downstream_steps(self, build_order, first_steps):
+        """
+        All build steps that depend on the given build steps.
+
+        :param first_steps: A collection of indices into the build_order.
+        :returns: A sorted list of indices into the build_order, containing
+                  first_steps and all steps in the subtrees below them.
+        """
+        children, _ = self._get_build_tree(build_order)
+        steps = set()
+        to_visit = list(first_steps)
+        while to_visit:
+            step = to_visit.pop()
+            if step in steps:
+                continue
+            steps.add(step)
+            to_visit.extend(children[build_order[step][2]])
+        return sorted(steps)
 
+    def _build_steps(self, build_order, steps, max_steps=float('inf'), end=None):
+        """
+        Place the stems for the given build steps.
+
+        :param steps: A sorted list of indices into the build order.
+        :param max_staps: Build at most that many stems.
+        :param end: End building once the build_order reaches this node.
+        :returns: A list of the nodes that have been built.
+        """
         nodes = []
-        if start == "start" or (start == "s0" and include_start):
-            # add the first stem in relation to a non-existent stem
-            first_stem = "s0"
-            log.debug("new_traverse_and_build: Setting self.stems[{}] (=first  stem)".format(first_stem))
-            self.stems[first_stem] = self.add_stem(first_stem, self.elem_defs[first_stem], StemModel(),
-                                                   ftms.AngleStat(), (0,1))
-            self.stem_to_coords(first_stem)
-            nodes.append(first_stem)
-            build_step = 0
-        elif start=="end" or start[0] in "fth":
-            self._finish_building()
-            return []
+        if end is not None:
+            _, position = self._get_build_tree(build_order)
+            end_step = position.get(end, float('inf'))
         else:
-            build_step = buildorder_of(start, include_start)
-            if build_step >= len(build_order):
-                if finish_building:
-                    self._finish_building()
-                return []
-            prev_stem = build_order[build_step][0]
-            try:
-                log.debug("new_traverse_and_build: Checking self.stems[{}] (=prev_stem)".format(prev_stem))
-                self.stems[prev_stem]
-            except KeyError:
-                raise ValueError("Cannot build structure starting from {0}, because the parts "
-                                 "of the structure before {0} have never been built. "
-                                 "(The start-option is only for RE-building)".format(start))
-
-        max_build_steps = min(build_step+max_steps, len(build_order))
-        while build_step < max_build_steps:
+            end_step = float('inf')
+        for build_step in steps:
+            if len(nodes)//2 >= max_steps or build_step > end_step:
+                break
             (s1, l, s2) = build_order[build_step]
             nodes += [l, s2]
-            build_step +=1
 
             prev_stem = self.stems[s1]
             angle_params = self.elem_defs[l]
@@ -851,19 +988,210 @@ class SpatialModel:
             # if its 1-end was added, the its coordinates need to
             # be reversed to reflect the fact it was added backwards
             if connection_ends[1] == 1:
-                self.stems[s2] = stem.reverse()
+                self._place_stem(s2, stem.mids[::-1], stem.twists[::-1])
             else:
-                self.stems[s2] = stem
+                self._place_stem(s2, stem.mids, stem.twists)
+        return nodes
 
-            self.stem_to_coords(s2)
+    def _build_first_stem(self):
+        # add the first stem in relation to a non-existent stem
+        first_stem = "s0"
+        log.debug("new_traverse_and_build: Setting self.stems[{}] (=first  stem)".format(first_stem))
+        stem = self.add_stem(first_stem, self.elem_defs[first_stem], StemModel(),
+                             ftms.AngleStat(), (0,1))
+        self._place_stem(first_stem, stem.mids, stem.twists)
+        return first_stem
 
-            #Optional end-criterion given as a node label.
-            if end is not None and end in nodes:
-                break
-        if finish_building:
+    def new_traverse_and_build(self, start='start', max_steps=float('inf'),
+                               end=None, include_start=False, finish_building = True):
+        '''
+        Build a 3D structure from the graph in self.bg and the stats from self.elem_defs.
+
+        If `start` is given, only the parts of the structure which depend on
+        the start node (the subtree downstream of it in the build order) are re-built.
+
+        :param start: Optional; Start building the given element. If it is a stem, build AFTER this stem.
+        :param max_staps: Optional; Build at most that many stems.
+        :param end: Optional; End building once the given node is built.
+                    If `end` and `max_steps` are given, the criterion that kicks in earlier counts.
+        :param include_start: If True, build including the node given as start,
+                              if False, only build AFTER it. Only has an effect is start is a stem.
+        :param finish_building: Usually True. Set it to False, if self._finish_building
+                                should not be called after the stems have been built.
+        :returns: A list of course_grained elements that have been built.
+                  (Useful, if start or max_steps is given).
+        '''
+        log.debug("new_traverse_and_build(self, start={}, max_steps={}, end={})".format(start, max_steps, end))
+        build_order = self._get_build_order()
+        log.debug("build_order: %s", build_order)
+        if start == "start" or (start == "s0" and include_start):
+            nodes = [self._build_first_stem()]
+            steps = list(range(len(build_order)))
+            if end in nodes:
+                steps = []
+        elif start=="end" or start[0] in "fth":
             self._finish_building()
+            return []
+        else:
+            children, position = self._get_build_tree(build_order)
+            if start != "s0" and start not in position:
+                raise ValueError("{} not found in {}.".format(start, build_order))
+            if start[0] == "s":
+                # All build steps placing stems relative to the start stem.
+                first_steps = list(children.get(start, []))
+                if include_start:
+                    first_steps.append(position[start])
+            else:
+                # For bulges, the stem AFTER the bulge is always the first stem placed.
+                first_steps = [position[start]]
+            if not first_steps:
+                if finish_building:
+                    self._finish_building()
+                return []
+            for prev_stem in set(build_order[step][0] for step in first_steps):
+                try:
+                    log.debug("new_traverse_and_build: Checking self.stems[{}] (=prev_stem)".format(prev_stem))
+                    self.stems[prev_stem]
+                except KeyError:
+                    raise ValueError("Cannot build structure starting from {0}, because the parts "
+                                     "of the structure before {0} have never been built. "
+                                     "(The start-option is only for RE-building)".format(start))
+            nodes = []
+            steps = self._downstream_steps(build_order, first_steps)
+
+        nodes += self._build_steps(build_order, steps, max_steps, end)
+        if finish_building:
+            if start == "start":
+                self._finish_building()
+            else:
+                self._finish_building(nodes)
+        return nodes
+
+    def rebuild_changed(self, changed, finish_building=True):
+        """
+        Rebuild the structure after the stats of the elements `changed` have been modified.
+
+        Only the subtrees downstream of the changed elements are re-built and only
+        the bulges, loops and virtual residues that are affected are updated.
+
+        :param changed: A collection of coarse grained element names, whose
+                        entries in `self.elem_defs` have been changed.
+        :returns: A list of all nodes that have been (re-)built.
+        """
+        build_order = self._get_build_order()
+        _, position = self._get_build_tree(build_order)
+        if "s0" in changed:
+            return self.new_traverse_and_build(start="start", finish_building=finish_building)
+        # Elements not in the build order (loops, broken ml-segments)
+        # do not influence any stems.
+        first_steps = set( position[elem] for elem in changed if elem in position )
+        steps = self._downstream_steps(build_order, first_steps)
+        nodes = self._build_steps(build_order, steps)
+        if finish_building:
+            self._finish_building(nodes+list(changed))
         return nodes
 
+    def affected_elements(self, changed):
+        """
+        All coarse grained elements whose coordinates or virtual residues
+        change, if the stats for the elements in `changed` are modified.
+
+        :param changed: A collection of coarse grained element names.
+        :returns: A set of element names.
+        """
+        if "s0" in changed:
+            return set(self.bg.defines)
+        build_order = self._get_build_order()
+        _, position = self._get_build_tree(build_order)
+        steps = self._downstream_steps(build_order,
+                                       set( position[elem] for elem in changed if elem in position ))
+        elems = set(changed)
+        for step in steps:
+            (s1, l, s2) = build_order[step]
+            elems.add(l)
+            elems.add(s2)
+            elems.update(self.bg.edges[s2])
+        return elems
+
+    def snapshot(self, changed=None):
+        """
+        Save the coordinates of all elements affected by a change of the stats
+        for the elements in `changed`, so they can be restored with `self.restore`
+        instead of re-building the structure.
+
+        :param changed: A collection of coarse grained element names,
+                        whose stats are about to be changed.
+                        If None, a snapshot of the whole structure is taken.
+        :returns: A snapshot, which should be treated as opaque and
+                  only be passed to `self.restore`
+        """
+        if changed is None:
+            changed = set(self.bg.defines)
+            elems = changed
+        else:
+            changed = set(changed)
+            elems = self.affected_elements(changed)
+        elems = sorted(elems)
+        stems = [d for d in elems if d[0] == "s"]
+        # One copy of the coordinate (and twist) arrays for all elements.
+        # Each element keeps a view into it.
+        coords = self.bg.coords[elems] if elems else None
+        twists = self.bg.twists[stems] if stems else None
+        saved = {}
+        stem_index = {d: i for i, d in enumerate(stems)}
+        for i, d in enumerate(elems):
+            elem_saved = {"coords": coords[2*i:2*i+2]}
+            if d[0] == "s":
+                j = stem_index[d]
+                elem_saved["twists"] = twists[2*j:2*j+2]
+                elem_saved["model"] = self.stems.get(d)
+                for attr in _VRES_CACHES:
+                    cache = getattr(self.bg, attr, None)
+                    if cache is not None and d in cache:
+                        elem_saved[attr] = copy.copy(cache[d])
+            else:
+                elem_saved["model"] = self.bulges.get(d)
+                if d in self.bg.vposs:
+                    elem_saved["vposs"] = copy.copy(self.bg.vposs[d])
+            saved[d] = elem_saved
+        return changed, saved
+
+    def restore(self, snapshot):
+        """
+        Restore the coordinates saved with `self.snapshot`.
+
+        The stats in self.elem_defs have to be restored by the caller before.
+
+        :param snapshot: The return value of `self.snapshot`
+        """
+        changed, saved = snapshot
+        # Setting the coordinates resets the virtual residue caches
+        # of the element, so we first set all coordinates.
+        for d, elem_saved in saved.items():
+            self.bg.coords[d] = elem_saved["coords"]
+            if d[0] == "s":
+                self.bg.twists[d] = elem_saved["twists"]
+        for d, elem_saved in saved.items():
+            if d[0] == "s":
+                models = self.stems
+                for attr in _VRES_CACHES:
+                    cache = getattr(self.bg, attr, None)
+                    if cache is None:
+                        continue
+                    if attr in elem_saved:
+                        cache[d] = elem_saved[attr]
+                    elif d in cache:
+                        del cache[d]
+            else:
+                models = self.bulges
+                if "vposs" in elem_saved:
+                    self.bg.vposs[d] = elem_saved["vposs"]
+            if elem_saved["model"] is not None:
+                models[d] = elem_saved["model"]
+            elif d in models:
+                del models[d]
+        self.save_sampled_elems(changed)
+
 
     def ml_stat_deviation(self, ml, stat):
         """
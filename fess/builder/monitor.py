@@ -31,6 +31,7 @@ import fess.builder.reconstructor as fbr
 
 from . import config as conf
 from . import energy as fbe
+from .geometry import GeometryCache
 from ..SortedCollection import SortedCollection
 
 log = logging.getLogger(__name__)
@@ -318,7 +319,7 @@ class RMSDStatistics(StatisticsCollector):
                     curr_vress.append(sm.bg.get_virtual_residue(res, allow_single_stranded = True))
                 curr_vress = np.array(curr_vress)
             else:
-                curr_vress = sm.bg.get_ordered_virtual_residue_poss()
+                curr_vress = GeometryCache.for_cg(sm.bg).virtual_residues
             if self.mode == "RMSD":
                 try:
                     rmsd = ftme.rmsd(self._reference, curr_vress)
@@ -59,6 +59,8 @@ class Mover:
         self.stat_source = stat_source
         #: A list of tuples  (elemenmt_name, stat)
         self._prev_stats = None
+        #: A snapshot of the coordinates before the last move (see SpatialModel.snapshot)
+        self._snapshot = None
 
     def _get_elem(self, sm):
         possible_elements = set(sm.bg.defines.keys()) - sm.frozen_elements
@@ -79,14 +81,23 @@ class Mover:
         elem, new_stat = self._get_elem_and_stat(sm)
         self._prev_stats = {}
         movestring = self._move(sm, elem, new_stat)
-        if elem in sm.bg.get_mst():
-            start=elem
-        else:
-            start="end"
-        log.debug("Mover building (start=%s")
-        sm.new_traverse_and_build(start = start, include_start = True)
+        log.debug("Mover building (changed=%s)", elem)
+        self._snapshot = sm.snapshot([elem])
+        sm.rebuild_changed([elem])
         return movestring
 
+    def changed_elements(self):
+        """
+        The coarse grained elements, whose coordinates or stats
+        were changed by the last move.
+
+        :returns: A set of element names or None, if this is not known.
+        """
+        if self._snapshot is None:
+            return None
+        changed, saved = self._snapshot
+        return set(saved)
+
     def _store_prev_stat(self, sm, elem):
         """
         Store the stat from elem_defs to self._prev_stats and return its pdb_name.
@@ -117,8 +128,13 @@ class Mover:
             assert stat is not None
             log.debug("%s REVERT Assigning %s to %s", type(self).__name__, stat.pdb_name, elem)
             sm.elem_defs[elem] = stat
+        changed = list(self._prev_stats)
         self._prev_stats = {}
-        sm.new_traverse_and_build(start='start', include_start = True)
+        if self._snapshot is not None:
+            sm.restore(self._snapshot)
+            self._snapshot = None
+        else:
+            sm.rebuild_changed(changed)
 
 class MoveAndRelaxer(Mover):
     def _store_prev_stat(self, sm, elem):
@@ -150,11 +166,9 @@ class MoveAndRelaxer(Mover):
         elem, new_stat = self._get_elem_and_stat(sm)
         self._prev_stats = {}
         movestring = self._move(sm, elem, new_stat)
-        if elem in sm.bg.get_mst():
-            start=elem
-        else:
-            start="end"
-        sm.new_traverse_and_build(start = start, include_start = True)
+        # Relaxation may change any element.
+        self._snapshot = sm.snapshot()
+        sm.rebuild_changed([elem])
         ok, relaxstring = fbrel.relax_sm(sm, self.stat_source, [elem])
         return movestring+relaxstring
 
@@ -270,6 +284,8 @@ class EnergeticJunctionMover(Mover):
         self._prev_stats = {}
         for elem in elems:
             self._store_prev_stat(sm, elem)
+        # _find_stats_for builds parts of the junction
+        self._snapshot = sm.snapshot(elems)
 
         use_asserts = ftuv.USE_ASSERTS
         ftuv.USE_ASSERTS=False
@@ -290,7 +306,7 @@ class EnergeticJunctionMover(Mover):
                 except KeyError:
                     p_name = "UNSET"
                 movestring.append("{}:{}->{};".format(ml, p_name, stat.pdb_name))
-            sm.new_traverse_and_build(start = "start", include_start = True)
+            sm.rebuild_changed(elems)
             return "".join(movestring)
 
     def _check_junction_pk():
@@ -384,6 +400,9 @@ class RotationMover(Mover):
         sm.bg.rotate(self.last_axis, -self.last_angle)
         self.last_axis = None
 
+    def changed_elements(self):
+        return None
+
 
 class MixedMover():
     def __init__(self, movers=[]):
@@ -417,6 +436,9 @@ class MixedMover():
     def revert(self, sm):
         self.last_mover.revert(sm)
 
+    def changed_elements(self):
+        return self.last_mover.changed_elements()
+
 
 ####################################################################################################
 ### Command line parsing
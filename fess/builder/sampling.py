@@ -8,6 +8,15 @@ __metaclass__ = type
 import logging
 import random
 import math
+import copy
+import os
+import traceback
+import warnings
+from multiprocessing import Process, Pipe
+
+import numpy as np
+
+from .move import MixedMover
 
 log=logging.getLogger(__name__)
 class NoopRevertWarning(UserWarning):
@@ -17,25 +26,38 @@ class MCMCSampler:
     '''
     Sample using tradition accept/reject sampling.
     '''
-    def __init__(self, sm, energy_function, mover, stats_collector, rerun_prev_energy=False):
+    def __init__(self, sm, energy_function, mover, stats_collector, rerun_prev_energy=False,
+                 cache_energy=True, early_rejection=False):
         """
         :param sm: A fess.builder.models.SpatialModel instance. The RNA that will be sampled.
         :param energy_function: A fess.builder.energy.CombinedEnergy instance.
                                 Used to evaluate the structure during the accept/reject step
         :param mover: A fess.builder.move.Mover instance.
                       It generated the next SpatialModel from the previous.
+        :param cache_energy: If True, do not re-evaluate the energy of the previous
+                             state after a rejected step, if neither the sampled stats
+                             nor the state of the energy function have changed.
+                             Furthermore, only energy contributions that depend on
+                             elements changed by the mover are re-evaluated.
+        :param early_rejection: If True, draw the random number for the Metropolis
+                             criterion before evaluating the energy and stop the
+                             energy evaluation as soon as a rejection is certain.
+                             This changes the sequence of random numbers used.
         """
         self.sm = sm
         self.mover = mover
         self.energy_function = energy_function
         self.stats_collector =  stats_collector
         self.rerun_prev_energy = rerun_prev_energy
+        self.cache_energy = cache_energy
+        self.early_rejection = early_rejection
         self.last_clashes=[]
         self.last_bad_mls=[]
 
         #: Store the previous energy.
         log.debug("MCMCSampler __init__ calling eval_energy")
-        self.prev_energy = energy_function.eval_energy(sm.bg, sampled_stats=sm.elem_defs)
+        self._prev_fingerprint = None
+        self.prev_energy = self._eval_prev_energy()
         log.info("Initial energy of the SpatialModel is {}".format(self.prev_energy))
         log.info("Junction energy is %s", {k:v.shortname for k,v in sm.junction_constraint_energy.items()})
         #: Store the previouse constituing energies (for StatisticsCollector)
@@ -49,7 +71,64 @@ class MCMCSampler:
         #: Keep track of the number of performed sampling steps.
         self.step_counter = 0
 
-    def eval_energy(self):
+    def _energy_fingerprint(self):
+        """
+        A fingerprint of the current state for caching the energy.
+
+        :returns: A tuple or None, if the energy cannot be cached.
+        """
+        if not self.cache_energy:
+            return None
+        state_key = self.energy_function.state_key()
+        if state_key is None:
+            return None
+        return self.sm, dict(self.sm.elem_defs), state_key
+
+    def _fingerprint_matches(self, fingerprint):
+        if fingerprint is None or self._prev_fingerprint is None:
+            return False
+        sm, elem_defs, state_key = fingerprint
+        prev_sm, prev_elem_defs, prev_state_key = self._prev_fingerprint
+        if sm is not prev_sm or state_key != prev_state_key:
+            return False
+        if len(elem_defs) != len(prev_elem_defs):
+            return False
+        # Stats are compared by identity. This is cheap and
+        # holding the references in the fingerprint keeps the ids unique.
+        return all(prev_elem_defs.get(elem) is stat for elem, stat in elem_defs.items())
+
+    def _eval_prev_energy(self):
+        """
+        Evaluate the energy of the current (accepted) state of self.sm,
+        unless it is known from the last evaluation.
+        """
+        fingerprint = self._energy_fingerprint()
+        if self._fingerprint_matches(fingerprint):
+            log.debug("Using cached energy %s", self.prev_energy)
+            return self.prev_energy
+        # The current structure is the accepted structure, so nothing changed.
+        if self.cache_energy:
+            changed = set()
+        else:
+            changed = None
+        energy = self.energy_function.eval_energy(self.sm.bg, sampled_stats=self.sm.elem_defs,
+                                                  changed=changed)
+        self._prev_fingerprint = fingerprint
+        return energy
+
+    def _changed_elements(self):
+        """
+        The elements changed by the last move (relative to the accepted structure)
+        or None, if the energy has to be evaluated for the whole structure.
+        """
+        if not self.cache_energy or not hasattr(self.mover, "changed_elements"):
+            return None
+        return self.mover.changed_elements()
+
+    def eval_energy(self, threshold=None):
+        """
+        :param threshold: See CombinedEnergy.eval_energy
+        """
         if self.sm.fulfills_constraint_energy():
             if self.sm.constraint_energy is None:
                 self.last_clashes="no_energy"
@@ -60,8 +139,14 @@ class MCMCSampler:
             else:
                 self.last_bad_mls=[]
             self.last_bad_mls=[]
-            return self.energy_function.eval_energy(self.sm.bg, sampled_stats=self.sm.elem_defs)
+            self._proposal_evaluated = True
+            kwargs = {}
+            if threshold is not None:
+                kwargs["threshold"] = threshold
+            return self.energy_function.eval_energy(self.sm.bg, sampled_stats=self.sm.elem_defs,
+                                                    changed=self._changed_elements(), **kwargs)
         else:
+            self._proposal_evaluated = False
             if self.sm.constraint_energy is None:
                 self.last_clashes="no_energy"
             else:
@@ -81,7 +166,7 @@ class MCMCSampler:
         self.step_counter += 1
         if self.rerun_prev_energy:
             # The energy of staying may get worse with every reject step
-            self.prev_energy = self.energy_function.eval_energy(self.sm.bg , sampled_stats=self.sm.elem_defs)
+            self.prev_energy = self._eval_prev_energy()
         #Make a sinle move (i.e. change the Spatial Model)
         movestring = self.mover.move(self.sm)
         # Accept or reject the new spatial model based on the energy.
@@ -99,6 +184,9 @@ class MCMCSampler:
         Evaluate the energy of self.sm and either accept or reject the new conformation.
         """
         log.debug("MCMCSampler accept_reject calling eval_energy")
+        self._proposal_fingerprint = self._energy_fingerprint()
+        if self.early_rejection:
+            return self._early_accept_reject()
         energy = self.eval_energy()
 
         movestring=[]
@@ -126,6 +214,35 @@ class MCMCSampler:
                 accepted = True
         return "".join(movestring), accepted
 
+    def _early_accept_reject(self):
+        """
+        Like accept_reject, but the random number is drawn first.
+
+        The move is accepted, if energy <= prev_energy - log(r),
+        which is equivalent to the Metropolis criterion. This threshold
+        is passed to the energy function, which may stop the evaluation early.
+        """
+        r = random.random()
+        if r > 0:
+            threshold = self.prev_energy - math.log(r)
+        else:
+            threshold = float("inf")
+        energy = self.eval_energy(threshold)
+
+        movestring=[]
+        movestring.append("{:.3f}".format(self.prev_energy))
+        movestring.append("->")
+        movestring.append("{:.3f};".format(energy))
+        if energy <= threshold:
+            movestring.append("A")
+            self.accept(energy)
+            accepted = True
+        else:
+            movestring.append("R")
+            self.reject()
+            accepted = False
+        return "".join(movestring), accepted
+
     def accept(self, energy):
         """
         :param energy: The energy of the accepted state.
@@ -133,8 +250,15 @@ class MCMCSampler:
         """
         # accept the new statistic
         self.prev_energy = energy
+        self._prev_fingerprint = getattr(self, "_proposal_fingerprint", None)
         self.prev_constituing =  self.energy_function.constituing_energies
+        if not getattr(self, "_proposal_evaluated", True):
+            # The cached contributions belong to a different structure.
+            self.energy_function.clear_cache()
+        self._proposal_evaluated = True
         self.energy_function.accept_last_measure()
+        if self.sm.constraint_energy is not None:
+            self.sm.constraint_energy.accept_last_measure()
         for e in self.energy_function.iterate_energies():
             if hasattr(e, "accepted_projDir"):
                 self.sm.bg.project_from=e.accepted_projDir
@@ -145,12 +269,333 @@ class MCMCSampler:
 
     def reject(self):
         self.energy_function.reject_last_measure()
+        if self.sm.constraint_energy is not None:
+            # E.g. the clash energy rolls back its index of the structure.
+            self.sm.constraint_energy.reject_last_measure()
+        self._revert_move()
+        # We need to recaluculate the prev_energy, because Energy might have been recalibrated.
+        # This is skipped, if the energy function reports an unchanged state.
+        log.debug("MCMCSampler After rejecting: reject calling eval_energy again")
+        self.prev_energy = self._eval_prev_energy()
+
+    def _revert_move(self):
         try:
             self.mover.revert(self.sm)
         except RuntimeError as e:
             raise
             #This warning will be ignored in ReplicaExchangeSimulations
             warnings.warn(e.message, NoopRevertWarning)
-        # We need to recaluculate the prev_energy, because Energy might have been recalibrated.
-        log.debug("MCMCSampler After rejecting: reject calling eval_energy again")
-        self.prev_energy = self.energy_function.eval_energy(self.sm.bg, sampled_stats=self.sm.elem_defs)
+
+    def close(self):
+        """
+        Release resources held by the sampler (e.g. worker processes).
+        """
+        pass
+
+
+def _iter_movers(mover):
+    """
+    Iterate over the mover and all movers contained in it (for a MixedMover).
+    """
+    yield mover
+    if isinstance(mover, MixedMover):
+        for m in mover.movers:
+            for sub_mover in _iter_movers(m):
+                yield sub_mover
+        if mover.moveAndRelML is not None:
+            yield mover.moveAndRelML
+
+
+def _logsumexp(values):
+    values = np.asarray(values, dtype=float)
+    m = np.max(values)
+    if m == -float("inf"):
+        return m
+    return m + np.log(np.sum(np.exp(values - m)))
+
+
+class _ProposalWorker(object):
+    """
+    Generates and scores proposals on its own copy of the SpatialModel.
+
+    The SpatialModel of the worker is kept at the accepted state of the sampler.
+    """
+    def __init__(self, sm, energy_function, mover):
+        self.sm = sm
+        self.energy_function = energy_function
+        self.mover = mover
+
+    def apply(self, deltas):
+        """
+        Update the accepted state.
+
+        :param deltas: A list of dictionaries {element: stat}
+        """
+        for delta in deltas:
+            self.sm.elem_defs.update(delta)
+            self.sm.rebuild_changed(list(delta))
+
+    def replay(self, events):
+        """
+        Repeat the accept/reject steps of the sampler on the energy function
+        of this worker, so reference distributions stay the same.
+
+        :param events: A list of tuples ("accept", measures) or ("reject", None),
+                       where measures is a list with the last measure of every
+                       energy in energy_function.iterate_energies()
+        """
+        for event, measures in events:
+            if event == "accept":
+                for energy, measure in zip(self.energy_function.iterate_energies(), measures):
+                    energy._last_measure = measure
+                self.energy_function.accept_last_measure()
+            else:
+                self.energy_function.reject_last_measure()
+
+    def _eval_energy(self):
+        if not self.sm.fulfills_constraint_energy():
+            return float("inf")
+        return self.energy_function.eval_energy(self.sm.bg, sampled_stats=self.sm.elem_defs)
+
+    def propose(self, base_delta, seeds):
+        """
+        Generate one proposal per seed and evaluate its energy.
+
+        :param base_delta: None or a dictionary {element: stat}. If given, the
+                           proposals start from the accepted state modified by base_delta.
+        :param seeds: A list of seeds for the random number generators.
+        :returns: A list of tuples (movestring, energy, delta), where delta is a
+                  dictionary {element: stat} of the stats changed by the proposal.
+        """
+        rng_state = random.getstate()
+        np_rng_state = np.random.get_state()
+        if base_delta:
+            prev_stats = { elem: self.sm.elem_defs[elem] for elem in base_delta }
+            snapshot = self.sm.snapshot(base_delta)
+            self.sm.elem_defs.update(base_delta)
+            self.sm.rebuild_changed(list(base_delta))
+        results = []
+        try:
+            for seed in seeds:
+                random.seed(seed)
+                np.random.seed(seed)
+                prev_defs = dict(self.sm.elem_defs)
+                movestring = self.mover.move(self.sm)
+                delta = { elem: stat for elem, stat in self.sm.elem_defs.items()
+                          if prev_defs.get(elem) is not stat }
+                energy = self._eval_energy()
+                self.mover.revert(self.sm)
+                results.append((movestring, energy, delta))
+        finally:
+            if base_delta:
+                self.sm.elem_defs.update(prev_stats)
+                self.sm.restore(snapshot)
+            random.setstate(rng_state)
+            np.random.set_state(np_rng_state)
+        return results
+
+
+def _worker_loop(worker, connection):
+    """
+    Executed in the worker processes of the MultipleTryMCMCSampler.
+
+    Only "propose" is answered. Errors during other commands are reported
+    with the next answer.
+    """
+    error = None
+    while True:
+        command, args = connection.recv()
+        if command == "close":
+            break
+        try:
+            result = getattr(worker, command)(*args)
+        except Exception:
+            log.exception("Error in worker process %s", os.getpid())
+            error = traceback.format_exc()
+            result = None
+        if command == "propose":
+            if error is not None:
+                connection.send(("error", error))
+            else:
+                connection.send(("ok", result))
+    connection.close()
+
+
+class MultipleTryMCMCSampler(MCMCSampler):
+    '''
+    Multiple-try Metropolis sampling (Liu, Liang and Wong, 2000).
+
+    In every step, num_tries proposals are generated with the mover and one of them
+    is selected with a probability proportional to its Boltzmann weight.
+    To keep detailed balance, num_tries-1 reference proposals are generated from
+    the selected proposal. Like the MCMCSampler, this assumes symmetric proposals.
+
+    The proposals are built and scored in parallel worker processes, each with
+    its own copy of the SpatialModel and the energy function.
+
+    ..warning::
+
+        Movers that change the minimum spanning tree of the RNA
+        (MSTchangingMover) are not supported and raise a ValueError.
+    '''
+    def __init__(self, sm, energy_function, mover, stats_collector, num_tries=4,
+                 processes=None, **kwargs):
+        """
+        For the other arguments, see MCMCSampler.
+
+        :param num_tries: The number of proposals per step.
+        :param processes: The number of worker processes. If this is None or 0,
+                          all proposals are evaluated in the main process.
+        """
+        if num_tries < 1:
+            raise ValueError("num_tries has to be at least 1")
+        if kwargs.get("early_rejection"):
+            raise ValueError("Early rejection is not supported by the MultipleTryMCMCSampler")
+        # Imported here, because importing _other_movers registers additional
+        # movers for the commandline.
+        from ._other_movers import MSTchangingMover
+        for m in _iter_movers(mover):
+            if isinstance(m, MSTchangingMover):
+                raise ValueError("Movers that change the minimum spanning tree are not "
+                                 "supported by the MultipleTryMCMCSampler")
+        super(MultipleTryMCMCSampler, self).__init__(sm, energy_function, mover,
+                                                     stats_collector, **kwargs)
+        self.num_tries = num_tries
+        #: The changes to the accepted state that were not yet sent to the workers.
+        self._pending_deltas = []
+        #: The accept/reject events that were not yet replayed by the workers.
+        self._pending_events = []
+        #: The elements changed by the last proposal applied to self.sm
+        self._applied_changed = None
+        #: The stats of the accepted state, as known to the workers.
+        self._worker_defs = dict(self.sm.elem_defs)
+        self._connections = []
+        self._processes = []
+        if processes:
+            for i in range(processes):
+                conn_main, conn_worker = Pipe()
+                worker = _ProposalWorker(self.sm, self.energy_function, self.mover)
+                p = Process(target=_worker_loop, args=(worker, conn_worker))
+                p.daemon = True
+                p.start()
+                conn_worker.close()
+                self._connections.append(conn_main)
+                self._processes.append(p)
+            self._local_worker = None
+        else:
+            # The energy function is shared with the local worker
+            self._local_worker = _ProposalWorker(copy.deepcopy(self.sm), self.energy_function,
+                                                 self.mover)
+
+    def close(self):
+        for conn in self._connections:
+            conn.send(("close", ()))
+            conn.close()
+        for p in self._processes:
+            p.join()
+        self._connections = []
+        self._processes = []
+
+    def _propose(self, base_delta, num):
+        """
+        Generate and score num proposals.
+
+        :returns: A list of tuples (movestring, energy, delta)
+        """
+        seeds = [ random.randint(0, 2**32-1) for i in range(num) ]
+        if self._local_worker is not None:
+            self._local_worker.apply(self._pending_deltas)
+            self._pending_deltas = []
+            return self._local_worker.propose(base_delta, seeds)
+        num_workers = len(self._connections)
+        for i, conn in enumerate(self._connections):
+            if self._pending_deltas:
+                conn.send(("apply", (self._pending_deltas,)))
+            if self._pending_events:
+                conn.send(("replay", (self._pending_events,)))
+            conn.send(("propose", (base_delta, seeds[i::num_workers])))
+        self._pending_deltas = []
+        self._pending_events = []
+        results = [None]*num
+        for i, conn in enumerate(self._connections):
+            status, result = conn.recv()
+            if status == "error":
+                raise RuntimeError("Error in worker process:\n{}".format(result))
+            results[i::num_workers] = result
+        return results
+
+    def _changed_elements(self):
+        if not self.cache_energy:
+            return None
+        return self._applied_changed
+
+    def _energy_measures(self):
+        return [ e._last_measure for e in self.energy_function.iterate_energies() ]
+
+    def step(self):
+        """
+        Make a single multiple-try sampling step.
+        """
+        self.step_counter += 1
+        if self.rerun_prev_energy:
+            self.prev_energy = self._eval_prev_energy()
+        proposals = self._propose(None, self.num_tries)
+        log_weights = -np.array([ energy for _, energy, _ in proposals ], dtype=float)
+        movestring = ["MTM{}:".format(len(proposals))]
+        if np.max(log_weights) == -float("inf"):
+            movestring.append("{:.3f}->inf;R".format(self.prev_energy))
+            self.reject()
+            accepted = False
+        else:
+            probabilities = np.exp(log_weights - np.max(log_weights))
+            probabilities /= np.sum(probabilities)
+            chosen = np.searchsorted(np.cumsum(probabilities), random.random(), side="right")
+            chosen = min(chosen, len(proposals)-1)
+            ms, energy, delta = proposals[chosen]
+            movestring.append(ms)
+            references = self._propose(delta, self.num_tries-1)
+            ref_log_weights = [ -ref_energy for _, ref_energy, _ in references ]
+            ref_log_weights.append(-self.prev_energy)
+            log_ratio = _logsumexp(log_weights) - _logsumexp(ref_log_weights)
+            movestring.append("{:.3f}->{:.3f};".format(self.prev_energy, energy))
+            if log_ratio >= 0 or random.random() <= math.exp(log_ratio):
+                self._apply_proposal(delta)
+                self._proposal_fingerprint = self._energy_fingerprint()
+                energy = self.eval_energy()
+                movestring.append("A")
+                self.accept(energy)
+                accepted = True
+            else:
+                movestring.append("R")
+                self.reject()
+                accepted = False
+        self.stats_collector.update_statistics( self.sm, self.prev_energy,
+                                                self.prev_constituing, "".join(movestring),
+                                                self.last_clashes,
+                                                self.last_bad_mls )
+        return accepted
+
+    def _apply_proposal(self, delta):
+        self._applied_changed = self.sm.affected_elements(delta)
+        self.sm.elem_defs.update(delta)
+        self.sm.rebuild_changed(list(delta))
+
+    def accept(self, energy):
+        super(MultipleTryMCMCSampler, self).accept(energy)
+        self._applied_changed = None
+        # accept may replace stats (e.g. for the FJC energy), so the delta is taken afterwards.
+        if self._local_worker is None:
+            self._pending_events.append(("accept", self._energy_measures()))
+        delta = { elem: stat for elem, stat in self.sm.elem_defs.items()
+                  if self._worker_defs.get(elem) is not stat }
+        self._pending_deltas.append(delta)
+        self._worker_defs = dict(self.sm.elem_defs)
+
+    def reject(self):
+        if self._local_worker is None:
+            self._pending_events.append(("reject", None))
+        super(MultipleTryMCMCSampler, self).reject()
+
+    def _revert_move(self):
+        # The proposals were never applied to self.sm
+        pass
@@ -6,10 +6,19 @@ from builtins import (ascii, bytes, chr, dict, filter, hex, input,
 import sys
 import random
 import math
+import bisect
 from collections import defaultdict
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
 import logging
 import string
+import os
 import os.path as op
+import json
+import hashlib
+import shutil
 
 import numpy as np
 
@@ -31,6 +40,19 @@ except ImportError:
         lru_cache = lambda *args, **kwargs: lambda x: x #No-op decorator taking arguments
 
 
+def _smaller_key(stat_type, key):
+    """
+    The next smaller key that is tried, if no stats exist for key, or None.
+    """
+    if stat_type == "loop" and key>3:
+        return key-1
+    elif stat_type == "angle" and (key[0]>0 or 1000>key[1]>0):
+        if 1000>key[1]>key[0]:
+            return (key[0], key[1]-1, key[2])
+        else:
+            return (key[0]-1, key[1], key[2])
+    return None
+
 def key_to_human_readable(key):
     try:
         if key[2]==1:
@@ -52,56 +74,578 @@ def patch_angtype(ang_type):
         return -math.copysign(6, ang_type)
     return ang_type
 
-def parse_stats_file(file_handle):
-    stats = {"stem": defaultdict(list),
-             "angle": defaultdict(list),
-             "loop": defaultdict(list), "3prime": defaultdict(list), "5prime": defaultdict(list)}
+def _parse_stat_line(line):
+    """
+    Parse a single (comment-free, stripped) line of a stats file.
+
+    :returns: A tuple `stat_type, key, stat` or None, if the stat should be ignored.
+    """
+    if line.startswith("stem"):
+        stem_stat = ftmstats.StemStat(line)
+        return "stem", stem_stat.bp_length, stem_stat
+    elif line.startswith("angle") or line.startswith("open") or line.startswith("pseudo"):
+        angle_stat = ftmstats.AngleStat()
+        try:
+            angle_stat.parse_line(line)
+        except Exception as e:
+            with log_to_exception(log, e):
+                log.error("Could not parse file due to error parsing line '{}'".format(line))
+            raise
+        if len(angle_stat.define) > 0 and angle_stat.define[0] == 1: #An angle at the beginning of a structure
+            #I guess this should never happen, if the stats do not stem from faulty bulge graphs.
+            log.error("Ignoring angle stat {} because it is at the beginning of a structure."
+                      " Does the stat come from a faulty BulgeGraph?".format(angle_stat.pdb_name))
+            return None
+        angle_stat.ang_type = patch_angtype(angle_stat.ang_type)
+        log.debug("Reading angle_stat with dimensions %s and %s, and type %s. With define %s", angle_stat.dim1, angle_stat.dim2, angle_stat.ang_type, angle_stat.define)
+        # Adding the reverse does not work as intended and produces a lot of structures
+        # that do not fulfill the constraint energy.
+        # stats["angle"][(angle_stat.dim1, angle_stat.dim2, -angle_stat.ang_type)].append(angle_stat)
+        # Note that CoarseGrainRNA.get_stats extracts two angle stats per angle.
+        return "angle", (angle_stat.dim1, angle_stat.dim2, angle_stat.ang_type), angle_stat
+    else:
+        key = line.split()[0]
+        if key not in ["3prime", "5prime", "loop"]:
+            raise ValueError("Illegal line in stats file: '{}'".format(line))
+        stat = ftmstats.LoopStat(line)
+        return key, stat.bp_length, stat
+
+def _iter_stat_lines(file_handle):
+    """
+    Yield the lines of a stats file with comments and whitespace removed.
+    """
     for line in file_handle:
         line=line.strip()
         if "#" in line:
-            line = line.split('#')[0]
+            line = line.split('#')[0].strip()
         if not line:
             continue
-        if line.startswith("stem"):
-            stem_stat = ftmstats.StemStat(line)
-            stats["stem"][stem_stat.bp_length].append(stem_stat)
-        elif line.startswith("angle") or line.startswith("open") or line.startswith("pseudo"):
-            angle_stat = ftmstats.AngleStat()
+        yield line
+
+def _empty_stats():
+    return {"stem": defaultdict(list),
+            "angle": defaultdict(list),
+            "loop": defaultdict(list), "3prime": defaultdict(list), "5prime": defaultdict(list)}
+
+def parse_stats_file(file_handle):
+    stats = _empty_stats()
+    for line in _iter_stat_lines(file_handle):
+        parsed = _parse_stat_line(line)
+        if parsed is None:
+            continue
+        stat_type, key, stat = parsed
+        stats[stat_type][key].append(stat)
+    return stats
+
+#: The geometric parameters of a stat in the columnar representation of stats.
+#: Parameters that do not exist for a stat type (e.g. the twist of an angle stat) are 0.
+STAT_PARAMS_DTYPE = np.dtype([(str(field), np.float64) for field in
+                              ["u", "v", "t", "r1", "u1", "v1", "twist", "length"]])
+
+def _stat_params(stat_type, stat):
+    """
+    The geometric parameters of stat as a tuple in the order of STAT_PARAMS_DTYPE.
+    """
+    if stat_type == "stem":
+        return (0., 0., 0., 0., 0., 0., stat.twist_angle, stat.phys_length)
+    elif stat_type == "angle":
+        return (stat.u, stat.v, stat.t, stat.r1, stat.u1, stat.v1, 0., 0.)
+    else:
+        return (stat.u, stat.v, 0., 0., 0., 0., 0., stat.phys_length)
+
+def _stat_seqs(stat):
+    """
+    The sequences of the strands of stat as a single string, separated by "&".
+
+    Stats without a `seqs` attribute (depending on the stat type and forgi version)
+    have an empty sequence.
+    """
+    return "&".join(getattr(stat, "seqs", []))
+
+class StatColumns(Sequence):
+    """
+    All stats of one stat type and key from one stats file in a columnar layout.
+
+    The geometric parameters (a structured array with the fields of
+    STAT_PARAMS_DTYPE), the pdb names, the defines (padded with -1)
+    and the sequences are available without creating any stat object.
+    The forgi stat objects are only created (by parsing the original line
+    of the stats file) when they are accessed and cached afterwards.
+    """
+    def __init__(self, stat_type, lines, params, pdb_names, defines, seqs):
+        """
+        :param lines: A sequence of the lines of the stats file (as text).
+        :param params: A structured array with dtype STAT_PARAMS_DTYPE.
+        :param pdb_names: A list of strings.
+        :param defines: An integer array of shape len(params) x define_length
+        :param seqs: A list of strings. The sequences of all strands of a stat,
+                     separated by "&" (see `_stat_seqs`)
+        """
+        self.stat_type = stat_type
+        self.lines = lines
+        self.params = params
+        self.pdb_names = pdb_names
+        self.defines = defines
+        self.seqs = seqs
+        self._stats = {} # Only the stats that were accessed.
+        self._encoded_strands = {}
+
+    def __len__(self):
+        return len(self.params)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i<0:
+            i+=len(self)
+        try:
+            return self._stats[i]
+        except KeyError:
+            if not 0<=i<len(self):
+                raise IndexError("StatColumns index out of range")
+            stat = self._stats[i] = _parse_stat_line(self.lines[i])[2]
+            return stat
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        try:
+            return len(self)==len(other) and all(a==b for a,b in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    def __repr__(self):
+        return "<StatColumns with {} {}-stats>".format(len(self), self.stat_type)
+
+    def encoded_strands(self, lengths):
+        """
+        The sequences of all stats, encoded by `_encode_strands` for strands
+        of the given lengths. They are only encoded once per lengths.
+        """
+        lengths = tuple(lengths)
+        if lengths not in self._encoded_strands:
+            self._encoded_strands[lengths] = _encode_strands([seqs.split("&") for seqs in self.seqs],
+                                                             lengths)
+        return self._encoded_strands[lengths]
+
+    @classmethod
+    def from_stats(cls, stat_type, lines, stats):
+        """
+        Create the columnar representation from parsed lines and the stat objects.
+
+        The stat objects are not kept, but recreated from the lines on demand.
+        """
+        params = np.array([_stat_params(stat_type, stat) for stat in stats], dtype=STAT_PARAMS_DTYPE)
+        define_len = max([len(getattr(stat, "define", [])) for stat in stats]+[1])
+        defines = np.full((len(stats), define_len), -1, dtype=np.int32)
+        for i, stat in enumerate(stats):
+            define = getattr(stat, "define", [])
+            defines[i, :len(define)] = define
+        return cls(stat_type, list(lines), params, [stat.pdb_name for stat in stats],
+                   defines, [_stat_seqs(stat) for stat in stats])
+
+class StatSelection(Sequence):
+    """
+    The stats that can be chosen for one stat type and key.
+
+    They are gathered from the StatColumns of one or more stats files
+    (only the rows not excluded, e.g. by a blacklist) without creating stat objects.
+    Like StatColumns, this behaves like a list of stats and creates a
+    stat object only when it is accessed.
+    """
+    def __init__(self, parts=()):
+        """
+        :param parts: A list of tuples `columns, rows`, where columns is a StatColumns
+                      instance and rows an array of the row indices used from it.
+        """
+        self._parts = []
+        self._starts = [0]
+        for columns, rows in parts:
+            self.add(columns, rows)
+
+    def add(self, columns, rows):
+        """
+        Append the given rows of the StatColumns columns.
+        """
+        self._parts.append((columns, np.asarray(rows, dtype=int)))
+        self._starts.append(self._starts[-1]+len(rows))
+        # Invalidate the concatenated arrays
+        self._params = None
+        self._pdb_names = None
+        self._seqs = None
+
+    def __len__(self):
+        return self._starts[-1]
+
+    def _locate(self, i):
+        if i<0:
+            i+=len(self)
+        if not 0<=i<len(self):
+            raise IndexError("StatSelection index out of range")
+        part = bisect.bisect_right(self._starts, i)-1
+        columns, rows = self._parts[part]
+        return columns, rows[i-self._starts[part]]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        columns, row = self._locate(i)
+        return columns[row]
+
+    def __iter__(self):
+        for columns, rows in self._parts:
+            for row in rows:
+                yield columns[row]
+
+    @property
+    def params(self):
+        """
+        The geometric parameters of all stats as one structured array (see STAT_PARAMS_DTYPE).
+        """
+        if self._params is None:
+            if self._parts:
+                self._params = np.concatenate([columns.params[rows] for columns, rows in self._parts])
+            else:
+                self._params = np.zeros(0, dtype=STAT_PARAMS_DTYPE)
+        return self._params
+
+    @property
+    def pdb_names(self):
+        """
+        The pdb_names of all stats.
+        """
+        if self._pdb_names is None:
+            self._pdb_names = [columns.pdb_names[row] for columns, rows in self._parts for row in rows]
+        return self._pdb_names
+
+    @property
+    def seqs(self):
+        """
+        The sequences of all stats (see `StatColumns`).
+        """
+        if self._seqs is None:
+            self._seqs = [columns.seqs[row] for columns, rows in self._parts for row in rows]
+        return self._seqs
+
+    def __repr__(self):
+        return "<StatSelection of {} stats>".format(len(self))
+
+    def subset(self, indices):
+        """
+        A new StatSelection with only the stats at the given (sorted) indices.
+        """
+        indices = np.asarray(indices, dtype=int)
+        parts = []
+        for part, (columns, rows) in enumerate(self._parts):
+            start, stop = self._starts[part], self._starts[part+1]
+            local = indices[(indices>=start)&(indices<stop)]-start
+            if len(local):
+                parts.append((columns, rows[local]))
+        return StatSelection(parts)
+
+    def to_columns(self, stat_type):
+        """
+        Copy the selected stats into a single new StatColumns instance.
+        """
+        define_len = max([columns.defines.shape[1] for columns, rows in self._parts]+[1])
+        defines = np.full((len(self), define_len), -1, dtype=np.int32)
+        lines = []
+        for part, (columns, rows) in enumerate(self._parts):
+            defines[self._starts[part]:self._starts[part+1], :columns.defines.shape[1]] = columns.defines[rows]
+            lines.extend(columns.lines[row] for row in rows)
+        return StatColumns(stat_type, lines, self.params.copy(), list(self.pdb_names), defines,
+                           list(self.seqs))
+
+class _StringTable(Sequence):
+    """
+    A read-only list of strings stored as one utf-8 encoded uint8 array and offsets.
+
+    The array may be memory mapped.
+    """
+    def __init__(self, buf, offsets):
+        self._buf = buf
+        self._offsets = offsets
+    def __len__(self):
+        return len(self._offsets)-1
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            return _StringTable(self._buf, self._offsets[start:stop+1])
+        if i<0:
+            i+=len(self)
+        return self._buf[self._offsets[i]:self._offsets[i+1]].tobytes().decode("utf-8")
+    def __iter__(self):
+        offsets = self._offsets.tolist()
+        if not offsets:
+            return
+        buf = self._buf[offsets[0]:offsets[-1]].tobytes()
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            yield buf[start-offsets[0]:stop-offsets[0]].decode("utf-8")
+    def __eq__(self, other):
+        try:
+            return list(self)==list(other)
+        except TypeError:
+            return NotImplemented
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+    def buffers(self):
+        """The byte buffer and offsets, ready for saving with numpy."""
+        start = self._offsets[0]
+        return self._buf[start:self._offsets[-1]], self._offsets-start
+
+#: Increase this, whenever the layout of the binary stats cache changes.
+STATS_CACHE_VERSION = 3
+
+def stats_cache_filename(filename):
+    """
+    The name of the binary cache (a directory) for the stats file `filename`.
+    """
+    return filename+".cache"
+
+def _file_signature(filename):
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime
+
+def _file_hash(filename):
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _columns_to_arrays(all_columns):
+    """
+    Concatenate the arrays of several StatColumns instances.
+
+    :returns: A dictionary of arrays (as stored by `_write_array_dir`) and
+              a list of the `(start, stop)` rows of every StatColumns instance.
+    """
+    bounds = []
+    start = 0
+    for columns in all_columns:
+        bounds.append((start, start+len(columns)))
+        start+=len(columns)
+    lines, line_offsets = _StringTable.from_strings([line for c in all_columns for line in c.lines]).buffers()
+    names, name_offsets = _StringTable.from_strings([name for c in all_columns for name in c.pdb_names]).buffers()
+    seqs, seq_offsets = _StringTable.from_strings([seq for c in all_columns for seq in c.seqs]).buffers()
+    define_len = max([c.defines.shape[1] for c in all_columns]+[1])
+    defines = np.full((start, define_len), -1, dtype=np.int32)
+    for (b_start, b_stop), columns in zip(bounds, all_columns):
+        defines[b_start:b_stop, :columns.defines.shape[1]] = columns.defines
+    if all_columns:
+        params = np.concatenate([c.params for c in all_columns])
+    else:
+        params = np.zeros(0, dtype=STAT_PARAMS_DTYPE)
+    return {"params": params, "defines": defines, "lines": lines, "line_offsets": line_offsets,
+            "names": names, "name_offsets": name_offsets, "seqs": seqs, "seq_offsets": seq_offsets}, bounds
+
+def _arrays_to_columns(stat_type, arrays, start, stop):
+    """
+    A StatColumns instance for the rows start to stop of the arrays loaded by `_read_array_dir`.
+    """
+    lines = _StringTable(arrays["lines"], arrays["line_offsets"])
+    names = _StringTable(arrays["names"], arrays["name_offsets"])
+    seqs = _StringTable(arrays["seqs"], arrays["seq_offsets"])
+    return StatColumns(stat_type, lines[start:stop], arrays["params"][start:stop],
+                       names[start:stop], arrays["defines"][start:stop], seqs[start:stop])
+
+def _write_array_dir(directory, meta, arrays):
+    """
+    Store numpy arrays as npy files and the dictionary meta as json in a new directory.
+
+    If the directory exists, it is replaced.
+    Failing to write it (e.g. for a read-only installation) is not an error.
+    """
+    tmp_dir = "{}.{}.tmp".format(directory, os.getpid())
+    try:
+        os.makedirs(tmp_dir)
+        with open(op.join(tmp_dir, "meta.json"), "wb") as f:
+            f.write(json.dumps(meta).encode("utf-8"))
+        for name, array in arrays.items():
+            np.save(op.join(tmp_dir, name+".npy"), array)
+        if op.isdir(directory):
+            # Processes using the old files keep them open until they are done.
+            shutil.rmtree(directory)
+        os.rename(tmp_dir, directory) # Atomic, if several processes write the cache.
+    except (IOError, OSError) as e:
+        log.info("Could not write cache %s: %s", directory, e)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+    log.info("Wrote cache %s", directory)
+    return True
+
+def _read_array_dir(directory):
+    """
+    Read a directory written by `_write_array_dir`.
+
+    The arrays are memory-mapped read-only, so all processes using
+    the same cache share the memory for it.
+
+    :returns: A tuple `meta, arrays`
+    """
+    with open(op.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+    arrays = {}
+    for name in os.listdir(directory):
+        if name.endswith(".npy"):
             try:
-                angle_stat.parse_line(line)
-            except Exception as e:
-                with log_to_exception(log, e):
-                    log.error("Could not parse file due to error parsing line '{}'".format(line))
-                raise
-            if len(angle_stat.define) > 0 and angle_stat.define[0] == 1: #An angle at the beginning of a structure
-                #I guess this should never happen, if the stats do not stem from faulty bulge graphs.
-                log.error("Ignoring angle stat {} because it is at the beginning of a structure."
-                          " Does the stat come from a faulty BulgeGraph?".format(angle_stat.pdb_name))
-                continue
-            angle_stat.ang_type = patch_angtype(angle_stat.ang_type)
-            log.debug("Reading angle_stat with dimensions %s and %s, and type %s. With define %s", angle_stat.dim1, angle_stat.dim2, angle_stat.ang_type, angle_stat.define)
-            stats["angle"][(angle_stat.dim1, angle_stat.dim2, angle_stat.ang_type)].append(angle_stat)
-            # Adding the reverse does not work as intended and produces a lot of structures
-            # that do not fulfill the constraint energy.
-            # stats["angle"][(angle_stat.dim1, angle_stat.dim2, -angle_stat.ang_type)].append(angle_stat)
-            # Note that CoarseGrainRNA.get_stats extracts two angle stats per angle.
-        else:
-            key = line.split()[0]
-            if key not in ["3prime", "5prime", "loop"]:
-                raise ValueError("Illegal line in stats file: '{}'".format(line))
-            stat = ftmstats.LoopStat(line)
-            stats[key][stat.bp_length].append(stat)
+                arrays[name[:-4]] = np.load(op.join(directory, name), mmap_mode="r")
+            except ValueError: # Empty arrays cannot be mapped
+                arrays[name[:-4]] = np.load(op.join(directory, name))
+    return meta, arrays
+
+def _write_stats_cache(filename, stats):
+    """
+    Store the (columnar) stats read from filename in a binary cache next to it.
+    """
+    size, mtime = _file_signature(filename)
+    buckets = []
+    all_columns = []
+    for stat_type in sorted(stats):
+        for key, columns in stats[stat_type].items():
+            buckets.append([stat_type, key])
+            all_columns.append(columns)
+    arrays, bounds = _columns_to_arrays(all_columns)
+    meta = {"version": STATS_CACHE_VERSION, "size": size, "mtime": mtime,
+            "sha1": _file_hash(filename),
+            "buckets": [bucket+list(bound) for bucket, bound in zip(buckets, bounds)]}
+    return _write_array_dir(stats_cache_filename(filename), meta, arrays)
+
+def _json_key(key):
+    if isinstance(key, list):
+        return tuple(_json_key(k) for k in key)
+    return key
+
+def _load_stats_cache(filename):
+    """
+    Load the columnar stats from the binary cache of the stats file `filename`.
+
+    :returns: The stats in the same layout as returned by `read_stats_file` or
+              None, if no valid cache exists.
+    """
+    cache_dir = stats_cache_filename(filename)
+    if not op.isdir(cache_dir):
+        return None
+    try:
+        meta, arrays = _read_array_dir(cache_dir)
+        if meta["version"] != STATS_CACHE_VERSION:
+            log.info("Stats cache %s has an outdated format.", cache_dir)
+            return None
+        if [meta["size"], meta["mtime"]] != list(_file_signature(filename)):
+            # The file might have only been touched or copied.
+            if meta["sha1"] != _file_hash(filename):
+                log.info("Stats cache %s is outdated.", cache_dir)
+                return None
+        stats = _empty_stats()
+        for stat_type, key, start, stop in meta["buckets"]:
+            stats[stat_type][_json_key(key)] = _arrays_to_columns(stat_type, arrays, start, stop)
+    except (IOError, OSError, ValueError, KeyError) as e:
+        log.info("Could not read stats cache %s: %s", cache_dir, e)
+        return None
+    log.info("Loaded stats from cache %s", cache_dir)
     return stats
 
 def read_stats_file(filename):
+    """
+    Read a stats file.
+
+    The parsed stats are stored in a binary cache next to the file, which is used
+    on subsequent calls, as long as the stats file is unchanged.
+    The arrays in the cache are memory mapped and thus shared by all processes
+    reading the same stats file.
+
+    :returns: A dictionary `{stat_type: {key: StatColumns}}`.
+              The StatColumns behave like lists of stats.
+    """
     log.info("Reading stats-file %s", filename)
+    stats = _load_stats_cache(filename)
+    if stats is not None:
+        return stats
+    lines = defaultdict(lambda: defaultdict(list))
+    parsed_stats = _empty_stats()
     with open (filename) as f:
         try:
-            return parse_stats_file(f)
+            for line in _iter_stat_lines(f):
+                parsed = _parse_stat_line(line)
+                if parsed is None:
+                    continue
+                stat_type, key, stat = parsed
+                parsed_stats[stat_type][key].append(stat)
+                lines[stat_type][key].append(line)
         except Exception as e:
             with log_to_exception(log, e):
                 log.error("Failed to parse file %s", filename)
             raise
+    stats = _empty_stats()
+    for stat_type, by_key in parsed_stats.items():
+        for key, stat_list in by_key.items():
+            stats[stat_type][key] = StatColumns.from_stats(stat_type, lines[stat_type][key], stat_list)
+    if _write_stats_cache(filename, stats):
+        # Use the memory mapped arrays (shared with other processes) instead.
+        stats = _load_stats_cache(filename) or stats
+    return stats
+
+def _write_candidate_cache(cache_dir, candidates):
+    """
+    Store the possible stats (with weights) for several keys in a binary cache.
+
+    :param candidates: A dictionary `(stat_type, key, min_entries): (weights, StatSelection)`
+    """
+    entries = []
+    all_columns = []
+    all_weights = []
+    for (stat_type, key, min_entries), (weights, stats) in candidates.items():
+        entries.append([stat_type, key, min_entries])
+        all_columns.append(stats.to_columns(stat_type))
+        all_weights.extend(weights)
+    arrays, bounds = _columns_to_arrays(all_columns)
+    arrays["weights"] = np.array(all_weights, dtype=float)
+    meta = {"version": STATS_CACHE_VERSION,
+            "entries": [entry+list(bound) for entry, bound in zip(entries, bounds)]}
+    return _write_array_dir(cache_dir, meta, arrays)
+
+def _load_candidate_cache(cache_dir):
+    """
+    Load the possible stats written by `_write_candidate_cache`.
+
+    :returns: A dictionary `(stat_type, key, min_entries): (weights, StatSelection)`
+              or None, if the cache does not exist or cannot be read.
+    """
+    if not op.isdir(cache_dir):
+        return None
+    try:
+        meta, arrays = _read_array_dir(cache_dir)
+        if meta["version"] != STATS_CACHE_VERSION:
+            return None
+        candidates = {}
+        for stat_type, key, min_entries, start, stop in meta["entries"]:
+            columns = _arrays_to_columns(stat_type, arrays, start, stop)
+            candidates[(stat_type, _json_key(key), min_entries)] = (arrays["weights"][start:stop].tolist(),
+                                                                   StatSelection([(columns, np.arange(stop-start))]))
+    except (IOError, OSError, ValueError, KeyError) as e:
+        log.warning("Could not read stat candidate cache %s: %s", cache_dir, e)
+        return None
+    log.info("Loaded stat candidate cache %s", cache_dir)
+    return candidates
 
 letter_to_stat_type = {
     "s": "stem",
@@ -139,35 +683,82 @@ def make_continuous( discrete_angle_stats):
         print("Singular matrix, dimensions:", dims, file=sys.stderr)
 
 class ContinuouseStatSampler:
+    #: The number of samples generated at once.
+    block_size = 1024
+
     def __init__(self, all_stats, key):
-        kde = make_continuous(all_stats)
-        self.kde = kde
+        import scipy.stats as ss
         self.key = key
         data=[]
         for d in all_stats:
             data += [[d.u, d.v, d.t, d.r1, d.u1, d.v1]]
+        if len(data) < 3:
+            raise ValueError("Insufficient stats to make continuouse")
         self.data = np.array(data)
-    def sample(self):
-        import scipy.stats as ss
         log.debug("DATA %s with shape %s", self.data, self.data.shape)
-        r1 = ss.gaussian_kde(self.data[:, 3]).resample(1)[0][0]
-        log.debug("r1 is %s", r1)
-        rnd = np.random.rand(5) # 5 random values from 0 to 1
-        u = rnd[0]*np.pi
-        v = rnd[1]*2*np.pi-np.pi
-        t = rnd[2]*2*np.pi-np.pi
-        u1 = rnd[3]*np.pi
-        v1 = rnd[4]*2*np.pi-np.pi
-
-        #sample = self.kde.resample(1).T
+        self.r1_kde = ss.gaussian_kde(self.data[:, 3])
+        self._samples = np.zeros((0, 6))
+        self._next_sample = 0
+
+    def _generate_samples(self):
+        """
+        Pregenerate the next block of samples (u, v, t, r1, u1, v1)
+        """
+        samples = np.empty((self.block_size, 6))
+        rnd = np.random.rand(self.block_size, 5) # 5 random values from 0 to 1 per sample
+        samples[:,0] = rnd[:,0]*np.pi                 # u
+        samples[:,1] = rnd[:,1]*2*np.pi-np.pi         # v
+        samples[:,2] = rnd[:,2]*2*np.pi-np.pi         # t
+        samples[:,3] = self.r1_kde.resample(self.block_size)[0] # r1
+        samples[:,4] = rnd[:,3]*np.pi                 # u1
+        samples[:,5] = rnd[:,4]*2*np.pi-np.pi         # v1
+        self._samples = samples
+        self._next_sample = 0
+
+    def sample(self):
+        if self._next_sample>=len(self._samples):
+            self._generate_samples()
+        u,v,t,r1,u1,v1 = self._samples[self._next_sample]
+        self._next_sample+=1
         log.debug("continuouse stat sample %s", (u,v,t,r1,u1,v1))
-        #u,v,t,r1,u1,v1 = sample[0]
         stat = ftmstats.AngleStat(stat_type="angle", pdb_name='cont-{:.1f}_{:.1f}_{:.1f}_{:.1f}_{:.1f}_{:.1f}'.format(u,v,t,r1,u1,v1),
                                 dim1=self.key[0], dim2=self.key[1], u=u, v=v, t=t, r1=r1, u1=u1, v1=v1,
                                 ang_type=self.key[2], define=[], seq="", vres={})
         return stat
 
 
+def junction_closure_feasibility(stat_source, cg, elem, stats, min_entries=100):
+    """
+    A feasibility test for `StatStorage.prefilter`.
+
+    A multiloop segment can only be part of a closed junction, if its r1 is
+    not larger than the sum of the largest r1 possible for all other segments
+    of the junction (the triangle test of FragmentBasedJunctionClosureEnergy.precheck).
+
+    :returns: A boolean array (True for feasible stats) or None, if elem is
+              not part of a regular multiloop.
+    """
+    if elem[0]!="m":
+        return None
+    for loop in cg.find_mlonly_multiloops():
+        if elem in loop and "regular_multiloop" in cg.describe_multiloop(loop):
+            break
+    else:
+        return None
+    max_r1_sum = 0
+    for other in loop:
+        if other == elem:
+            continue
+        if other in stat_source.continuouse:
+            return None
+        key = stat_source.key_from_bg_and_elem(cg, other)
+        try:
+            _, _, other_stats = stat_source._sampling_weights("angle", key, min_entries)
+        except LookupError:
+            return None
+        max_r1_sum += np.max(other_stats.params["r1"])
+    return stats.params["r1"] <= max_r1_sum
+
 class StatStorage(object):
     def __init__(self, filename, fallback_filenames = None, continuouse=None, blacklist=[]):
         self.filename = filename
@@ -175,6 +766,13 @@ class StatStorage(object):
             fallback_filenames = []
         self.fallbacks = fallback_filenames
         self._sources = None
+        self._name_index = {}
+        self._stat_buckets = None
+        self._resolved_keys = {}
+        self._stored_candidates = {}
+        self._element_weights = {}
+        self._cumulative_weights = {}
+        self._statsamplers = {}
         self._has_reported = set() #Only emit warnings about insufficient stats once.
         if continuouse:
             if any(elem[0] not in "mi" for elem in continuouse):
@@ -185,7 +783,9 @@ class StatStorage(object):
         self.blacklist=blacklist
 
     def in_blacklist(self, stat):
-        statname = stat.pdb_name
+        return self._name_in_blacklist(stat.pdb_name)
+
+    def _name_in_blacklist(self, statname):
         for pattern in self.blacklist:
             if pattern in statname:
                 return True
@@ -209,6 +809,14 @@ class StatStorage(object):
                   bg.get_node_dimensions(elem, with_missing=True))
         return key
 
+    @staticmethod
+    def _structural_key(key):
+        """
+        The part of a key returned by `key_from_bg_and_elem`,
+        under which the stats are stored in the stats files.
+        """
+        return key
+
     def _iter_stat_sources(self):
         if self._sources is None:
             self._sources = [read_stats_file(self.filename)]
@@ -216,77 +824,217 @@ class StatStorage(object):
             if i>=len(self._sources):
                 self._sources.append(read_stats_file(self.fallbacks[i-1]))
             yield self._sources[i]
-        raise StopIteration
 
     @lru_cache(maxsize = 128)
     def _possible_stats(self, stat_type, key, min_entries=100, strict=False, enable_logging=True):
-        try:
-            return self._possible_stats_inner(stat_type, key, min_entries, strict, enable_logging=enable_logging)
-        except RuntimeError as e:
-            if "recursion" not in str(e):
-                raise
-            # Maximum recursion depth exceeded.
-            raise LookupError("No stats found for {} with key {}, even after reducing length.".format(stat_type, key))
+        if not strict and (stat_type, key, min_entries) in self._stored_candidates:
+            return self._stored_candidates[(stat_type, key, min_entries)]
+        return self._possible_stats_inner(stat_type, key, min_entries, strict, enable_logging=enable_logging)
+
+    def candidate_cache_filename(self, cg, cache_dir, min_entries=100):
+        """
+        The file in cache_dir that stores the possible stats for all elements of cg.
+
+        The filename is a hash of everything that influences the possible stats:
+        The content of all stats files, the blacklist, min_entries and
+        the keys of all elements of cg.
+        """
+        sha = hashlib.sha1()
+        sha.update(json.dumps([type(self).__name__, STATS_CACHE_VERSION, min_entries,
+                               sorted(self.blacklist),
+                               [_file_hash(fn) for fn in [self.filename]+self.fallbacks],
+                               [ [elem, self.key_from_bg_and_elem(cg, elem)]
+                                 for elem in sorted(cg.defines) ] ]).encode("utf-8"))
+        return op.join(cache_dir, "stat_candidates_{}".format(sha.hexdigest()))
+
+    def use_candidate_cache(self, cg, cache_dir, min_entries=100):
+        """
+        Use a cache in cache_dir for the possible stats of all elements of cg.
+
+        If the cache exists, the stats files are not read at all for sampling these
+        elements. Otherwise the possible stats are calculated and stored in the cache
+        for subsequent runs.
+        """
+        cache_file = self.candidate_cache_filename(cg, cache_dir, min_entries)
+        candidates = _load_candidate_cache(cache_file)
+        if candidates is None:
+            candidates = {}
+            for elem in cg.defines:
+                stat_type = letter_to_stat_type[elem[0]]
+                key = self.key_from_bg_and_elem(cg, elem)
+                try:
+                    candidates[(stat_type, key, min_entries)] = self._possible_stats(stat_type, key, min_entries)
+                except LookupError:
+                    pass # Will raise again when stats are sampled.
+            if _write_candidate_cache(cache_file, candidates):
+                # Use the memory mapped arrays (shared with other processes) instead.
+                candidates = _load_candidate_cache(cache_file) or candidates
+        self._stored_candidates.update(candidates)
+
+    def _sampling_weights(self, stat_type, key, min_entries=100):
+        """
+        The possible stats with their weights as an array and the cumulative weights.
+
+        They are calculated once for every key (and not evicted, because
+        sequence dependent keys are different for every element of the RNA).
+
+        :returns: A tuple `weights, cumulative_weights, stats`
+        """
+        if (stat_type, key, min_entries) not in self._cumulative_weights:
+            weights, stats = self._possible_stats(stat_type, key, min_entries)
+            weights = np.asarray(weights, dtype=float)
+            self._cumulative_weights[(stat_type, key, min_entries)] = (weights, np.cumsum(weights), stats)
+        return self._cumulative_weights[(stat_type, key, min_entries)]
+
+    def _allowed_rows(self, columns):
+        """
+        The indices of all rows of the StatColumns columns that are not blacklisted.
+        """
+        if not self.blacklist:
+            return np.arange(len(columns))
+        return np.array([ i for i, name in enumerate(columns.pdb_names)
+                          if not self._name_in_blacklist(name) ], dtype=int)
+
+    def _get_stat_buckets(self):
+        """
+        A dictionary `{stat_type: {key: [(columns, rows), ...]}}` with the
+        StatColumns of all stats files (in the order of the files) that
+        contain stats for this key and the rows that are not blacklisted.
+
+        It is built once, when it is first needed.
+        """
+        if self._stat_buckets is None:
+            self._stat_buckets = defaultdict(dict)
+            for source in self._iter_stat_sources():
+                for stat_type, by_key in source.items():
+                    for key, columns in by_key.items():
+                        rows = self._allowed_rows(columns)
+                        if len(rows):
+                            self._stat_buckets[stat_type].setdefault(key, []).append((columns, rows))
+        return self._stat_buckets
+
+    def _resolve_key(self, stat_type, key, min_entries=100, strict=False, enable_logging=True):
+        """
+        The key that is used for looking up stats for the requested key.
+
+        If no stats exist for the key and strict is False, this is the next smaller key,
+        for which stats exist. The result is stored in a table, so subsequent
+        lookups are a single dictionary access.
+        """
+        if (stat_type, key, strict) not in self._resolved_keys:
+            buckets = self._get_stat_buckets()[stat_type]
+            new_key = key
+            while new_key not in buckets:
+                smaller_key = None if strict else _smaller_key(stat_type, new_key)
+                if smaller_key is None:
+                    # If everything else fails, raise an error even if strict was disabled.
+                    raise LookupError("No stats found for {} with key {}".format(stat_type, new_key))
+                if enable_logging and (stat_type, new_key, min_entries) not in self._has_reported:
+                    log.error("Trying %s instead of %s for %s-stat", key_to_human_readable(smaller_key), key_to_human_readable(new_key), stat_type)
+                    self._has_reported.add((stat_type, new_key, min_entries))
+                new_key = smaller_key
+            self._resolved_keys[(stat_type, key, strict)] = new_key
+        return self._resolved_keys[(stat_type, key, strict)]
 
     def _possible_stats_inner(self, stat_type, key, min_entries = 100, strict=False, enable_logging=True):
         """
-        :returns: Two lists, `weights` and `choose_from` of the same length.
-                  weights is a list of floats, choose_from is a list of stats.
+        :returns: A list `weights` and a StatSelection `choose_from` of the same length.
+                  weights is a list of floats, choose_from behaves like a list of stats.
         """
         has_reported=False
-        choose_from = []
+        key = self._resolve_key(stat_type, key, min_entries, strict, enable_logging)
+        choose_from = StatSelection()
         weights = []
-        statfiles = self._iter_stat_sources()
-        while sum(weights)<min_entries:
-            try:
-                sf = next(statfiles)
-                source = sf[stat_type]
-            except StopIteration: #All stat_files exhausted
-                if enable_logging and len(choose_from)<min_entries and (stat_type, key, min_entries) not in self._has_reported:
-                    log.warning("Only {} {}-stats found for {}".format(len(choose_from), stat_type, key_to_human_readable(key)))
-                    has_reported = True
+        for columns, rows in self._get_stat_buckets()[stat_type][key]:
+            if sum(weights)>=min_entries:
                 break
-            if key in source:
-                stats=[ stat for stat in source[key] if not self.in_blacklist(stat) ]
-                num_stats = len(stats)
-                if enable_logging:
-                    log.info("Appending {} stats from source {} for {}.".format(len(stats),id( sf), key))
-                choose_from.extend(stats)
-                if not weights:
-                    weight = 1 #All stats from the first stat_source always has weight 1, even if there are more than min_entries stats.
-                else:
-                    remaining_total_weight = min_entries - sum(weights)
-                    weight = min(1, remaining_total_weight/len(stats))
-                weights += [weight]*num_stats
+            num_stats = len(rows)
+            if enable_logging:
+                log.info("Appending {} stats from source {} for {}.".format(num_stats, id(columns), key))
+            choose_from.add(columns, rows)
+            if not weights:
+                weight = 1 #All stats from the first stat_source always has weight 1, even if there are more than min_entries stats.
             else:
-                if enable_logging:
-                     log.info("Appending NO stats from source {} for {}.".format(id( sf), key))
+                remaining_total_weight = min_entries - sum(weights)
+                weight = min(1, remaining_total_weight/num_stats)
+            weights += [weight]*num_stats
+        else:
+            #All stat_files exhausted
+            if enable_logging and len(choose_from)<min_entries and (stat_type, key, min_entries) not in self._has_reported:
+                log.warning("Only {} {}-stats found for {}".format(len(choose_from), stat_type, key_to_human_readable(key)))
+                has_reported = True
         if enable_logging and (stat_type, key, min_entries) not in self._has_reported:
             log.info("Found {} stats for {} with key {}".format(len(choose_from), stat_type, key))
             has_reported = True
 
-        if not choose_from:
-            if not strict: # Fallback to the next smaller stat, until all options are exhausted.
-                if stat_type == "loop" and key>3:
-                    if enable_logging and (stat_type, key, min_entries) not in self._has_reported:
-                        log.error("Trying %s instead of %s for %s-stat", key_to_human_readable(key-1), key_to_human_readable(key), stat_type)
-                        self._has_reported.add((stat_type, key, min_entries))
-                    return self._possible_stats_inner(stat_type, key-1, min_entries, strict, enable_logging)
-                elif stat_type == "angle" and (key[0]>0 or 1000>key[1]>0):
-                    if 1000>key[1]>key[0]:
-                        new_key = (key[0], key[1]-1, key[2])
-                    else:
-                        new_key = (key[0]-1, key[1], key[2])
-                    if enable_logging and (stat_type, key, min_entries) not in self._has_reported:
-                        log.error("Trying key %s instead of %s for %s-stat", key_to_human_readable(new_key), key_to_human_readable(key), stat_type)
-                        self._has_reported.add((stat_type, key, min_entries))
-                    return self._possible_stats_inner(stat_type, new_key, min_entries, strict, enable_logging)
-            # If everything else fails, raise an error even if strict was disabled.
-            raise LookupError("No stats found for {} with key {}".format(stat_type, key))
         if has_reported:
             self._has_reported.add((stat_type, key, min_entries))
         return weights, choose_from
 
+    def _element_sampling_weights(self, bg, elem, min_entries = 100):
+        """
+        Like `_sampling_weights`, but for an element of bg.
+
+        This takes the result of `self.prefilter` into account.
+
+        :returns: A tuple `weights, cumulative_weights, stats`
+        """
+        key = self.key_from_bg_and_elem(bg, elem)
+        try:
+            prefiltered_key, prefiltered_min_entries, weights = self._element_weights[elem]
+        except KeyError:
+            pass
+        else:
+            if prefiltered_key==key and prefiltered_min_entries==min_entries:
+                return weights
+        log.debug("Calling _possible_stats with %r, %r", letter_to_stat_type[elem[0]], key)
+        return self._sampling_weights(letter_to_stat_type[elem[0]], key, min_entries)
+
+    def prefilter(self, cg, feasibility_tests = None, min_entries = 100, infeasible_weight = 0.):
+        """
+        Remove (or down-weight) stats that are infeasible for an element of cg,
+        independent of the stats used for all other elements.
+
+        This affects sample_for, sample_many, iterate_stats_for and coverage_for for
+        the elements of cg.
+
+        :param feasibility_tests: A list of functions with the signature
+                        `test(stat_source, cg, elem, stats, min_entries)`, where stats
+                        is a StatSelection. They return a boolean array (True for
+                        feasible stats) or None, if they do not apply to elem.
+                        Defaults to `[junction_closure_feasibility]`
+        :param infeasible_weight: The factor for the weight of infeasible stats.
+                        If this is 0, infeasible stats are removed.
+        """
+        if feasibility_tests is None:
+            feasibility_tests = [junction_closure_feasibility]
+        for elem in sorted(cg.defines):
+            if elem in self.continuouse:
+                continue
+            key = self.key_from_bg_and_elem(cg, elem)
+            try:
+                weights, _, stats = self._sampling_weights(letter_to_stat_type[elem[0]], key, min_entries)
+            except LookupError:
+                continue
+            feasible = np.ones(len(stats), dtype=bool)
+            for test in feasibility_tests:
+                result = test(self, cg, elem, stats, min_entries)
+                if result is not None:
+                    feasible &= result
+            if np.all(feasible):
+                continue
+            if not np.any(feasible):
+                log.warning("All %d stats for %s are infeasible. Not filtering them.", len(stats), elem)
+                continue
+            log.info("%d of %d stats for %s are infeasible", len(stats)-np.sum(feasible), len(stats), elem)
+            if infeasible_weight == 0:
+                indices = np.flatnonzero(feasible)
+                weights = weights[indices]
+                stats = stats.subset(indices)
+            else:
+                weights = np.where(feasible, weights, weights*infeasible_weight)
+            self._element_weights[elem] = (key, min_entries, (weights, np.cumsum(weights), stats))
+
     def sample_for(self, bg, elem, min_entries = 100):
         """
         Sample a stat for the given coarse-grained element elem of bulge graph bg.
@@ -309,17 +1057,31 @@ class StatStorage(object):
         if elem in self.continuouse:
             return self._sample_continuouse_stat(bg, elem, min_entries)
         else:
+            _, cumulative_weights, stats = self._element_sampling_weights(bg, elem, min_entries)
+            r = random.uniform(0, cumulative_weights[-1])
+            # The first stat with r <= the cumulative weight.
+            i = min(np.searchsorted(cumulative_weights, r), len(stats)-1)
+            # TODO: Penalize stats found with JARED, but for another loop
+            return stats[i]
+
+    def sample_many(self, bg, elem, n, min_entries = 100):
+        """
+        Sample n stats for the element elem of bulge graph bg.
+
+        This is equivalent to calling `self.sample_for` n times,
+        but uses one call to numpy's random number generator.
+
+        :param n: The number of stats to sample (with replacement)
+        :returns: A list of n Stat objects.
+        """
+        if elem in self.continuouse:
             key = self.key_from_bg_and_elem(bg, elem)
-            log.debug("Calling _possible_stats with %r, %r", letter_to_stat_type[elem[0]], key)
-            weights, stats = self._possible_stats(letter_to_stat_type[elem[0]], key, min_entries)
-            r = random.uniform(0, sum(weights))
-            for i, w in enumerate(weights):
-                if r<=w:
-                    # TODO: Penalize stats found with JARED, but for another loop
-                    return stats[i]
-                r-=w
-            assert False
-            return stats[0] #Fallback if asserts are disabled. Should be unreachable.
+            kde = self._get_statsampler(letter_to_stat_type[elem[0]], key, min_entries)
+            return [ kde.sample() for _ in range(n) ]
+        _, cumulative_weights, stats = self._element_sampling_weights(bg, elem, min_entries)
+        r = np.random.uniform(0, cumulative_weights[-1], size=n)
+        indices = np.minimum(np.searchsorted(cumulative_weights, r), len(stats)-1)
+        return [ stats[i] for i in indices ]
 
     def _sample_continuouse_stat(self, bg, elem, min_entries=100):
         key = self.key_from_bg_and_elem(bg, elem)
@@ -334,35 +1096,66 @@ class StatStorage(object):
             yield kde.sample()
 
     def _get_statsampler(self, stat_type, key, min_entries):
-        log.debug("Getting continuouse kde-based sampler for %s", key)
-        all_stats = list(self.iterate_stats(stat_type, key, min_entries, False))
-        return ContinuouseStatSampler(all_stats, key)
+        """
+        The ContinuouseStatSampler for the key. It is shared by all elements with this key.
+        """
+        if (stat_type, key, min_entries) not in self._statsamplers:
+            log.debug("Creating continuouse kde-based sampler for %s", key)
+            all_stats = list(self.iterate_stats(stat_type, key, min_entries, False))
+            self._statsamplers[(stat_type, key, min_entries)] = ContinuouseStatSampler(all_stats, key)
+        return self._statsamplers[(stat_type, key, min_entries)]
 
     def iterate_stats(self, stat_type, key, min_entries = 100, cycle = False):
-        weights, stats = self._possible_stats(stat_type, key, min_entries)
-        stat_samples = []
-        for i, w in enumerate(weights):
-            r = random.random()
-            if r<=w:
-                stat_samples.append(stats[i])
+        weights, _, stats = self._sampling_weights(stat_type, key, min_entries)
+        return self._iterate_weighted(weights, stats, cycle)
+
+    @staticmethod
+    def _iterate_weighted(weights, stats, cycle = False):
+        # Every stat is used with a probability equal to its weight (capped at 1).
+        stat_samples = np.flatnonzero(np.random.random(len(weights))<=weights)
         while True:
-            for stat in stat_samples:
-                yield stat
+            for i in stat_samples:
+                yield stats[i] # The stat object is only created here
             if not cycle:
                 break #Exhaust the generator
 
+    def _get_name_index(self, stat_type, key):
+        """
+        A dictionary `pdb_name: [(columns, row), ...]` for the (not blacklisted)
+        stats of all stat files with the given stat_type and key.
+
+        It is built for every key, when it is first needed. Thus only the
+        keys of elements that are actually loaded are indexed.
+        """
+        if (stat_type, key) not in self._name_index:
+            index = defaultdict(list)
+            for columns, rows in self._get_stat_buckets()[stat_type].get(key, []):
+                names = list(columns.pdb_names)
+                for row in rows:
+                    index[names[row]].append((columns, row))
+            self._name_index[(stat_type, key)] = index
+        return self._name_index[(stat_type, key)]
+
     def load_stat_by_name(self, bg, elem, name):
         key = self.key_from_bg_and_elem(bg, elem)
-        
-        _, stats = self._possible_stats(letter_to_stat_type[elem[0]], key, min_entries=float('inf'), enable_logging=False)
+        stat_type = letter_to_stat_type[elem[0]]
+        index = self._get_name_index(stat_type, self._structural_key(key))
+        if name in index:
+            found = index[name]
+            assert len(found)==1
+            columns, row = found[0]
+            return columns[row]
+        # The stat might have been sampled with a fallback key
+        # (if no stats exist for the key of the element)
+        _, stats = self._possible_stats(stat_type, key, min_entries=float('inf'), enable_logging=False)
         found=None
-        for stat in stats:
-            if stat.pdb_name == name:
+        for i, pdb_name in enumerate(stats.pdb_names):
+            if pdb_name == name:
                 assert found is None
-                found=stat
-        if not found:
-            raise RuntimeError("Cannot load stat %s for elem %s. Maybe a different stat file or different cg was used?")
-        return found
+                found=i
+        if found is None:
+            raise RuntimeError("Cannot load stat {} for elem {}. Maybe a different stat file or different cg was used?".format(name, elem))
+        return stats[found]
 
 
     def iterate_stats_for(self, bg, elem, min_entries = 100, cycle = False):
@@ -377,10 +1170,9 @@ class StatStorage(object):
             for stat in self._iterate_continuouse_stat(bg, elem, min_entries):
                 yield stat
         else:
-            key = self.key_from_bg_and_elem(bg, elem)
-            log.debug("Key is %s, elem is %s, elem[0] is %s", key, elem, elem[0])
             log.debug("letter_to_stat_type[elem[0]] is %s", letter_to_stat_type[elem[0]])
-            for stat in self.iterate_stats(letter_to_stat_type[elem[0]], key, min_entries):
+            weights, _, stats = self._element_sampling_weights(bg, elem, min_entries)
+            for stat in self._iterate_weighted(weights, stats):
                 yield stat
 
 
@@ -394,12 +1186,11 @@ class StatStorage(object):
         For the other parameters, see `self.sample_for`
         """
 
-        key = self.key_from_bg_and_elem(bg, elem)
-        weights, stats = self._possible_stats(letter_to_stat_type[elem[0]], key, min_entries)
+        weights, _, stats = self._element_sampling_weights(bg, elem, min_entries)
         total_weight = sum(weights)
         coverage = 0.
         for i, weight in enumerate(weights):
-            if stats[i].pdb_name in sampled_stat_names:
+            if stats.pdb_names[i] in sampled_stat_names:
                 coverage += weight/total_weight
         return coverage
 
@@ -431,11 +1222,61 @@ def seq_and_pyrpur_similarity(sequences, stat):
     #log.debug("Score is %f", score)
     return score
 
+#: Maps the 4-letter alphabeth to the purine/pyrimidine alphabeth, for sequences encoded as uint8.
+_PYRPUR_TABLE = np.arange(256, dtype=np.uint8)
+for _c, _t in zip("AGCU", "RRYY"):
+    _PYRPUR_TABLE[ord(_c)] = ord(_t)
+
+def _encode_strands(sequences, lengths):
+    """
+    Encode the strands of the sequences of many stats as one uint8 array.
+
+    Strands are compared as in `identitical_bases`: A strand with 2 nucleotides more
+    than the requested length is trimmed at both ends, strands of any other wrong
+    length are encoded as 0 (which never matches a nucleotide).
+
+    :param sequences: A list of lists of strands (one list per stat)
+    :param lengths: The length of every strand of the target sequence.
+    :returns: An array of shape `len(sequences) x sum(lengths)`
+    """
+    encoded = np.zeros((len(sequences), sum(lengths)), dtype=np.uint8)
+    for i, strands in enumerate(sequences):
+        start = 0
+        for strand, length in zip(strands, lengths):
+            if len(strand)==length+2:
+                strand = strand[1:-1]
+            if len(strand)==length:
+                encoded[i, start:start+length] = np.frombuffer(strand.encode("ascii"), dtype=np.uint8)
+            start+=length
+    return encoded
+
+def seq_and_pyrpur_similarities(sequences, encoded_strands):
+    """
+    The same as `seq_and_pyrpur_similarity`, but for many stats at once.
+
+    :param sequences: The sequences (strands) of the target element.
+    :param encoded_strands: The sequences of the stats, encoded by `_encode_strands`.
+    :returns: An array of scores
+    """
+    target = _encode_strands([sequences], [len(x) for x in sequences])
+    ib4 = np.sum(encoded_strands == target, axis=1)
+    ib2 = np.sum(_PYRPUR_TABLE[encoded_strands] == _PYRPUR_TABLE[target], axis=1)
+    return (ib2 + ib4 + 1) / (sum(len(x) for x in sequences) * 2 +1)
+
 class SequenceDependentStatStorage(StatStorage):
     def __init__(self, filename, fallback_filenames = None, sequence_score = seq_and_pyrpur_similarity):
         self.sequence_score = sequence_score
         super(SequenceDependentStatStorage, self).__init__(filename, fallback_filenames)
 
+    def _sequence_scores(self, sequence, columns, rows):
+        """
+        The sequence_score of the given rows of the StatColumns columns.
+        """
+        if self.sequence_score is not seq_and_pyrpur_similarity:
+            return np.array([self.sequence_score(sequence, columns[row]) for row in rows])
+        encoded_strands = columns.encoded_strands([len(x) for x in sequence])
+        return seq_and_pyrpur_similarities(sequence, encoded_strands[rows])
+
     @staticmethod
     def key_from_bg_and_elem(bg, elem):
         dims = bg.get_node_dimensions(elem)
@@ -446,51 +1287,51 @@ class SequenceDependentStatStorage(StatStorage):
         else:
             return dims[0], tuple(bg.get_define_seq_str(elem, adjacent = elem[0]!="s"))
 
+    @staticmethod
+    def _structural_key(key):
+        """
+        The key without the sequence.
+        """
+        return key[0]
 
-    @lru_cache(maxsize = 256)
-    def _possible_stats(self, stat_type, key, min_entries = 100, enable_loging=True):
+
+    @lru_cache(maxsize = None) # Every element of the RNA has its own key and sequence
+    def _possible_stats(self, stat_type, key, min_entries = 100, enable_logging=True):
         """
-        :returns: Two lists, `weights` and `choose_from` of the same length.
-                  weights is a list of floats, choose_from is a list of stats.
+        :returns: A list `weights` and a StatSelection `choose_from` of the same length.
+                  weights is a list of floats, choose_from behaves like a list of stats.
         """
+        if (stat_type, key, min_entries) in self._stored_candidates:
+            return self._stored_candidates[(stat_type, key, min_entries)]
         key, sequence = key
-        choose_from = []
+        choose_from = StatSelection()
         weights = []
-        statfiles = self._iter_stat_sources()
-        while sum(weights)<min_entries:
-            try:
-                sf = next(statfiles)
-                source = sf[stat_type]
-            except StopIteration: #All stat_files exhausted
-                if enable_logging and (stat_type, key, min_entries) not in self._has_reported:
-                    log.warning("Only {} stats found for {} with key {}".format(len(choose_from), stat_type, key))
-                    self._has_reported.add((stat_type, key, min_entries))
+        for columns, rows in self._get_stat_buckets()[stat_type].get(key, []):
+            if sum(weights)>=min_entries:
                 break
-            if key in source:
-                stats=[ stat for stat in source[key] if not self.in_blacklist(stat) ]
-                num_stats = len(stats)
-                if enable_logging:
-                    log.info("Added %s stats ", num_stats)
-                choose_from.extend(stats)
-                if not weights:
-                    weight = 1
-                else:
-                    remaining_total_weight = min_entries - sum(weights)
-                    weight = min(1, remaining_total_weight/len(stats))
-                for stat in stats:
-                    #log.debug("Evaluating score for %s %s %s", key, sequence, stat)
-                    weights.append(weight*self.sequence_score(sequence, stat))
+            num_stats = len(rows)
+            if enable_logging:
+                log.info("Added %s stats ", num_stats)
+            choose_from.add(columns, rows)
+            if not weights:
+                weight = 1
             else:
-                if enable_logging:
-                    log.info("Nothing added from stat_source %s",id(sf))
+                remaining_total_weight = min_entries - sum(weights)
+                weight = min(1, remaining_total_weight/num_stats)
+            weights.extend((weight*self._sequence_scores(sequence, columns, rows)).tolist())
+        else:
+            #All stat_files exhausted
+            if enable_logging and (stat_type, key, min_entries) not in self._has_reported:
+                log.warning("Only {} stats found for {} with key {}".format(len(choose_from), stat_type, key))
+                self._has_reported.add((stat_type, key, min_entries))
 
-        if not choose_from:
+        if not len(choose_from):
             raise LookupError("No stats found for {} with key {}".format(stat_type, key))
         if enable_logging:
             log.info("For key %s: %s stats with weight in range %s-%s", key, len(choose_from), min(weights), max(weights))
             if len(choose_from)<20:
                 for i, w in enumerate(weights):
-                    log.debug("     Weight %f: %s", w, choose_from[i].seqs)
+                    log.debug("     Weight %f: %s", w, choose_from.seqs[i])
         return weights, choose_from
 
 
@@ -521,6 +1362,14 @@ def update_parser(parser):
                                 'or multiloops. The stats of these elements will be sampled from'
                                 ' a continuouse distribution. EXPERIMENTAL, DONT USE THIS.')
     stat_options.add_argument('--blacklist-stats', type=str, help="A comma seperate list of pdb-ids. Disallow stats from these pdb ids.")
+    stat_options.add_argument('--prefilter-stats', action="store_true",
+                              help="Do not sample stats that can never be part of a valid structure.\n"
+                                   "Currently this removes multiloop segments that are too long\n"
+                                   "to close their junction. Only useful with a junction constraint energy.")
+    stat_options.add_argument('--stat-cache-dir', type=str,
+                              help="A directory for caching the stats that can be sampled for\n"
+                                   "the elements of the RNA. Subsequent runs for the same RNA\n"
+                                   "with the same stats files reuse the cache.")
 
 def from_args(args, cg):
     if args.sequence_based:
@@ -544,4 +1393,8 @@ def from_args(args, cg):
         stat_source = StatSourceClass(jared_out, new_fallbacks, **kwargs)
     else:
         stat_source = StatSourceClass(args.stats_file, args.fallback_stats_files, **kwargs)
+    if args.stat_cache_dir and cg is not None:
+        stat_source.use_candidate_cache(cg, args.stat_cache_dir)
+    if args.prefilter_stats and cg is not None:
+        stat_source.prefilter(cg)
     return stat_source
@@ -53,6 +53,18 @@ parser.add_argument('--num-builds', action='store', type=int,
                          "Each of it will be sampled for \n"
                          "--iterations steps independently")
 
+parser.add_argument('--early-rejection', action="store_true",
+                    help="Draw the random number of the Metropolis criterion\n"
+                         "before the energy evaluation and stop evaluating\n"
+                         "energies as soon as the step will be rejected.")
+
+parser.add_argument('--multiple-try', type=int, metavar="K",
+                    help="Use multiple-try Metropolis sampling with K proposals\n"
+                         "per step. The proposals are built and evaluated\n"
+                         "in K parallel processes.\n"
+                         "Cannot be used with --replica-exchange or\n"
+                         "--early-rejection.")
+
 parser.add_argument('--externally-interacting', type=str,
                             help="A comma-separated list of element names or nt positions, "
                                  "which have interactions with proteins/... and "
@@ -161,10 +173,13 @@ def run(args, cg, main_dir, reference_cg):
 #    raise NotImplementedError("TODO")
 
 def sample_one_trajectory(sampler, iterations):
-    with sampler.stats_collector.open_outfile():
-        for i in range(iterations):
-            sampler.step()
-        sampler.stats_collector.collector.to_file()
+    try:
+        with sampler.stats_collector.open_outfile():
+            for i in range(iterations):
+                sampler.step()
+            sampler.stats_collector.collector.to_file()
+    finally:
+        sampler.close()
 
 def build_spatial_models(args, cg, stat_source, main_dir):
     """
@@ -213,7 +228,17 @@ def setup_sampler(args, sm, stat_source, sampling_energy, replica_nr=None, origi
             os.makedirs(out_dir)
 
     monitor = fbm.from_args(args, original_cg, sampling_energy, stat_source, out_dir, show_min_rmsd)
-    sampler = fbs.MCMCSampler(sm, sampling_energy, mover, monitor)
+    if args.multiple_try:
+        if args.replica_exchange:
+            raise ValueError("--multiple-try and --replica-exchange are mutually exclusive.")
+        if args.early_rejection:
+            raise ValueError("--multiple-try and --early-rejection are mutually exclusive.")
+        sampler = fbs.MultipleTryMCMCSampler(sm, sampling_energy, mover, monitor,
+                                             num_tries=args.multiple_try,
+                                             processes=args.multiple_try)
+    else:
+        sampler = fbs.MCMCSampler(sm, sampling_energy, mover, monitor,
+                                  early_rejection=args.early_rejection)
     return sampler
 
 def setup_rng(args):
@@ -8,6 +8,7 @@ from builtins import (ascii, bytes, chr, dict, filter, hex, input,
 import unittest
 import sys
 import random
+import copy
 try:
     from unittest.mock import Mock #python3
 except:
@@ -16,6 +17,7 @@ except:
 # Scientific import
 import numpy as np
 import pandas as pd
+import scipy.stats
 
 import numpy.testing as nptest
 
@@ -23,9 +25,11 @@ import numpy.testing as nptest
 import forgi.projection.projection2d as ftmp
 import forgi.threedee.model.coarse_grain as ftmc
 import forgi.threedee.utilities.vector as ftuv
+import forgi.threedee.utilities.graph_pdb as ftug
 
 import fess.builder.energy as fbe
-from fess.builder.energy_abcs import EnergyFunction, CoarseGrainEnergy
+from fess.builder.energy_abcs import (EnergyFunction, CoarseGrainEnergy, BinnedDistribution,
+                                      TabulatedDistribution, LengthIndexedData)
 import fess.builder.models as fbm
 from fess.builder.stat_container import StatStorage
 
@@ -93,6 +97,42 @@ class TestClashEnergy(unittest.TestCase):
         #Structure with a clash
         self.assertGreater(self.energy.eval_energy(self.cg_clash), 100.)
         self.assertGreater(self.energy.eval_energy(self.cg_clash, nodes=["s7", "s11"]), 100.)
+        self.assertEqual(self.energy.bad_bulges, [("s11", "s7")])
+
+    def test_incremental_evaluation_equals_full_evaluation(self):
+        for cg in [self.cg, self.cg_clash, self.cg2, self.cg_clash]:
+            full_energy = fbe.StemVirtualResClashEnergy()
+            self.assertEqual(self.energy.eval_energy(cg),
+                             full_energy.eval_energy(cg, nodes=list(cg.defines)))
+            self.assertEqual(sorted(self.energy.bad_bulges), sorted(full_energy.bad_bulges))
+
+    def test_reject_rolls_back_clash_index(self):
+        self.energy.eval_energy(self.cg)
+        self.energy.accept_last_measure()
+        index = self.energy._clash_index
+        self.assertGreater(self.energy.eval_energy(self.cg_clash), 0)
+        self.energy.reject_last_measure()
+        self.assertIs(self.energy._clash_index, index)
+        self.assertEqual(self.energy.eval_energy(self.cg), 0.)
+        self.assertEqual(self.energy.bad_bulges, [])
+
+    def test_stem_virtual_atoms_after_rigid_movement(self):
+        fbe._stem_virtual_atoms(self.cg, "s1")
+        num_templates = len(fbe._STEM_TEMPLATES)
+        self.cg.rotate(0.7, "x")
+        self.cg.add_all_virtual_residues()
+        coords, offsets = fbe._stem_virtual_atoms(self.cg, "s1")
+        self.assertEqual(len(fbe._STEM_TEMPLATES), num_templates)
+        expected = [ atom for i in range(self.cg.stem_length("s1")) for a in (1, 0)
+                     for atom in ftug.virtual_residue_atoms(self.cg, "s1", i, a).values() ]
+        nptest.assert_allclose(coords, expected, atol=1e-8)
+
+    def test_connected_stems_do_not_clash(self):
+        stems = sorted(self.cg.stem_iterator())
+        connected = self.energy._stem_connectivity(self.cg, stems)
+        for i, s1 in enumerate(stems):
+            for j, s2 in enumerate(stems):
+                self.assertEqual(connected[i, j], s1 == s2 or bool(self.cg.edges[s1] & self.cg.edges[s2]))
 
 
     def test_energy_independent_of_nodes(self):
@@ -351,6 +391,14 @@ class TestEnergyFunction_ABC(unittest.TestCase):
         e.accept_last_measure()
         self.assertAlmostEqual(e.adjustment, 27)
 
+    def test_state_key(self):
+        e = DummyEnergy(prefactor=(20,2,2))
+        key = e.state_key()
+        e.accept_last_measure()
+        self.assertEqual(e.state_key(), key)
+        e.accept_last_measure()
+        self.assertNotEqual(e.state_key(), key)
+
 
 class DummyCgEnergy(CoarseGrainEnergy):
     HELPTEXT=""
@@ -361,6 +409,9 @@ class DummyCgEnergy(CoarseGrainEnergy):
         return 0
     def _get_values_from_file(self, filename, nt_length):
         return [0,1,2,3,10, 50, 100]
+    @classmethod
+    def generate_target_distribution(cls, *args, **kwargs):
+        raise NotImplementedError
     def _get_cg_measure(self, cg):
         if self._last_measure is None:
             self._last_measure = 1
@@ -445,6 +496,41 @@ class TestCoarseGrainEnergyABC(unittest.TestCase):
         nptest.assert_almost_equal(orig_ref, e.reference_distribution([1,10,100]))
         nptest.assert_almost_equal(orig_target, e.target_distribution([1,10,100]))
 
+    def test_binned_reference(self):
+        e = self.energy_function
+        e.use_binned_reference()
+        self.assertIsInstance(e.reference_distribution, BinnedDistribution)
+        self.assertEqual(e.reference_distribution.n, 7)
+        self.assertEqual(len(e.accepted_measures), 1)
+        orig_ref = e.reference_distribution([1,10,100])
+        expected = BinnedDistribution([0,1,2,3,10, 50, 100])
+        # An accepted step adds the new measure
+        e._last_measure = 5
+        e.accept_last_measure()
+        expected.add(5)
+        self.assertEqual(e.reference_distribution.n, 8)
+        self.assertEqual(e.accepted_measures, [5])
+        # A rejected step adds the last accepted measure again
+        e._last_measure = 70
+        e.reject_last_measure()
+        expected.add(5)
+        self.assertEqual(e.reference_distribution.n, 9)
+        self.assertEqual(e.accepted_measures, [5])
+        e.accept_last_measure()
+        expected.add(70)
+        self.assertEqual(e.reference_distribution.n, 10)
+        self.assertEqual(e.accepted_measures, [70])
+        nptest.assert_almost_equal(e.reference_distribution.counts, expected.counts)
+        # The 3rd step smoothed the histogram
+        expected.smooth()
+        nptest.assert_almost_equal(e.reference_distribution([1,10,100]), expected([1,10,100]))
+        self.assertFalse(np.allclose(orig_ref, e.reference_distribution([1,10,100])))
+        e.reset_distributions(60)
+        self.assertIsInstance(e.reference_distribution, BinnedDistribution)
+        self.assertEqual(e.reference_distribution.n, 7)
+        self.assertEqual(len(e.accepted_measures), 1)
+        nptest.assert_almost_equal(orig_ref, e.reference_distribution([1,10,100]))
+
     def test_values_within_nt_range(self):
         data = pd.DataFrame({"nt_length": [5,6,7,7,8,9,10,11,12,13,13,13,14,15,19,25,26,27,27,28,29,30],
                              "property" : [1,2,3,4,5,6, 7, 8, 9,10,11,12,13,14,15,16,17,18,19,20,21,22]})
@@ -455,6 +541,64 @@ class TestCoarseGrainEnergyABC(unittest.TestCase):
         vals = CoarseGrainEnergy._values_within_nt_range(data, 27,"property", target_len=3)
         self.assertEqual(set(vals), {17,18,19,20})
 
+class TestBinnedDistribution(unittest.TestCase):
+    def test_binned_distribution_approximates_kde(self):
+        values = list(np.random.normal(40, 8, 300))
+        binned = BinnedDistribution(values)
+        for x in np.random.normal(45, 6, 500):
+            values += [x, x]
+            binned.add(x, 2)
+        binned.smooth()
+        kde = scipy.stats.gaussian_kde(values)
+        xs = np.linspace(0, 100, 500)
+        nptest.assert_allclose(binned(xs), kde(xs), rtol=0.02, atol=10**-3*max(kde(xs)))
+    def test_add_outside_of_histogram(self):
+        binned = BinnedDistribution([1,2,3])
+        binned.add(-100)
+        binned.add(200, 2)
+        binned.smooth()
+        self.assertEqual(binned.n, 6)
+        kde = scipy.stats.gaussian_kde([1,2,3,-100,200,200])
+        nptest.assert_allclose(binned([-300, -100, 200, 400]), kde([-300, -100, 200, 400]), rtol=0.01)
+        self.assertEqual(binned([0, 1, 2]).shape, (3,))
+
+class TestTabulatedDistribution(unittest.TestCase):
+    def test_tabulated_distribution_interpolates(self):
+        norm = scipy.stats.norm(10, 2)
+        tab = TabulatedDistribution.from_function(norm.pdf, 0, 20)
+        xs = np.linspace(0, 20, 333)
+        nptest.assert_allclose(tab.logpdf(xs), norm.logpdf(xs), atol=10**-4)
+        nptest.assert_allclose(tab(xs), norm.pdf(xs), rtol=10**-4)
+        self.assertEqual(tab(10).shape, (1,))
+    def test_tails_are_finite(self):
+        norm = scipy.stats.norm(10, 2)
+        tab = TabulatedDistribution.from_function(norm.pdf, 0, 20)
+        self.assertTrue(np.all(np.isfinite(tab.logpdf([-10**5, -1, 21, 10**5]))))
+        # The log-density decreases with the slope at the edge of the grid.
+        nptest.assert_allclose(tab.logpdf([-1, 21]), norm.logpdf([0, 20])-2.5, rtol=10**-3)
+    def test_zero_density_at_edges(self):
+        uniform = lambda x: np.where((x>0) & (x<10), 0.1, 0)
+        tab = TabulatedDistribution.from_function(uniform, -10, 20)
+        nptest.assert_allclose(tab([1, 5, 9]), [0.1, 0.1, 0.1])
+        self.assertTrue(0 < tab(15) < 0.1)
+        self.assertTrue(0 < tab(-5) < 0.1)
+
+class TestLengthIndexedData(unittest.TestCase):
+    def test_values_within_nt_range(self):
+        data = pd.DataFrame({"nt_length": [30,6,7,7,8,9,10,11,12,13,13,13,14,15,19,25,26,27,27,28,29,5],
+                             "property" : [1,2,3,4,5,6, 7, 8, 9,10,11,12,13,14,15,16,17,18,19,20,21,22]})
+        data = LengthIndexedData(data)
+        nptest.assert_equal(data.values_within_nt_range(10, "property", target_len=3), [6,7,8])
+        nptest.assert_equal(data.values_within_nt_range(10, "property", target_len=6),
+                            [3,4,5,6,7,8,9,10,11,12])
+        nptest.assert_equal(data.values_within_nt_range(27, "property", target_len=3), [17,18,19,20])
+        self.assertEqual(len(data.values_within_nt_range(10, "property", target_len=100)), 22)
+    def test_reference_data_is_shared(self):
+        data = fbe.load_reference_data("stats/rog_target_dist_1S72_0.csv", delimiter=' ',
+                                       comment="#", names=["pdb_id","nt_length","rog"])
+        self.assertIs(data, fbe.load_reference_data("stats/rog_target_dist_1S72_0.csv", delimiter=' ',
+                                                    comment="#", names=["pdb_id","nt_length","rog"]))
+
 class TestCombinedEnergy(unittest.TestCase):
     def test_getattr(self):
         e = fbe.CombinedEnergy()
@@ -469,6 +613,46 @@ class TestCombinedEnergy(unittest.TestCase):
 
         with self.assertRaises(AttributeError):
             e.do_something_else()
+    def test_state_key(self):
+        e = fbe.CombinedEnergy([DummyEnergy(), fbe.CombinedEnergy([DummyEnergy(adjustment=(1,1,1))])])
+        key = e.state_key()
+        self.assertEqual(key, e.state_key())
+        e.accept_last_measure()
+        self.assertNotEqual(key, e.state_key())
+        e.energies.append(fbe.RandomEnergy())
+        self.assertIsNone(e.state_key())
+    def test_eval_energy_changed(self):
+        cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
+        e1 = fbe.DistanceExponentialEnergy("s0", "s1", distance=5)
+        e2 = fbe.DistanceExponentialEnergy("s3", "h1", distance=5)
+        e = fbe.CombinedEnergy([e1, fbe.CombinedEnergy([e2])])
+        energy1 = e1.eval_energy(cg)
+        e.eval_energy(cg)
+        e.accept_last_measure()
+        e1.eval_energy = Mock(return_value=1000.)
+        e2.eval_energy = Mock(return_value=1000.)
+        # Only e2 depends on h1
+        self.assertAlmostEqual(e.eval_energy(cg, changed=["h1"]), energy1+1000.)
+        self.assertEqual(e1.eval_energy.call_count, 0)
+        self.assertEqual(e2.eval_energy.call_count, 1)
+        # Without changed, everything is evaluated
+        self.assertAlmostEqual(e.eval_energy(cg), 2000.)
+        self.assertEqual(e1.eval_energy.call_count, 1)
+        # A different cg is always evaluated
+        e.eval_energy(copy.deepcopy(cg), changed=[])
+        self.assertEqual(e1.eval_energy.call_count, 2)
+    def test_eval_energy_threshold(self):
+        cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
+        e1 = fbe.ConstantEnergy(100.)
+        e2 = fbe.DistanceExponentialEnergy("s0", "s1", distance=5)
+        e2.eval_energy = Mock(return_value=1.)
+        e = fbe.CombinedEnergy([e2, e1])
+        # The ConstantEnergy has no lower bound and is evaluated first
+        self.assertGreater(e.eval_energy(cg, threshold=50.), 50.)
+        self.assertEqual(e2.eval_energy.call_count, 0)
+        self.assertEqual(len(e.constituing_energies), 1)
+        self.assertEqual(e.eval_energy(cg, threshold=150.), e1.eval_energy(cg)+1.)
+        self.assertEqual(e2.eval_energy.call_count, 1)
     def test_hasinstance(self):
         e = fbe.CombinedEnergy([1, 1.2]) #Thanks to Ducktyping, energies can be any object if we don't use them
         self.assertTrue(e.hasinstance(int))
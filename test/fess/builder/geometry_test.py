@@ -0,0 +1,89 @@
+#Future imports
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+# Standard Imports
+import unittest
+
+# Scientific import
+import numpy as np
+import numpy.testing as nptest
+
+# import from forgi and ernwin
+import forgi.threedee.model.coarse_grain as ftmc
+import forgi.threedee.utilities.vector as ftuv
+
+import fess.builder.geometry as fbg
+
+
+class TestSegmentDistances(unittest.TestCase):
+    def test_segment_distances_like_forgi(self):
+        starts1 = np.random.uniform(-10, 10, (20, 3))
+        ends1 = starts1 + np.random.uniform(-10, 10, (20, 3))
+        starts2 = np.random.uniform(-10, 10, (15, 3))
+        ends2 = starts2 + np.random.uniform(-10, 10, (15, 3))
+        # Parallel segments, identical segments and a segment of length 0
+        starts2[0], ends2[0] = starts1[0] + 1, ends1[0] + 1
+        starts2[1], ends2[1] = starts1[1], ends1[1]
+        ends2[2] = starts2[2]
+        distances = fbg.segment_distances(starts1, ends1, starts2, ends2)
+        self.assertEqual(distances.shape, (20, 15))
+        for i in range(20):
+            for j in range(15):
+                p1, p2 = ftuv.line_segment_distance(starts1[i], ends1[i], starts2[j], ends2[j])
+                self.assertAlmostEqual(distances[i, j], ftuv.vec_distance(p1, p2))
+
+
+    def test_segment_distances_closest_points(self):
+        starts1 = np.random.uniform(-10, 10, (6, 3))
+        ends1 = starts1 + np.random.uniform(-10, 10, (6, 3))
+        starts2 = np.random.uniform(-10, 10, (4, 3))
+        ends2 = starts2 + np.random.uniform(-10, 10, (4, 3))
+        distances, points1, points2 = fbg.segment_distances(starts1, ends1, starts2, ends2,
+                                                            closest_points=True)
+        self.assertEqual(points1.shape, (6, 4, 3))
+        for i in range(6):
+            for j in range(4):
+                p1, p2 = ftuv.line_segment_distance(starts1[i], ends1[i], starts2[j], ends2[j])
+                nptest.assert_almost_equal(points1[i, j], p1)
+                nptest.assert_almost_equal(points2[i, j], p2)
+
+    def test_segment_distances_cutoff(self):
+        starts1 = np.random.uniform(-50, 50, (20, 3))
+        ends1 = starts1 + np.random.uniform(-10, 10, (20, 3))
+        starts2 = np.random.uniform(-50, 50, (15, 3))
+        ends2 = starts2 + np.random.uniform(-10, 10, (15, 3))
+        distances = fbg.segment_distances(starts1, ends1, starts2, ends2)
+        close, points1, points2 = fbg.segment_distances(starts1, ends1, starts2, ends2,
+                                                        cutoff=30, closest_points=True)
+        for i in range(20):
+            for j in range(15):
+                closer = ftuv.elements_closer_than(starts1[i], ends1[i], starts2[j], ends2[j], 30)
+                self.assertEqual(close[i, j] < 30, closer)
+        nptest.assert_almost_equal(close[distances < 30], distances[distances < 30])
+        self.assertTrue(np.all(np.isinf(close[distances >= 30])))
+        self.assertTrue(np.all(np.isnan(points1[distances >= 30])))
+
+
+class TestGeometryCache(unittest.TestCase):
+    def setUp(self):
+        self.cg = ftmc.CoarseGrainRNA.from_bg_file("test/fess/data/1GID_A.cg")
+
+    def test_shared_per_structure(self):
+        geometry = fbg.GeometryCache.for_cg(self.cg)
+        vres = geometry.virtual_residues
+        self.assertIs(fbg.GeometryCache.for_cg(self.cg).virtual_residues, vres)
+        nptest.assert_almost_equal(vres, self.cg.get_ordered_virtual_residue_poss())
+        with self.assertRaises(ValueError):
+            vres[0, 0] = 3
+
+    def test_invalidated_on_change(self):
+        hloops = list(self.cg.hloop_iterator())
+        distances = fbg.GeometryCache.for_cg(self.cg).segment_distances(hloops)
+        start, end = self.cg.coords[hloops[0]]
+        self.cg.coords[hloops[0]] = start + 100, end + 100
+        new_distances = fbg.GeometryCache.for_cg(self.cg).segment_distances(hloops)
+        self.assertGreater(new_distances[0, 1], distances[0, 1])
+        nptest.assert_almost_equal(new_distances[1:, 1:], distances[1:, 1:])
@@ -578,6 +578,83 @@ class TestNewTraverse(unittest.TestCase):
         self.sm.new_traverse_and_build(max_steps=5)
         self.assertGreater(ftmsim.cg_rmsd(self.sm.bg, self.cg_copy), 0)
 
+class TestPartialRebuild(unittest.TestCase):
+    def setUp(self):
+        self.cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
+        self.sm = fbm.SpatialModel(self.cg)
+        self.sm.load_sampled_elems(None)
+        self.sm.new_traverse_and_build()
+
+    def test_start_builds_only_downstream_subtree(self):
+        nodes = self.sm.new_traverse_and_build(start="m0", include_start=True)
+        self.assertEqual(nodes, ["m0", "s9", "i6", "s10", "i7", "s11"])
+
+    def test_start_stem_builds_all_branches_after_it(self):
+        # The build order of 1GID_A is branched: s0 -> i0 -> s1 -> i5 -> s2 ...
+        # and s0 -> m0 -> s9 -> ...
+        nodes = self.sm.new_traverse_and_build(start="s1")
+        self.assertEqual(nodes, ["i5", "s2", "i1", "s3", "i2", "s4", "i3", "s5",
+                                 "i4", "s6", "m1", "s7", "m3", "s8"])
+        nodes = self.sm.new_traverse_and_build(start="s1", include_start=True)
+        self.assertEqual(nodes[:2], ["i0", "s1"])
+        self.assertNotIn("s9", nodes)
+        nodes = self.sm.new_traverse_and_build(start="s0")
+        self.assertEqual(set(nodes), set(d for d in self.sm.bg.defines
+                                         if d[0] in "smi" and d in self.sm.bg.mst) - {"s0"})
+        self.assertEqual(self.sm.new_traverse_and_build(start="s11"), [])
+
+    def test_rebuild_changed_does_not_move_upstream_stems(self):
+        old_coords = copy.deepcopy(self.sm.bg.coords)
+        stat = copy.deepcopy(self.sm.elem_defs["i2"])
+        stat.u += 0.5
+        self.sm.elem_defs["i2"] = stat
+        nodes = self.sm.rebuild_changed(["i2"])
+        self.assertEqual(nodes, ["i2", "s4", "i3", "s5", "i4", "s6", "m1", "s7", "m3", "s8"])
+        for stem in ["s0", "s1", "s2", "s3", "s9", "s10", "s11"]:
+            nptest.assert_array_equal(self.sm.bg.coords[stem], old_coords[stem])
+        self.assertFalse(np.allclose(self.sm.bg.coords["s4"], old_coords["s4"]))
+
+    def test_rebuild_changed_equals_full_rebuild(self):
+        stat = copy.deepcopy(self.sm.elem_defs["i5"])
+        stat.t += 0.5
+        self.sm.elem_defs["i5"] = stat
+        self.sm.rebuild_changed(["i5"])
+        sm_full = copy.deepcopy(self.sm)
+        sm_full.new_traverse_and_build()
+        for d in self.sm.bg.defines:
+            nptest.assert_allclose(self.sm.bg.coords[d], sm_full.bg.coords[d])
+        for d in self.sm.bg.stem_iterator():
+            nptest.assert_allclose(self.sm.bg.twists[d], sm_full.bg.twists[d])
+            for i in range(self.sm.bg.stem_length(d)):
+                nptest.assert_allclose(self.sm.bg.v3dposs[d][i][0], sm_full.bg.v3dposs[d][i][0])
+
+    def test_restore_snapshot(self):
+        old_coords = copy.deepcopy(self.sm.bg.coords)
+        old_stat = self.sm.elem_defs["i5"]
+        snapshot = self.sm.snapshot(["i5"])
+        stat = copy.deepcopy(old_stat)
+        stat.t += 0.5
+        self.sm.elem_defs["i5"] = stat
+        self.sm.rebuild_changed(["i5"])
+        self.assertNotEqual(self.sm.bg.coords, old_coords)
+        self.sm.elem_defs["i5"] = old_stat
+        self.sm.restore(snapshot)
+        self.assertEqual(self.sm.bg.coords, old_coords)
+        sm_full = copy.deepcopy(self.sm)
+        sm_full.new_traverse_and_build()
+        for d in self.sm.bg.stem_iterator():
+            for i in range(self.sm.bg.stem_length(d)):
+                nptest.assert_allclose(self.sm.bg.v3dposs[d][i][0], sm_full.bg.v3dposs[d][i][0])
+
+    def test_stems_are_views_into_coords(self):
+        for d in self.sm.bg.stem_iterator():
+            self.assertTrue(self.sm.stems[d].is_bound_to(self.sm.bg.coords, self.sm.bg.twists))
+            nptest.assert_array_equal(self.sm.stems[d].mids, self.sm.bg.coords[d])
+        self.sm.stems["s0"].translate(np.array([1., 2., 3.]))
+        nptest.assert_array_equal(self.sm.stems["s0"].mids, self.sm.bg.coords["s0"])
+        sm_copy = copy.deepcopy(self.sm)
+        self.assertTrue(sm_copy.stems["s0"].is_bound_to(sm_copy.bg.coords, sm_copy.bg.twists))
+
 class ReconstructionTests(unittest.TestCase):
     def test_get_stem_rotation_matrix(self):
         stem1 = fbm.StemModel(mids=(np.array([0.,0.,0.]),np.array([0.,0.,10.])), twists=(np.array([0., 1., 0.]),np.array([0., -1., 0.])))
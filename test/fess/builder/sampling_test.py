@@ -0,0 +1,186 @@
+#Future imports
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input,
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+
+# Standard Imports
+import unittest
+import copy
+import os
+import random
+try:
+    from unittest import mock #python3
+except ImportError:
+    import mock
+
+# Scientific import
+import numpy as np
+import numpy.testing as nptest
+
+# import from forgi and ernwin
+import forgi.threedee.model.coarse_grain as ftmc
+
+import fess.builder.models as fbm
+import fess.builder.move as fbmov
+import fess.builder._other_movers as fbomov
+import fess.builder.energy as fbe
+import fess.builder.sampling as fbs
+
+
+class ChangingStatSource(object):
+    """
+    Returns randomly modified copies of the stats loaded from the cg file,
+    so the tests do not need a stats file.
+    """
+    def __init__(self, elem_defs):
+        self.elem_defs = dict(elem_defs)
+    def sample_for(self, bg, elem):
+        stat = copy.deepcopy(self.elem_defs[elem])
+        stat.u += random.uniform(-0.3, 0.3)
+        stat.v += random.uniform(-0.3, 0.3)
+        stat.pdb_name = "changed{}".format(random.randint(0, 10**6))
+        return stat
+
+
+class ReferenceCountingEnergy(fbe.DistanceExponentialEnergy):
+    """
+    Depends on the accepted measures, like energies with a reference distribution.
+    """
+    def eval_energy(self, cg, background=True, nodes=None, **kwargs):
+        self._last_measure = self.get_distance(cg)
+        energy = super(ReferenceCountingEnergy, self).eval_energy(cg, background, nodes, **kwargs)
+        return energy + 0.1 * len(self.accepted_measures)
+
+    def state_key(self):
+        return len(self.accepted_measures)
+
+
+class FailingMover(fbmov.Mover):
+    """
+    Fails in all processes except the one that created it.
+    """
+    def __init__(self, stat_source):
+        super(FailingMover, self).__init__(stat_source)
+        self.pid = os.getpid()
+    def move(self, sm):
+        if os.getpid() != self.pid:
+            raise ValueError("Failing in worker")
+        return super(FailingMover, self).move(sm)
+
+
+class TestMultipleTryMCMCSampler(unittest.TestCase):
+    processes = None
+
+    def setUp(self):
+        random.seed(1)
+        np.random.seed(1)
+        cg = ftmc.CoarseGrainRNA.from_bg_file("test/fess/data/1GID_A.cg")
+        self.sm = fbm.SpatialModel(cg)
+        self.sm.load_sampled_elems(None)
+        self.sm.new_traverse_and_build()
+        self.stat_source = ChangingStatSource(self.sm.elem_defs)
+        self.energy = fbe.CombinedEnergy([ReferenceCountingEnergy("h1", "h2", distance=0, scale=10)])
+        self.stats_collector = mock.Mock()
+        self.samplers = []
+
+    def tearDown(self):
+        for sampler in self.samplers:
+            sampler.close()
+
+    def make_sampler(self, mover=None, **kwargs):
+        if mover is None:
+            mover = fbmov.Mover(self.stat_source)
+            interior_loops = sorted(self.sm.bg.iloop_iterator())
+            mover._get_elem = lambda sm: random.choice(interior_loops)
+        sampler = fbs.MultipleTryMCMCSampler(self.sm, self.energy, mover, self.stats_collector,
+                                             num_tries=3, processes=self.processes, **kwargs)
+        self.samplers.append(sampler)
+        return sampler
+
+    def assert_workers_in_sync(self, sampler):
+        """
+        Proposals of the workers are the same as proposals starting from the accepted state.
+        """
+        state = random.getstate()
+        results = sampler._propose(None, 3)
+        random.setstate(state)
+        seeds = [ random.randint(0, 2**32-1) for i in range(3) ]
+        reference = fbs._ProposalWorker(copy.deepcopy(self.sm), self.energy, sampler.mover)
+        expected = reference.propose(None, seeds)
+        self.assertEqual(sorted(ms for ms, _, _ in results), sorted(ms for ms, _, _ in expected))
+        nptest.assert_allclose(sorted(e for _, e, _ in results), sorted(e for _, e, _ in expected))
+
+    def test_workers_stay_in_sync(self):
+        sampler = self.make_sampler()
+        accepted = [ sampler.step() for i in range(8) ]
+        # The tests are only meaningful, if there were accepted and rejected steps.
+        self.assertIn(True, accepted)
+        self.assertIn(False, accepted)
+        self.assertEqual(sampler._worker_defs, self.sm.elem_defs)
+        self.assert_workers_in_sync(sampler)
+        # The structure is the one built from the stats.
+        sm_full = copy.deepcopy(self.sm)
+        sm_full.new_traverse_and_build()
+        for d in self.sm.bg.defines:
+            nptest.assert_allclose(self.sm.bg.coords[d], sm_full.bg.coords[d], atol=10**-8)
+
+    def test_all_inf_proposals_are_rejected(self):
+        sampler = self.make_sampler()
+        stats = dict(self.sm.elem_defs)
+        new_stat = self.stat_source.sample_for(self.sm.bg, "i0")
+        with mock.patch.object(sampler, "_propose",
+                               return_value=[("i0:a->b;", float("inf"), {"i0": new_stat})]*3):
+            self.assertFalse(sampler.step())
+        self.assertEqual(self.sm.elem_defs, stats)
+        self.assertAlmostEqual(sampler.prev_energy, self.energy.eval_energy(self.sm.bg))
+        movestring = self.stats_collector.update_statistics.call_args[0][3]
+        self.assertTrue(movestring.endswith("R"))
+        self.assert_workers_in_sync(sampler)
+
+    def test_acceptance_ratio_uses_energy_of_current_state(self):
+        sampler = self.make_sampler()
+        sampler.prev_energy = 5.
+        new_stat = self.stat_source.sample_for(self.sm.bg, "i0")
+        proposals = [("i0:a->b;", 10., {"i0": new_stat})] + [("x", float("inf"), {})]*2
+        references = [("x", float("inf"), {})]*2
+        # With only infinite reference energies, the acceptance probability is exp(5-10)
+        with mock.patch.object(sampler, "_propose", side_effect=[proposals, references]):
+            with mock.patch("random.random", return_value=0.01):
+                self.assertFalse(sampler.step())
+        self.assertIsNot(self.sm.elem_defs["i0"], new_stat)
+        sampler.prev_energy = 5.
+        num_accepted = len(self.energy.energies[0].accepted_measures)
+        with mock.patch.object(sampler, "_propose", side_effect=[proposals, references]):
+            with mock.patch("random.random", return_value=0.005):
+                self.assertTrue(sampler.step())
+        self.assertIs(self.sm.elem_defs["i0"], new_stat)
+        # The energy of the new state is evaluated (before its measure is accepted)
+        distance_energy = fbe.DistanceExponentialEnergy("h1", "h2", distance=0, scale=10)
+        self.assertAlmostEqual(sampler.prev_energy,
+                               distance_energy.eval_energy(self.sm.bg) + 0.1 * num_accepted)
+        self.assert_workers_in_sync(sampler)
+
+    def test_mst_changing_movers_are_not_supported(self):
+        with self.assertRaises(ValueError):
+            self.make_sampler(fbomov.MSTchangingMover(self.stat_source))
+        mixed = fbmov.MixedMover([fbmov.Mover(self.stat_source),
+                                  fbomov.MSTchangingMover(self.stat_source)])
+        with self.assertRaises(ValueError):
+            self.make_sampler(mixed)
+
+    def test_early_rejection_is_not_supported(self):
+        with self.assertRaises(ValueError):
+            self.make_sampler(early_rejection=True)
+
+
+class TestMultipleTryMCMCSamplerProcesses(TestMultipleTryMCMCSampler):
+    processes = 2
+
+    def test_errors_in_workers_are_raised(self):
+        mover = FailingMover(self.stat_source)
+        interior_loops = sorted(self.sm.bg.iloop_iterator())
+        mover._get_elem = lambda sm: random.choice(interior_loops)
+        sampler = self.make_sampler(mover)
+        with self.assertRaises(RuntimeError):
+            sampler.step()
@@ -97,6 +97,46 @@ class TestMSTchangingMoverPublicAPI(TestMoverBaseClassPublicAPI):
         self.mover._get_elem = old_get_elem
 
 
+class TestMSTchangingMoverRevert(unittest.TestCase):
+    """
+    Does not need the real stats: The stat source returns modified copies
+    of the stats loaded from the cg file.
+    """
+    def setUp(self):
+        cg = ftmc.CoarseGrainRNA.from_bg_file("test/fess/data/1GID_A.cg")
+        self.sm = SpatialModel(cg)
+        self.sm.load_sampled_elems(None)
+        self.sm.new_traverse_and_build()
+        def sample_for(bg, elem):
+            stat = copy.deepcopy(self.sm.elem_defs[elem])
+            stat.u += 0.3
+            stat.pdb_name = "changed"
+            return stat
+        stat_source = mock.Mock()
+        stat_source.sample_for.side_effect = sample_for
+        self.mover = fbmov.MSTchangingMover(stat_source)
+        self.mover._get_elem = lambda sm: "m1" # Part of a regular multiloop
+
+    def test_revert_restores_mst_stats_and_coords(self):
+        initial_mst = copy.copy(self.sm.bg.mst)
+        initial_coords = copy.deepcopy(self.sm.bg.coords)
+        initial_stats = dict(self.sm.elem_defs)
+        self.assertTrue(self.mover.move(self.sm).startswith("BREAKm1"))
+        self.assertNotEqual(self.sm.bg.mst, initial_mst)
+        with mock.patch.object(self.sm, "new_traverse_and_build",
+                               wraps=self.sm.new_traverse_and_build) as full_build:
+            with mock.patch.object(self.sm, "rebuild_changed") as partial_build:
+                self.mover.revert(self.sm)
+        # The structure is built exactly once
+        self.assertEqual(full_build.call_count, 1)
+        self.assertEqual(partial_build.call_count, 0)
+        self.assertEqual(self.sm.bg.mst, initial_mst)
+        self.assertEqual(self.sm.bg.coords, initial_coords)
+        self.assertEqual(set(self.sm.elem_defs), set(initial_stats))
+        for elem, stat in initial_stats.items():
+            self.assertIs(self.sm.elem_defs[elem], stat)
+
+
 class TestConnectedElementMoverPublicAPI(TestNMoverPublicAPI):
     def setUp(self):
         super(TestConnectedElementMoverPublicAPI, self).setUp()
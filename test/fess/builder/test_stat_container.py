@@ -5,6 +5,8 @@ from builtins import (ascii, bytes, chr, dict, filter, hex, input,
 from future.utils import viewkeys
 import unittest
 import sys
+import numpy as np
+import numpy.testing as nptest
 try: #py 3K
     from io import StringIO
 except ImportError:
@@ -18,6 +20,10 @@ try:
 except ImportError:
     from mock import mock_open, patch
 import logging
+import os
+import shutil
+import tempfile
+import warnings
 
 log = logging.getLogger(__name__)
 class ParseFileTests(unittest.TestCase):
@@ -69,6 +75,167 @@ class ReadFileTests(unittest.TestCase):
         self.assertEqual(stats["5prime"][4],
                          [ftmstats.LoopStat("5prime test:f_0 4 20.4034805163 1.47912394946 -0.0715301558972")])
 
+class StatsCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "test.stats")
+        with open(self.filename, "w") as f:
+            f.write("stem test:s_0 5 10.388 2.43294047108 1 5 10 15 GCAUG UGCAU\n"
+                    "stem test:s_1 5 11.388 2.43294047108 20 24 30 34 GCAUG UGCAU\n"
+                    "loop test:h_0 6 15.2401560955 0.269833051418 0.731484795668\n")
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache_is_written_and_used(self):
+        stats = fbstat.read_stats_file(self.filename)
+        self.assertTrue(os.path.isdir(fbstat.stats_cache_filename(self.filename)))
+        cached = fbstat.read_stats_file(self.filename)
+        self.assertEqual(cached["stem"][5][1].pdb_name, "test:s_1")
+        self.assertEqual(cached["stem"][5].pdb_names, ["test:s_0", "test:s_1"])
+        self.assertEqual(list(cached["stem"][5].defines[1]), [20, 24, 30, 34])
+        self.assertEqual(list(cached["stem"][5].seqs), ["GCAUG&UGCAU", "GCAUG&UGCAU"])
+        self.assertAlmostEqual(cached["stem"][5].params["length"][1], 11.388)
+        self.assertAlmostEqual(cached["loop"][6].params["u"][0], 0.269833051418)
+        self.assertEqual(cached["loop"][6][0].phys_length, stats["loop"][6][0].phys_length)
+
+    def test_outdated_cache_is_not_used(self):
+        fbstat.read_stats_file(self.filename)
+        with open(self.filename, "a") as f:
+            f.write("stem test:s_2 5 12.388 2.43294047108 40 44 50 54 GCAUG UGCAU\n")
+        stats = fbstat.read_stats_file(self.filename)
+        self.assertEqual(len(stats["stem"][5]), 3)
+
+    def test_possible_stats_are_columnar(self):
+        st = fbstat.StatStorage(self.filename, blacklist=["s_0"])
+        weights, stats = st._possible_stats("stem", 5)
+        self.assertEqual(weights, [1])
+        self.assertEqual(stats.pdb_names, ["test:s_1"])
+        self.assertAlmostEqual(stats.params["length"][0], 11.388)
+        self.assertEqual(stats[0].pdb_name, "test:s_1")
+
+    def test_candidate_cache(self):
+        cg = ftmc.CoarseGrainRNA.from_dotbracket(dotbracket_str = "(((((...)))))", seq = "AUGCACCCUGCAU")
+        cache_dir = os.path.join(self.tmpdir, "candidates")
+        st = fbstat.StatStorage(self.filename)
+        st.use_candidate_cache(cg, cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        st2 = fbstat.StatStorage(self.filename)
+        st2.use_candidate_cache(cg, cache_dir)
+        self.assertEqual(st2.sample_for(cg, "s0").pdb_name[:6], "test:s")
+        self.assertEqual(st2._possible_stats("stem", 5)[1].pdb_names, ["test:s_0", "test:s_1"])
+        self.assertIsNone(st2._sources) # The stats file was not read.
+
+    def test_prefilter(self):
+        cg = ftmc.CoarseGrainRNA.from_dotbracket(dotbracket_str = "(((((...)))))", seq = "AUGCACCCUGCAU")
+        def short_stems(stat_source, cg, elem, stats, min_entries):
+            if elem[0]!="s":
+                return None
+            return stats.params["length"]<11
+        st = fbstat.StatStorage(self.filename)
+        st.prefilter(cg, [short_stems])
+        self.assertEqual(set(stat.pdb_name for stat in st.sample_many(cg, "s0", 20)), set(["test:s_0"]))
+        self.assertEqual([stat.pdb_name for stat in st.iterate_stats_for(cg, "s0")], ["test:s_0"])
+        # Only the sampling for elements of cg is affected
+        self.assertEqual(len(st._possible_stats("stem", 5)[1]), 2)
+
+    def test_sampling_weights_are_stored_per_instance(self):
+        st = fbstat.StatStorage(self.filename)
+        weights, cumulative_weights, stats = st._sampling_weights("stem", 5)
+        nptest.assert_almost_equal(cumulative_weights, [1, 2])
+        # More keys than an RNA has elements do not evict the weights.
+        for key in range(6, 300):
+            st._sampling_weights("loop", key)
+        self.assertIs(st._sampling_weights("stem", 5)[1], cumulative_weights)
+        self.assertIsNot(fbstat.StatStorage(self.filename)._sampling_weights("stem", 5)[1],
+                         cumulative_weights)
+
+    def test_fallback_for_large_keys(self):
+        st = fbstat.StatStorage(self.filename)
+        _, stats = st._possible_stats("loop", 5000)
+        self.assertEqual(stats.pdb_names, ["test:h_0"])
+        with self.assertRaises(LookupError):
+            st._possible_stats("loop", 5000, strict=True)
+
+    def test_load_stat_by_name(self):
+        cg = ftmc.CoarseGrainRNA.from_dotbracket(dotbracket_str = "(((((...)))))", seq = "AUGCACCCUGCAU")
+        st = fbstat.StatStorage(self.filename)
+        stat = st.load_stat_by_name(cg, "s0", "test:s_1")
+        self.assertEqual(stat.pdb_name, "test:s_1")
+        self.assertAlmostEqual(stat.phys_length, 11.388)
+        with self.assertRaises(RuntimeError):
+            st.load_stat_by_name(cg, "s0", "test:s_2")
+        # Only the key of the loaded element is indexed
+        self.assertEqual(list(st._name_index), [("stem", 5)])
+
+    def test_load_stat_by_name_sequence_dependent(self):
+        cg = ftmc.CoarseGrainRNA.from_dotbracket(dotbracket_str = "(((((...)))))", seq = "AUGCACCCUGCAU")
+        st = fbstat.SequenceDependentStatStorage(self.filename)
+        with patch.object(fbstat.SequenceDependentStatStorage, "_possible_stats") as possible_stats:
+            stat = st.load_stat_by_name(cg, "s0", "test:s_1")
+        possible_stats.assert_not_called()
+        self.assertEqual(stat.pdb_name, "test:s_1")
+        # The index uses the key without the sequence, no other stat was created.
+        self.assertEqual(list(st._name_index), [("stem", 5)])
+        columns, _ = st._get_stat_buckets()["stem"][5][0]
+        self.assertEqual(list(columns._stats), [1])
+
+    def test_sequence_scores_are_columnar(self):
+        with open(self.filename, "a") as f:
+            f.write("stem test:s_2 5 12.388 2.43294047108 40 44 50 54 AUGCA UCCAU\n")
+        cg = ftmc.CoarseGrainRNA.from_dotbracket(dotbracket_str = "(((((...)))))", seq = "AUGCACCCUGCAU")
+        st = fbstat.SequenceDependentStatStorage(self.filename)
+        key, sequence = st.key_from_bg_and_elem(cg, "s0")
+        weights, stats = st._possible_stats("stem", (key, sequence))
+        # No stat object was created for scoring the sequences
+        columns, _ = st._get_stat_buckets()["stem"][5][0]
+        self.assertEqual(columns._stats, {})
+        with open(self.filename) as f:
+            parsed = fbstat.parse_stats_file(f)
+        for i, stat in enumerate(parsed["stem"][5]):
+            self.assertAlmostEqual(weights[i], fbstat.seq_and_pyrpur_similarity(sequence, stat))
+        self.assertEqual(stats.seqs[2], "AUGCA&UCCAU")
+
+    def test_get_stat_buckets(self):
+        fallback = os.path.join(self.tmpdir, "fallback.stats")
+        with open(fallback, "w") as f:
+            f.write("stem fallback:s_0 6 12.388 2.43294047108 1 6 10 15 GCAUGC GCAUGC\n"
+                    "stem fallback:s_1 5 13.388 2.43294047108 1 5 10 14 GCAUG UGCAU\n")
+        st = fbstat.StatStorage(self.filename, [fallback], blacklist=["s_0"])
+        with warnings.catch_warnings():
+            # Python<3.7 only warns about a StopIteration raised inside the generator
+            warnings.simplefilter("error", DeprecationWarning)
+            warnings.simplefilter("error", PendingDeprecationWarning)
+            buckets = st._get_stat_buckets()
+        self.assertEqual(set(buckets["stem"]), {5})
+        self.assertEqual([ columns.pdb_names[rows[0]] for columns, rows in buckets["stem"][5] ],
+                         ["test:s_1", "fallback:s_1"])
+        self.assertEqual(set(buckets["loop"]), {6})
+        self.assertEqual(st.sample_for(ftmc.CoarseGrainRNA.from_dotbracket(
+                                            dotbracket_str = "(((((...)))))", seq = "AUGCACCCUGCAU"),
+                                       "s0").pdb_name[-3:], "s_1")
+
+class ContinuouseStatSamplerTests(unittest.TestCase):
+    def setUp(self):
+        rnd = np.random.RandomState(1)
+        self.stats = [ ftmstats.AngleStat(stat_type="angle", pdb_name="test:i_{}".format(i),
+                                          dim1=2, dim2=3, u=rnd.rand(), v=rnd.rand(), t=rnd.rand(),
+                                          r1=10.+i%5, u1=rnd.rand(), v1=rnd.rand(),
+                                          ang_type=1, define=[], seq="", vres={})
+                       for i in range(20) ]
+
+    def test_sample_more_than_one_block(self):
+        sampler = fbstat.ContinuouseStatSampler(self.stats, (2,3,1))
+        samples = [ sampler.sample() for i in range(sampler.block_size+10) ]
+        self.assertEqual(samples[-1].dim1, 2)
+        self.assertEqual(samples[-1].ang_type, 1)
+        self.assertAlmostEqual(sum(s.r1 for s in samples)/len(samples), 12., delta=0.5)
+        self.assertTrue(all(0<=s.u<=3.1416 for s in samples))
+        self.assertNotEqual(samples[0].r1, samples[-1].r1)
+
+    def test_insufficient_stats(self):
+        with self.assertRaises(ValueError):
+            fbstat.ContinuouseStatSampler(self.stats[:2], (2,3,1))
+
 class StatStorageTest(unittest.TestCase):
     def test_stat_files_are_loaded_lazily(self):
         stats_open = mock_open()
@@ -156,6 +323,14 @@ class StatStoragePublicAPITests(unittest.TestCase):
         self.assertGreater(mc[2][1], 25) #Expectation value 50
         self.assertLess(mc[2][1], 75)
 
+    def test_sample_many(self):
+        c = Counter(stat.pdb_name for stat in self.st.sample_many(self.cg, "s0", 200, 2))
+        mc =  c.most_common()
+        self.assertEqual(mc[0][0], "test:s_0")
+        self.assertGreater(mc[0][1], 75) #Expectation value 100
+        self.assertLess(mc[0][1], 150)
+        self.assertEqual(sum(c.values()), 200)
+
     def test_iterate_stats(self):
         #With minimal 10 stats, the 3 stats found in the 3 files are used.
         if True: #with self.assertWarnsRegex(UserWarning, "Only .* stats found for .* with key .*"): #Only python 3.3+
@@ -174,6 +349,12 @@ class StatStoragePublicAPITests(unittest.TestCase):
         stat_iter = self.st.iterate_stats_for(self.cg, "s0", 2)
         self.assertEqual(next(stat_iter).pdb_name, "test:s_0")
 
+    def test_load_stat_by_name(self):
+        self.assertEqual(self.st.load_stat_by_name(self.cg, "s0", "fallback2:s_0").pdb_name, "fallback2:s_0")
+        self.assertEqual(self.st.load_stat_by_name(self.cg2, "i0", "test:i_0").pdb_name, "test:i_0")
+        with self.assertRaises(RuntimeError):
+            self.st.load_stat_by_name(self.cg, "s0", "fallback2:s_1") # Has another length
+
     def test_coverage_for(self):
         cov = self.st.coverage_for(set(["test:s_0", "fallback2:s_0", "fallback2:s_2"]), self.cg, "s0", 10)
         self.assertEqual(cov, 1.) # All stats have been sampled (although this is less than min-stats
@@ -186,6 +367,19 @@ class StatStoragePublicAPITests(unittest.TestCase):
         cov = self.st.coverage_for(set(["test:i_0", "fallback1:i_0"]), self.cg2, "i0", 2)
         self.assertAlmostEqual(cov, 1.) # The file fallback2 is not needed at all.
 
+class SequenceSimilarityTests(unittest.TestCase):
+    def test_vectorized_similarity_equals_similarity(self):
+        class FakeStat(object):
+            def __init__(self, seqs):
+                self.seqs = seqs
+        stats = [FakeStat(["GCAUG", "UGCAU"]), FakeStat(["AGCAUGA", "UGCAU"]),
+                 FakeStat(["GCAU", "UGCAU"]), FakeStat(["CCCCC", "AAAAA"])]
+        sequence = ("GCAUC", "AGCAU")
+        encoded = fbstat._encode_strands([stat.seqs for stat in stats], [5, 5])
+        scores = fbstat.seq_and_pyrpur_similarities(sequence, encoded)
+        for i, stat in enumerate(stats):
+            self.assertAlmostEqual(scores[i], fbstat.seq_and_pyrpur_similarity(sequence, stat))
+
 class SequenceDependentStatStorageTests(unittest.TestCase):
     def setUp(self):
         self.st = fbstat.SequenceDependentStatStorage("test/fess/data/test1.stats", ["test/fess/data/fallback1.stats", "test/fess/data/fallback2.stats"])